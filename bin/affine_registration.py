@@ -6,26 +6,16 @@ import argparse
 import logging
 import os
 from utils import logging_config
-from utils.misc import create_checkpoint_dirs
-from utils.image_cropping import load_h5_region
-from utils.image_cropping import get_image_file_shape
-from utils.image_cropping import get_padding_shape
-from utils.image_cropping import zero_pad_array
-from utils.image_cropping import crop_2d_array
-from utils.image_cropping import get_crop_areas
-from utils.image_mapping import compute_affine_mapping_cv2
-from utils.wrappers.apply_mappings import apply_mapping
-from utils.io_tools import save_pickle, load_nd2, load_h5
+from utils.profiling import setup_profiling, span
+from utils.service import run_in_service
+from utils.sample_store import track_stage
+from utils.misc import create_checkpoint_dirs, get_grid_params_path, get_affine_matrix_path
+from utils.artifact_index import ArtifactIndex, get_artifact_key, get_crop_key, get_file_identity
 
 
 logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
-def binarize_image(image, thresh=None, alpha=1.5):
-    if thresh == None:
-        thresh = np.mean(image)
-    return (image > thresh * alpha).astype('int8')
-
 def get_cropping_params(shape):
     """
     Determines cropping parameters based on the size of the input image.
@@ -55,100 +45,149 @@ def get_cropping_params(shape):
 
     return crop_width_x, crop_width_y, overlap_x, overlap_y
 
-def get_dense_crop(input_path, fixed_image_path, crop_areas, nonzero_thresh=0.15):
+def get_affine_matrix(input_path, fixed_image_path, grid, crop=False, crop_size=4000, n_features=2000, matrix_path=None):
     """
-    Loads and pads image crops, ensuring minimal zero-valued pixels in the moving image.
-    
+    Computes the affine transformation matrix of a moving image on a dense region of the images, or loads
+    it if it was saved for the same images and parameters.
+
     Args:
         input_path (str): Path to the moving image.
         fixed_image_path (str): Path to the fixed image.
-        crop_areas (list): List of areas to crop from the input images.
-    
+        grid (CropGrid): Crop grid of the moving image, whose crops are candidate regions.
+        crop (bool): Whether to compute affine mapping using a smaller region.
+        crop_size (int): Size of the subregion for affine mapping.
+        n_features (int): Number of features to use for the affine transformation.
+        matrix_path (str, optional): Path where the matrix is saved. The matrix is not saved if None.
+
     Returns:
-        tuple: Fixed crop and moving crop arrays after padding.
+        tuple: The affine transformation matrix and its artifact key.
     """
-    for area in crop_areas:
-        # Load specific region of the images for comparison
-        moving_crop = load_h5_region(input_path, area)
-        fixed_crop = load_h5_region(fixed_image_path, area)
-
-        # Select DAPI channel (channel 2)
-        moving_crop = np.squeeze(moving_crop[:, :, 2])
-        fixed_crop = np.squeeze(fixed_crop[:, :, 2])
-
-        # Pad the crops if needed
-        moving_shape = moving_crop.shape
-        fixed_shape = fixed_crop.shape
-        padding_shape = get_padding_shape(moving_shape, fixed_shape)
-        moving_crop = zero_pad_array(moving_crop, padding_shape)
-        fixed_crop = zero_pad_array(fixed_crop, padding_shape)
-        nonzero_prop = np.mean(binarize_image(moving_crop))
-        
-        # Stop cropping if sufficient non-zero pixels are found
-        if nonzero_prop >= nonzero_thresh:
-            break
+    # Imported when needed, so that the script starts quickly and jobs submitted to the service stay light
+    from utils.image_cropping import get_dense_crop
+    from utils.image_mapping import compute_affine_mapping_cv2
 
-    return fixed_crop, moving_crop
+    key = get_artifact_key('affine_matrix', get_file_identity(input_path), get_file_identity(fixed_image_path),
+                           grid.crop_areas, crop, crop_size, n_features)
+    index = ArtifactIndex(os.path.dirname(matrix_path)) if matrix_path is not None else None
+    if index is not None and index.is_valid(matrix_path, key):
+        logger.info(f'Affine transformation matrix loaded from {matrix_path}.')
+        return np.load(matrix_path), key
 
-def affine_registration(input_path, fixed_image_path, current_registered_crops_dir, 
-                        crop_width_x, crop_width_y, overlap_x, overlap_y, crop=False, crop_size=4000, n_features=2000):
+    # Find a dense region to compute the affine transformation matrix
+    fixed_crop, moving_crop = get_dense_crop(input_path, fixed_image_path, grid.crop_areas)
+
+    logger.info('Computing affine transformation matrix.')
+    matrix = compute_affine_mapping_cv2(fixed_crop, moving_crop, crop, crop_size, n_features)
+    logger.info('Transformation computed successfully.')
+
+    del fixed_crop, moving_crop
+    gc.collect()
+
+    if index is not None:
+        index.invalidate([matrix_path])
+        np.save(matrix_path, matrix)
+        index.record(matrix_path, key)
+        index.flush()
+
+    return matrix, key
+
+def affine_registration(input_path, fixed_image_path, current_registered_crops_dir, grid, 
+                        crop=False, crop_size=4000, n_features=2000, adaptive_overlap=False, grid_params_path=None,
+                        grid_key=None, matrix_path=None):
     """
-    Registers moving and fixed images using an affine transformation and saves the registered image.
+    Registers moving and fixed images using an affine transformation and saves the registered crops.
+    Only the crops whose key changed, because the moving image, the transformation or the crop area
+    changed, are computed again.
 
     Args:
         input_path (str): Path to the moving image.
-        output_path (str): Path to save the registered image.
         fixed_image_path (str): Path to the fixed image used for registration.
         current_registered_crops_dir (str): Directory to store intermediate crops.
+        grid (CropGrid): Crop grid of the moving image.
         crop (bool): Whether to compute affine mapping using a smaller region.
         crop_size (int): Size of the subregion for affine mapping.
         n_features (int): Number of features to use for the affine transformation.
+        adaptive_overlap (bool): Whether to choose the overlap from the deformation measured on a coarse pass.
+        grid_params_path (str, optional): Path where the crop grid manifest used by the following stages is saved.
+        grid_key (str, optional): Key the crop grid manifest is recorded with.
+        matrix_path (str, optional): Path where the affine transformation matrix is saved.
+
+    Returns:
+        CropGrid: The crop grid the moving image was cropped with.
     """
-    # Get image shape and determine crop areas
-    mov_shape = get_image_file_shape(input_path)
-    fixed_shape = get_image_file_shape(fixed_image_path)
-    padding_shape = get_padding_shape(mov_shape, fixed_shape)
-    crop_areas = get_crop_areas(shape=padding_shape, crop_width_x=crop_width_x, crop_width_y=crop_width_y, overlap_x=overlap_x, overlap_y=overlap_y)
+    from utils.crop_grid import CropGrid, get_crop_path
+    from utils.image_cropping import zero_pad_array, crop_2d_array
+    from utils.io_tools import save_pickle, load_h5
+    from utils.overlap_estimation import estimate_overlap
+    from utils.wrappers.apply_mappings import apply_mapping
 
-    # Find a dense region to compute the affine transformation matrix
-    fixed_crop, moving_crop = get_dense_crop(input_path, fixed_image_path, crop_areas[1])
+    matrix, matrix_key = get_affine_matrix(input_path, fixed_image_path, grid, crop, crop_size, n_features, matrix_path)
 
-    logger.info(f'Computing affine transformation matrix.')
-    matrix = compute_affine_mapping_cv2(fixed_crop, moving_crop, crop, crop_size, n_features)
-    logger.info(f'Transformation computed successfully.')
+    if adaptive_overlap:
+        # Choose the smallest overlap covering the residual deformation and use it for every stage
+        overlap_x, overlap_y = estimate_overlap(fixed_image_path, input_path, matrix, grid.shape, 
+                                                grid.crop_width_x, grid.crop_width_y, grid.overlap_x, grid.overlap_y)
+        grid = CropGrid(grid.shape, grid.crop_width_x, grid.crop_width_y, overlap_x, overlap_y)
 
-    del moving_crop
-    gc.collect()
+    if grid_params_path is not None:
+        grid.save(grid_params_path, grid_key)
+
+    # Each crop depends on the moving image, its area and the transformation
+    n_channels = 3
+    index = ArtifactIndex(current_registered_crops_dir)
+    moving_identity = get_file_identity(input_path)
+    keys = {
+        (idx, ch): get_artifact_key('affine_split', matrix_key, get_crop_key(moving_identity, grid.area(idx), ch))
+        for ch in range(n_channels) for idx in grid.crop_indices
+    }
+    invalid_crops = [
+        (idx, ch) for (idx, ch), key in keys.items()
+        if not index.is_valid(get_crop_path(current_registered_crops_dir, 'affine_split', idx, ch), key)
+    ]
+    if not invalid_crops:
+        logger.info(f'All {grid.n_crops} affine registered crops of {input_path} are up to date.')
+        return grid
+
+    index.invalidate([get_crop_path(current_registered_crops_dir, 'affine_split', idx, ch) for idx, ch in invalid_crops])
 
     # Load and pad the moving image
     logger.debug(f"Loading moving image {input_path}")
     moving_image = load_h5(input_path)
     # Apply the affine transformation to each crop and channel
-    n_channels = 3
     for ch in range(n_channels):
-        for idx, area in zip(crop_areas[0], crop_areas[1]):
-            checkpoint_filename = os.path.join(current_registered_crops_dir, f'affine_split_{idx[0]}_{idx[1]}_{ch}.pkl')
-            if not os.path.exists(checkpoint_filename):
-                crop = crop_2d_array(
-                    array=zero_pad_array(
-                        array=np.squeeze(moving_image[:, :, ch]), 
-                        target_shape=padding_shape
-                    ),
-                    crop_areas=area
-                )
-
-                logger.info(f'Applying transformation to moving crops.')
+        channel_crops = [idx for idx, crop_ch in invalid_crops if crop_ch == ch]
+        if not channel_crops:
+            continue
+
+        channel = zero_pad_array(array=np.squeeze(moving_image[:, :, ch]), target_shape=grid.shape)
+        for idx in channel_crops:
+            checkpoint_filename = get_crop_path(current_registered_crops_dir, 'affine_split', idx, ch)
+            crop = crop_2d_array(array=channel, crop_areas=grid.area(idx))
+
+            logger.info('Applying transformation to moving crops.')
+            with span('affine_warp', 'tile', tile=idx, channel=ch, bytes=crop.nbytes):
                 crop = ((idx) + (ch,), apply_mapping(matrix, crop, 'cv2'))
-                logger.info(f'Transformation applied successfully.')
+            logger.info('Transformation applied successfully.')
+
+            # Save the transformed crop
+            save_pickle(crop, checkpoint_filename)
+            index.record(checkpoint_filename, keys[(idx, ch)])
 
-                # Save the transformed crop
-                save_pickle(crop, checkpoint_filename)
+        # Record the crops of each channel, so that an interrupted run keeps them
+        index.flush()
+        del channel
 
     del moving_image, crop
     gc.collect()
 
+    return grid
+
 
 def main(args):
+    from utils.crop_grid import CropGrid, get_grid_key, load_grid_manifest
+    from utils.resource_model import GB, get_image_shape, predict_resources
+    from utils.scratch import reserve_scratch, release_reservation
+
     handler = logging.FileHandler(os.path.join(args.logs_dir, 'image_registration.log'))
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
@@ -157,44 +196,45 @@ def main(args):
     input_path = args.input_path.replace('.nd2', '.h5')
     fixed_image_path = args.fixed_image_path.replace('.nd2', '.h5')
 
-    filename = os.path.basename(input_path) # Name of the output file 
-    dirname = os.path.basename(os.path.dirname(input_path)) # Name of the parent directory to output file
-    file_output_dir = os.path.join(args.output_dir, 'affine', dirname) # Path to parent directory of the output file
-    output_path = os.path.join(file_output_dir, filename) # Path to output output file
-
-    # Get image shape and determine crop areas
-    mov_shape = get_image_file_shape(input_path)
-    fixed_shape = get_image_file_shape(fixed_image_path)
-    padding_shape = get_padding_shape(mov_shape, fixed_shape)
-    crop_areas = get_crop_areas(
-        shape=padding_shape, 
-        crop_width_x=args.crop_width_x, crop_width_y=args.crop_width_y, 
-        overlap_x=args.overlap_x, overlap_y=args.overlap_y
-    )
+    # Use the crop grid chosen by a previous adaptive run of the same images and parameters, if any
+    grid_params_path = get_grid_params_path(args.registered_crops_dir, input_path)
+    grid_key = get_grid_key(input_path, fixed_image_path, args.crop_width_x, args.crop_width_y, args.overlap_x,
+                            args.overlap_y, args.adaptive_overlap, args.crop, args.crop_size, args.n_features)
+    grid = load_grid_manifest(grid_params_path, grid_key) if args.adaptive_overlap else None
+    estimate_grid = args.adaptive_overlap and grid is None
+    if grid is not None:
+        logger.info(f'Crop grid loaded from {grid_params_path}.')
+    else:
+        grid = CropGrid.from_image_files(input_path, fixed_image_path, 
+                                         args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y)
 
     # Get checkpoint directories
-    _, current_registered_crops_dir, _ = create_checkpoint_dirs(
+    _, current_registered_crops_dir = create_checkpoint_dirs(
         root_registered_crops_dir=args.registered_crops_dir, 
         moving_image_path=input_path,
-        transformation='affine',
-        makedirs=False
+        transformation='affine'
     )
 
-    n_registered_crops = len(os.listdir(current_registered_crops_dir))
-    n_crops = len(crop_areas[0])
-    
-    if not os.path.exists(output_path) or n_registered_crops != n_crops:
-        # Get checkpoint directories
-        _, current_registered_crops_dir, _ = create_checkpoint_dirs(
-            root_registered_crops_dir=args.registered_crops_dir, 
-            moving_image_path=input_path,
-            transformation='affine'
-        )
-
-        # Perform affine registration
-        affine_registration(input_path, fixed_image_path, current_registered_crops_dir, 
-                            args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y,
-                            args.crop, args.crop_size, args.n_features)
+    # New images wait for their intermediate artifacts to fit in the scratch budget
+    scratch_dirs = args.scratch_dirs or [args.registered_crops_dir]
+    if args.scratch_budget is not None:
+        stages = predict_resources(get_image_shape(input_path), get_image_shape(fixed_image_path), grid.crop_width_x,
+                                   grid.crop_width_y, grid.overlap_x, grid.overlap_y, max_workers=1, level_iters=[])
+        reserve_scratch(scratch_dirs, args.scratch_budget * GB, input_path,
+                        stages['affine']['disk'] + stages['diffeomorphic']['disk'])
+
+    registered = False
+    try:
+        # Perform affine registration, recomputing only the artifacts that are missing or out of date
+        affine_registration(input_path, fixed_image_path, current_registered_crops_dir, grid,
+                            args.crop, args.crop_size, args.n_features, estimate_grid, grid_params_path, grid_key,
+                            get_affine_matrix_path(args.registered_crops_dir, input_path))
+        registered = True
+    finally:
+        if args.scratch_budget is not None:
+            # The affine crops are now counted by the scratch usage, while the share of the diffeomorphic stage
+            # is held until it wrote its artifacts. A failed image releases everything, and reserves again on retry
+            release_reservation(scratch_dirs, input_path, stages['diffeomorphic']['disk'] if registered else 0)
         
 
 if __name__ == '__main__':
@@ -216,6 +256,8 @@ if __name__ == '__main__':
                         help='Overlap of each crop along the x-axis.')
     parser.add_argument('--overlap-y', type=int, 
                         help='Overlap of each crop along the y-axis.')
+    parser.add_argument('--adaptive-overlap', action='store_true',
+                        help='Choose the smallest overlap covering the deformation measured on a coarse pass, instead of the requested overlap.')
     parser.add_argument('--crop', action='store_true', 
                         help='Whether to compute the affine mapping using a smaller subregion of the image.')
     parser.add_argument('--crop-size', type=int, default=4000, 
@@ -224,7 +266,14 @@ if __name__ == '__main__':
                         help='Number of features to detect for computing the affine transformation.')
     parser.add_argument('--logs-dir', type=str, required=True, 
                         help='Directory to store log files.')
-    parser.add_argument('--delete-checkpoints', action='store_false', 
-                        help='Delete intermediate files after processing.')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Directory where the timing spans of each stage, tile and I/O call are written. Profiling is disabled if not set.')
+    parser.add_argument('--scratch-budget', type=float,
+                        help='Disk space in gigabytes the intermediate artifacts of all images may take. The registration of a new image waits until its artifacts fit.')
+    parser.add_argument('--scratch-dirs', type=str, nargs='+',
+                        help='Directories of the intermediate artifacts sharing the scratch budget. Defaults to the registered crops directory.')
     args = parser.parse_args()
-    main(args)
+    run_in_service(__file__)
+    setup_profiling(args.profile_dir, args.input_path)
+    with span('affine_registration'), track_stage('affine_registration', args.input_path):
+        main(args)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from utils import logging_config
+from utils.benchmarking import measure, compare_results
+from utils.crop_grid import CropGrid
+from utils.misc import get_grid_dirname
+from utils.image_cropping import crop_image_channels
+from utils.image_mapping import DEFAULT_LEVEL_ITERS
+from utils.image_stitching import stitch_crops
+from utils.wrappers.compute_mappings import compute_mappings
+from utils.wrappers.apply_mappings import apply_mappings
+from utils.synthetic_slides import generate_fixed_slide, generate_moving_cycle, get_ground_truth_path
+from utils.registration_accuracy import evaluate_registration
+from affine_registration import get_affine_matrix, affine_registration
+from convert_to_ome_tiff import convert_to_ome_tiff
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Parameters of the benchmark matrix, in the order they identify a cell
+MATRIX_PARAMETERS = ['size', 'crop_width', 'overlap', 'max_workers']
+
+# Stages in pipeline order, with the parameters of the matrix they depend on. Stages are only run once
+# for the values of the parameters they do not depend on
+STAGES = {
+    'conversion': ['size', 'max_workers'],
+    'affine_estimation': ['size', 'crop_width', 'overlap'],
+    'affine_warp': ['size', 'crop_width', 'overlap'],
+    'cropping': ['size', 'crop_width', 'overlap'],
+    'mapping_computation': ['size', 'crop_width', 'overlap', 'max_workers'],
+    'mapping_application': ['size', 'crop_width', 'overlap', 'max_workers'],
+    'stitching': ['size', 'crop_width', 'overlap', 'max_workers']
+}
+
+# Stages making up the registration of a moving image, whose runtime is reported next to its accuracy
+REGISTRATION_STAGES = ['affine_estimation', 'affine_warp', 'cropping', 'mapping_computation', 'mapping_application', 'stitching']
+
+"""
+Stages
+"""
+
+def get_stage_paths(work_dir, cell):
+    """
+    Paths of the artifacts of a cell of the matrix. Artifacts depending on the crop grid are shared by the
+    cells of the grid, while those depending on the number of workers get their own directory, so that
+    every stage computes its artifacts instead of finding them up to date.
+    """
+    size_dir = os.path.join(work_dir, f"size_{cell['size']}")
+    grid_dir = os.path.join(size_dir, get_grid_dirname(cell['crop_width'], cell['crop_width'], cell['overlap'], cell['overlap']))
+    workers_dir = os.path.join(grid_dir, f"workers_{cell['max_workers']}")
+
+    return {
+        'converted': os.path.join(size_dir, f"workers_{cell['max_workers']}", 'moving.ome.tiff'),
+        'matrix': os.path.join(grid_dir, 'matrix', 'moving.npy'),
+        'affine_crops': os.path.join(grid_dir, 'affine_crops'),
+        'fixed_crops': os.path.join(grid_dir, 'fixed_crops'),
+        'mappings': os.path.join(workers_dir, 'mappings'),
+        'registered_crops': os.path.join(workers_dir, 'registered_crops'),
+        'stitched': os.path.join(workers_dir, 'registered.h5')
+    }
+
+def run_stage(stage, cell, slides, paths, registration_params):
+    """
+    Runs a stage of the pipeline on the slides of a cell, from the artifacts of the previous stages.
+
+    Parameters:
+        stage (str): Name of the stage.
+        cell (dict): Values of the parameters of the matrix.
+        slides (tuple): Paths to the fixed and moving slides.
+        paths (dict): Paths to the artifacts, as returned by get_stage_paths.
+        registration_params (dict): Keyword arguments of the diffeomorphic registration.
+    """
+    fixed_image_path, input_path = slides
+    max_workers = cell.get('max_workers')
+    grid = CropGrid.from_image_files(input_path, fixed_image_path, cell['crop_width'], cell['crop_width'],
+                                     cell['overlap'], cell['overlap'])
+
+    if stage == 'conversion':
+        # Slides are generated as HDF5, so the conversion to OME-TIFF of the output stands for the ND2 conversion
+        convert_to_ome_tiff(input_path, paths['converted'], (512, 512), n_resolutions=3, scale=2, max_workers=max_workers)
+    elif stage == 'affine_estimation':
+        os.makedirs(os.path.dirname(paths['matrix']), exist_ok=True)
+        get_affine_matrix(input_path, fixed_image_path, grid, matrix_path=paths['matrix'])
+    elif stage == 'affine_warp':
+        # The matrix saved by the affine estimation is loaded, so only the warp of the crops is measured
+        affine_registration(input_path, fixed_image_path, paths['affine_crops'], grid, matrix_path=paths['matrix'])
+    elif stage == 'cropping':
+        crop_image_channels(fixed_image_path, grid, paths['fixed_crops'])
+    elif stage == 'mapping_computation':
+        compute_mappings(grid.crop_indices, paths['fixed_crops'], paths['affine_crops'], paths['mappings'], max_workers,
+                         registration_params=registration_params)
+    elif stage == 'mapping_application':
+        apply_mappings(grid.crop_indices, paths['mappings'], paths['affine_crops'], paths['registered_crops'], max_workers)
+    elif stage == 'stitching':
+        # Overlaps are trimmed while stitching, so overlap removal is measured with it
+        stitch_crops(paths['registered_crops'], paths['stitched'], grid, max_workers)
+    else:
+        raise ValueError(f'Unknown stage {stage}.')
+
+def measure_stage(stage, cell, slides, paths, registration_params):
+    """Measures a stage in a fresh process, whose peak memory is not inflated by the previous stages."""
+    # Spawned processes start from an empty interpreter, unlike forked ones
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        _, metrics = executor.submit(measure, run_stage, stage, cell, slides, paths, registration_params).result()
+
+    return metrics
+
+def evaluate_cell(cell, slides, paths, results):
+    """
+    Evaluates the accuracy of the image registered in a cell against the ground truth of the slides, and
+    reports it next to the runtime of the registration stages of the cell.
+
+    Returns:
+        dict: Result of the accuracy of the cell, whose wall time is the one of its registration.
+    """
+    fixed_image_path, input_path = slides
+    grid = CropGrid.from_image_files(input_path, fixed_image_path, cell['crop_width'], cell['crop_width'],
+                                     cell['overlap'], cell['overlap'])
+    summary, _ = evaluate_registration(fixed_image_path, paths['stitched'], input_path, grid, get_ground_truth_path(input_path))
+
+    registration_seconds = sum(
+        result['wall_seconds'] for result in results
+        if result['stage'] in REGISTRATION_STAGES and all(result[parameter] == cell[parameter] for parameter in STAGES[result['stage']])
+    )
+    parameters = {parameter: cell[parameter] for parameter in ['size', 'crop_width', 'overlap', 'max_workers']}
+
+    return {
+        'stage': 'accuracy',
+        **parameters,
+        'wall_seconds': registration_seconds,
+        'megapixels_per_second': cell['size'] * cell['size'] / 1e6 / registration_seconds,
+        **summary
+    }
+
+"""
+Slides
+"""
+
+def get_slides(slides_dir, size, seed, max_workers=None):
+    """
+    Generates a synthetic fixed slide and a moving cycle of a given size, or reuses them if they exist.
+
+    Returns:
+        tuple: Paths to the fixed and moving slides.
+    """
+    fixed_image_path = os.path.join(slides_dir, f'size_{size}', 'cycle_0', 'fixed.h5')
+    input_path = os.path.join(slides_dir, f'size_{size}', 'cycle_1', 'moving.h5')
+
+    if not os.path.exists(fixed_image_path):
+        generate_fixed_slide(fixed_image_path, (size, size), seed, max_workers)
+    if not os.path.exists(input_path):
+        generate_moving_cycle(input_path, fixed_image_path, seed + 1, max_workers)
+
+    return fixed_image_path, input_path
+
+def get_host_info():
+    """Describes the host and the code version, which results can only be compared across with care."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'hostname': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit
+    }
+
+"""
+Commands
+"""
+
+def run(args):
+    registration_params = {'level_iters': args.level_iters}
+    stages = args.stages or list(STAGES)
+    matrix = [dict(zip(MATRIX_PARAMETERS, values)) for values in itertools.product(args.sizes, args.crop_widths, args.overlaps, args.max_workers)]
+
+    results = []
+    for size in args.sizes:
+        slides = get_slides(args.slides_dir or os.path.join(args.work_dir, 'slides'), size, args.seed, max(args.max_workers))
+        work_dir = os.path.join(args.work_dir, 'artifacts')
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+        measured = set()
+        for cell in [cell for cell in matrix if cell['size'] == size]:
+            paths = get_stage_paths(work_dir, cell)
+            for stage in stages:
+                # Parameters a stage does not depend on are left out of its results
+                parameters = {parameter: cell[parameter] for parameter in STAGES[stage]}
+                key = (stage,) + tuple(parameters.items())
+                if key in measured:
+                    continue
+                measured.add(key)
+
+                logger.info(f'Running {stage} with {parameters}.')
+                metrics = measure_stage(stage, cell, slides, paths, registration_params)
+                metrics['megapixels_per_second'] = size * size / 1e6 / metrics['wall_seconds']
+                results.append({'stage': stage, **parameters, **metrics})
+                logger.info(f"{stage}: {metrics['wall_seconds']:.2f} s, {metrics['megapixels_per_second']:.1f} MP/s, "
+                            f"{metrics['peak_rss'] / 1e6:.0f} MB peak RSS.")
+
+            # The registered image of a crop grid does not depend on the number of workers, so it is evaluated once
+            grid_key = ('accuracy', cell['crop_width'], cell['overlap'])
+            if args.evaluate and 'stitching' in stages and grid_key not in measured:
+                measured.add(grid_key)
+                results.append(evaluate_cell(cell, slides, paths, results))
+
+        if not args.keep_artifacts:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'host': get_host_info(),
+        'config': {'registration_params': registration_params, 'seed': args.seed, 'stages': stages},
+        'results': results
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.results_path)), exist_ok=True)
+    with open(args.results_path, 'w') as f:
+        json.dump(output, f, indent=2)
+    logger.info(f'{len(results)} benchmark results written to {args.results_path}.')
+
+def compare(args):
+    with open(args.baseline_path) as f:
+        baseline = json.load(f)
+    with open(args.results_path) as f:
+        current = json.load(f)
+
+    if baseline['host']['hostname'] != current['host']['hostname']:
+        logger.warning(f"Results were measured on different hosts ({baseline['host']['hostname']} and "
+                       f"{current['host']['hostname']}), differences may not be regressions.")
+
+    comparisons = compare_results(baseline['results'], current['results'], MATRIX_PARAMETERS, args.threshold, args.min_seconds)
+    regressions = [comparison for comparison in comparisons if comparison['regression']]
+    for comparison in comparisons:
+        cell = ', '.join(f'{parameter}={value}' for parameter, value in zip(MATRIX_PARAMETERS, comparison['cell'][1:]) if value is not None)
+        message = (f"{comparison['cell'][0]} ({cell}) {comparison['metric']}: {comparison['baseline']:.4g} -> "
+                   f"{comparison['current']:.4g} ({comparison['change']:+.1%})")
+        if comparison['regression']:
+            logger.warning(f'Regression: {message}')
+        else:
+            logger.debug(message)
+
+    logger.info(f'{len(regressions)} regressions out of {len(comparisons)} compared metrics.')
+    if regressions:
+        sys.exit(1)
+
+def main(args):
+    if args.command == 'run':
+        run(args)
+    else:
+        compare(args)
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    def int_list(value):
+        return [int(n) for n in value.split(',')]
+
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the pipeline on synthetic slides across a matrix of slide sizes, crop grids and workers.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmark matrix and write its results.')
+    run_parser.add_argument('--results-path', type=str, required=True,
+                            help='Path to the JSON results file.')
+    run_parser.add_argument('--work-dir', type=str, required=True,
+                            help='Directory of the slides and of the artifacts written by the stages.')
+    run_parser.add_argument('--slides-dir', type=str,
+                            help='Directory of the synthetic slides, reused across runs. Defaults to a subdirectory of the work directory.')
+    run_parser.add_argument('--sizes', type=int_list, default=[4000],
+                            help='Comma separated heights and widths of the square slides, in pixels.')
+    run_parser.add_argument('--crop-widths', type=int_list, default=[1000],
+                            help='Comma separated widths of the crops.')
+    run_parser.add_argument('--overlaps', type=int_list, default=[200],
+                            help='Comma separated overlaps between crops.')
+    run_parser.add_argument('--max-workers', type=int_list, default=[1],
+                            help='Comma separated numbers of workers.')
+    run_parser.add_argument('--stages', type=lambda s: s.split(','),
+                            help=f'Comma separated stages to run, among {", ".join(STAGES)}. Defaults to every stage. '
+                                 'A stage needs the artifacts of the previous ones.')
+    run_parser.add_argument('--level-iters', type=int_list, default=DEFAULT_LEVEL_ITERS,
+                            help='Comma separated number of iterations per level of the diffeomorphic registration.')
+    run_parser.add_argument('--seed', type=int, default=0,
+                            help='Seed of the synthetic slides.')
+    run_parser.add_argument('--evaluate', action='store_true',
+                            help='Evaluate the accuracy of the registered images against the ground truth of the slides, next to the runtime of their registration.')
+    run_parser.add_argument('--keep-artifacts', action='store_true',
+                            help='Keep the artifacts written by the stages.')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two results files and flag regressions.')
+    compare_parser.add_argument('--baseline-path', type=str, required=True,
+                                help='Path to the JSON results of the baseline run.')
+    compare_parser.add_argument('--results-path', type=str, required=True,
+                                help='Path to the JSON results of the current run.')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Relative change of a metric above which it is flagged as a regression.')
+    compare_parser.add_argument('--min-seconds', type=float, default=0.5,
+                                help='Wall time below which the time of a stage is too noisy to be compared.')
+
+    args = parser.parse_args()
+    main(args)
@@ -2,10 +2,14 @@
 
 import argparse
 import os
-from utils.io_tools import load_nd2, save_h5
-from utils.image_cropping import crop_2d_array
+from utils.profiling import setup_profiling, span
+from utils.service import run_in_service
+from utils.sample_store import track_stage
 
 def convert_to_h5(src, dst, input_ext='.nd2'):
+    # Imported when needed, so that converted images are skipped without loading nd2
+    from utils.io_tools import load_nd2, save_h5
+
     if input_ext == '.nd2' or input_ext == 'nd2':
         data = load_nd2(src)
         save_h5(data, dst)
@@ -26,7 +30,12 @@ if __name__ == '__main__':
                         help='Path to the input (moving) image.')
     parser.add_argument('--logs-dir', type=str, required=True, 
                         help='Directory to store log files.')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Directory where the timing spans of each stage, tile and I/O call are written. Profiling is disabled if not set.')
     parser.add_argument('--delete-src', action='store_true', 
                         help='Delete intermediate files after processing.')
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    run_in_service(__file__)
+    setup_profiling(args.profile_dir, args.input_path)
+    with span('convert_to_h5'), track_stage('convert_to_h5', args.input_path):
+        main(args)
\ No newline at end of file
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+from utils import logging_config
+from utils.profiling import setup_profiling, span
+from utils.service import run_in_service
+from utils.sample_store import track_stage
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def convert_to_ome_tiff(input_path, output_path, tile_shape, n_resolutions, scale, max_workers=None):
+    """
+    Converts an HDF5 image to a tiled, pyramidal BigTIFF OME file.
+
+    Args:
+        input_path (str): Path to the HDF5 image.
+        output_path (str): Path to the OME-TIFF file.
+        tile_shape (tuple): Shape (height, width) of the tiles.
+        n_resolutions (int): Number of resolutions of the pyramid, including the full resolution.
+        scale (int): Downsampling factor between pyramid levels.
+        max_workers (int, optional): Maximum number of threads compressing tiles.
+    """
+    # Imported when needed, so that converted images are skipped without loading the TIFF libraries
+    import h5py
+    from utils.ome_tiff import write_ome_tiff
+
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    with h5py.File(input_path, 'r') as f:
+        write_ome_tiff(f['dataset'], output_path, tile_shape, n_resolutions, scale, max_workers=max_workers)
+
+    logger.info(f'Image {input_path} converted to {output_path}.')
+
+def main(args):
+    handler = logging.FileHandler(os.path.join(args.logs_dir, 'image_conversion.log'))
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    input_path = args.input_path.replace('.nd2', '.h5')
+
+    if not os.path.exists(args.output_path):
+        convert_to_ome_tiff(input_path, args.output_path, (args.tiley, args.tilex), args.pyramid_resolutions,
+                            args.pyramid_scale, args.max_workers)
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Convert an HDF5 image to a tiled, pyramidal OME-TIFF file.")
+    parser.add_argument('--input-path', type=str, required=True,
+                        help='Path to the input image.')
+    parser.add_argument('--output-path', type=str, required=True,
+                        help='Path to the output OME-TIFF file.')
+    parser.add_argument('--tilex', type=int, default=512,
+                        help='Width of the tiles. Must be a multiple of 16.')
+    parser.add_argument('--tiley', type=int, default=512,
+                        help='Height of the tiles. Must be a multiple of 16.')
+    parser.add_argument('--pyramid-resolutions', type=int, default=3,
+                        help='Number of resolutions of the pyramid, including the full resolution.')
+    parser.add_argument('--pyramid-scale', type=int, default=2,
+                        help='Downsampling factor between pyramid levels.')
+    parser.add_argument('--max-workers', type=int,
+                        help='Maximum number of threads compressing tiles.')
+    parser.add_argument('--logs-dir', type=str, required=True,
+                        help='Directory to store log files.')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Directory where the timing spans of each stage, tile and I/O call are written. Profiling is disabled if not set.')
+
+    args = parser.parse_args()
+    run_in_service(__file__)
+    setup_profiling(args.profile_dir, args.input_path)
+    with span('convert_to_ome_tiff'), track_stage('convert_to_ome_tiff', args.input_path):
+        main(args)
@@ -4,47 +4,194 @@ import argparse
 import os 
 import logging
 from utils import logging_config
-from utils.image_cropping import crop_image_channels
-from utils.misc import create_checkpoint_dirs, get_crops_dir
-from utils.image_cropping import get_image_file_shape
-from utils.image_cropping import get_crop_areas
-from utils.image_cropping import get_padding_shape
-from utils.wrappers.compute_mappings import compute_mappings
-from utils.wrappers.apply_mappings import apply_mappings
+from utils.profiling import setup_profiling, span
+from utils.service import run_in_service
+from utils.sample_store import track_stage, set_artifact_key
+from utils.misc import create_checkpoint_dirs, get_crops_dir, get_scale_space_dir
+from utils.misc import get_grid_params_path, get_grid_dirname, get_quality_map_path, get_telemetry_path, get_batch_path, get_status_path
+from utils.artifact_index import ArtifactIndex, get_artifact_key, get_file_identity
 
 # Set up logging configuration
 logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
-def diffeomorphic_registration(current_crops_dir_fixed, current_crops_dir_moving, 
-                               current_mappings_dir, current_registered_crops_dir, max_workers):
+def diffeomorphic_registration(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, 
+                               current_mappings_dir, current_registered_crops_dir, max_workers, current_scale_space_dir=None,
+                               skip_threshold=None, similarity_metric='ncc', registration_params=None, status_path=None):
     """
     Performs diffeomorphic registration between fixed and moving image crops.
 
     Args:
+        crop_indices (list): Indices (row, column) of the crops.
         current_crops_dir_fixed (str): Directory containing fixed image crops.
         current_crops_dir_moving (str): Directory containing moving image crops.
         current_mappings_dir (str): Directory to save computed mappings.
         current_registered_crops_dir (str): Directory to save registered crops.
         max_workers (int): Maximum number of workers for parallel processing.
+        current_scale_space_dir (str, optional): Directory where the scale spaces of the fixed crops are cached.
+        skip_threshold (float, optional): Crops whose similarity score reaches this threshold after affine 
+                                          registration are not registered again.
+        similarity_metric (str, optional): Similarity metric used for the pre-check, either 'ncc' or 'mi'.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+        status_path (str, optional): Path to the status file where the progress of the workers is written.
+
+    Returns:
+        tuple: Similarity score and telemetry record of each crop processed in this run, indexed by (row, column).
     """
-    # List of files in each directory
-    fixed_files = sorted([os.path.join(current_crops_dir_fixed, file) for file in os.listdir(current_crops_dir_fixed)])
-    moving_files = sorted([os.path.join(current_crops_dir_moving, file) for file in os.listdir(current_crops_dir_moving)])
+    # Imported when needed, so that the script starts quickly and jobs submitted to the service stay light
+    from utils.wrappers.compute_mappings import compute_mappings
+    from utils.wrappers.apply_mappings import apply_mappings
 
-    # Filter the files that end with '2.pkl'
-    fixed_files_dapi = [f for f in fixed_files if f.endswith('_2.pkl')]    
-    moving_files_dapi = [f for f in moving_files if f.endswith('_2.pkl')]  
-    
-    # Compute mappings for all crop pairs
-    compute_mappings(fixed_files_dapi, moving_files_dapi, current_crops_dir_fixed, current_crops_dir_moving, current_mappings_dir, max_workers)
+    # Mappings deleted once applied are not computed again while their registered crops are up to date
+    crop_indices = get_pending_crops(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, current_mappings_dir,
+                                     current_registered_crops_dir, skip_threshold, similarity_metric, registration_params)
+
+    # Compute mappings for all crop pairs on the DAPI channel
+    scores, records = compute_mappings(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, 
+                                       current_mappings_dir, max_workers, current_scale_space_dir, skip_threshold, 
+                                       similarity_metric, registration_params, status_path)
+
+    # Apply the mappings to every channel
+    apply_mappings(crop_indices, current_mappings_dir, current_crops_dir_moving, current_registered_crops_dir, max_workers,
+                   status_path=status_path)
+
+    return scores, records
+
+def get_pending_crops(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, current_mappings_dir,
+                      current_registered_crops_dir, skip_threshold=None, similarity_metric='ncc', registration_params=None,
+                      n_channels=3):
+    """
+    Finds the crops still to be registered, leaving out those whose mapping was deleted after being applied 
+    while it was up to date, and whose registered crops are up to date or were deleted once exported.
+
+    Returns:
+        list: Indices (row, column) of the crops to register.
+    """
+    from utils.crop_grid import get_crop_path
+    from utils.wrappers.compute_mappings import get_mapping_keys
+    from utils.wrappers.apply_mappings import get_registered_crop_keys
+
+    mapping_keys, _ = get_mapping_keys(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, skip_threshold,
+                                       similarity_metric, registration_params)
+    registered_keys = get_registered_crop_keys(crop_indices, current_mappings_dir, current_crops_dir_moving, n_channels)
+    mapping_index = ArtifactIndex(current_mappings_dir)
+    registered_index = ArtifactIndex(current_registered_crops_dir)
+
+    def is_consumed(idx):
+        registered_paths = [get_crop_path(current_registered_crops_dir, 'registered_split', idx, ch) for ch in range(n_channels)]
+        return (
+            mapping_index.is_consumed(get_crop_path(current_mappings_dir, 'mapping', idx), mapping_keys[idx])
+            and all(registered_index.is_valid(path, registered_keys[idx + (ch,)]) or 
+                    registered_index.is_consumed(path, registered_keys[idx + (ch,)]) for ch, path in enumerate(registered_paths))
+        )
+
+    return [idx for idx in crop_indices if not is_consumed(idx)]
+
+def delete_consumed_crops(crop_indices, current_crops_dir_moving, current_mappings_dir=None, n_channels=3):
+    """
+    Deletes the affine registered moving crops and the mappings of registered crops, which no following
+    stage reads. The affine registered image was already exported from the moving crops.
+
+    Args:
+        crop_indices (list): Indices (row, column) of the registered crops.
+        current_crops_dir_moving (str): Directory containing moving image crops.
+        current_mappings_dir (str, optional): Directory of the mappings. Not deleted if None.
+        n_channels (int, optional): Number of channels of the moving crops.
+
+    Returns:
+        int: Number of bytes freed.
+    """
+    from utils.crop_grid import get_crop_path
+    from utils.scratch import release_artifacts
+
+    paths = [get_crop_path(current_crops_dir_moving, 'affine_split', idx, ch) for idx in crop_indices for ch in range(n_channels)]
+    if current_mappings_dir is not None:
+        paths += [get_crop_path(current_mappings_dir, 'mapping', idx) for idx in crop_indices]
+
+    return release_artifacts(paths)
+
+def diffeomorphic_registration_in_memory(current_crops_dir_moving, fixed_image_path, output_path, grid, max_workers, current_registered_crops_dir=None, 
+                                         current_scale_space_dir=None, skip_threshold=None, similarity_metric='ncc',
+                                         registration_params=None, blend=False, status_path=None):
+    """
+    Performs diffeomorphic registration and stitching without intermediate mappings and registered crops. 
+    Crops are held in shared memory blocks and workers only receive their descriptors. The moving crops are
+    the affine registered crops, as in the staged registration, so that both give the same registered image.
+
+    Args:
+        current_crops_dir_moving (str): Directory containing the affine registered moving crops.
+        fixed_image_path (str): Path to the fixed image.
+        output_path (str): Path where the registered image will be saved.
+        grid (CropGrid): Crop grid of the moving image.
+        max_workers (int): Maximum number of workers for parallel processing.
+        current_registered_crops_dir (str, optional): Directory where registered crops are checkpointed 
+                                                      asynchronously. No checkpoints are saved if None.
+        current_scale_space_dir (str, optional): Directory where the scale spaces of the fixed crops are cached.
+        skip_threshold (float, optional): Crops whose similarity score reaches this threshold after affine 
+                                          registration are not registered again.
+        similarity_metric (str, optional): Similarity metric used for the pre-check, either 'ncc' or 'mi'.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+        blend (bool, optional): Feather blend the crops across their overlap instead of cutting them at its middle.
+        status_path (str, optional): Path to the status file where the progress of the workers is written.
+
+    Returns:
+        tuple: Similarity score and telemetry record of each crop, indexed by (row, column).
+    """
+    from utils.crop_grid import get_crop_path
+    from utils.image_cropping import crop_image_channels_shared
+    from utils.image_stitching import stitch_shared_crops, blend_shared_crops
+    from utils.shared_memory import release_shared_arrays
+    from utils.scratch import check_artifacts
+    from utils.wrappers.shared_mappings import register_crops_shared, get_scale_space_keys, load_crops_shared
 
     n_channels = 3
-    mapping_files = sorted([os.path.join(current_mappings_dir, file) for file in os.listdir(current_mappings_dir)] * n_channels)
-    apply_mappings(mapping_files, moving_files, current_registered_crops_dir, max_workers)
+    check_artifacts([get_crop_path(current_crops_dir_moving, 'affine_split', idx, ch) for idx in grid.crop_indices for ch in range(n_channels)],
+                    'affine registration')
+
+    fixed_crops, moving_crops = {}, {}
+    try:
+        # Only the DAPI channel of the fixed image is used to compute the mappings
+        fixed_crops = crop_image_channels_shared(fixed_image_path, grid, channels=[2])
+        moving_crops = load_crops_shared(current_crops_dir_moving, grid.crop_indices, 'affine_split', range(n_channels))
+
+        scores, records = register_crops_shared(fixed_crops, moving_crops, grid.crop_indices, n_channels, 
+                                                current_registered_crops_dir, max_workers, current_scale_space_dir,
+                                                skip_threshold, similarity_metric, registration_params,
+                                                scale_space_keys=get_scale_space_keys(fixed_image_path, grid, registration_params),
+                                                status_path=status_path)
+
+        if blend:
+            blend_shared_crops(moving_crops, grid, output_path, n_channels)
+        else:
+            stitch_shared_crops(moving_crops, grid, output_path, n_channels)
+        logger.info(f'Crops of {current_crops_dir_moving} processed successfully.')
+    finally:
+        release_shared_arrays([crop[0] for crop in fixed_crops.values()])
+        release_shared_arrays([crop[0] for crop in moving_crops.values()])
+
+    scores = {idx: score for idx, score in scores.items() if score is not None}
+    records = {idx: record for idx, record in records.items() if record is not None}
+
+    return scores, records
 
 
 def main(args):
+    from utils.scratch import release_reservation
+
+    try:
+        register(args)
+    finally:
+        # Batches are released together by gather_registration.py
+        if args.scratch_budget is not None and args.n_batches == 1:
+            release_reservation(args.scratch_dirs or [args.registered_crops_dir], args.input_path.replace('.nd2', '.h5'))
+
+def register(args):
+    from utils.crop_grid import load_crop_grid, get_crop_path
+    from utils.image_cropping import crop_image_channels
+    from utils.image_mapping import DEFAULT_LEVEL_ITERS
+    from utils.registration_telemetry import save_telemetry, save_quality_map
+    from utils.scratch import acquire_lease, release_lease
+
     # Set up logging to a file
     handler = logging.FileHandler(os.path.join(args.logs_dir, 'image_registration.log'))
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -60,44 +207,127 @@ def main(args):
     input_path = os.path.join(args.output_dir, 'affine', dirname, filename) # Path to input file
     output_path = os.path.join(args.output_dir, 'diffeomorphic', dirname, filename) # Path to output file
 
-    # Get image shape and determine crop areas
-    mov_shape = get_image_file_shape(input_path)
-    fixed_shape = get_image_file_shape(fixed_image_path)
-    padding_shape = get_padding_shape(mov_shape, fixed_shape)
-    crop_areas = get_crop_areas(
-        shape=padding_shape, 
-        crop_width_x=args.crop_width_x, crop_width_y=args.crop_width_y, 
-        overlap_x=args.overlap_x, overlap_y=args.overlap_y
-    )
+    # Use the crop grid saved during affine registration
+    grid = load_crop_grid(get_grid_params_path(args.registered_crops_dir, input_path), input_path, fixed_image_path,
+                          args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y)
 
     # Get checkpoint directories
-    current_mappings_dir, current_registered_crops_dir, _ = create_checkpoint_dirs(
+    current_mappings_dir, current_registered_crops_dir = create_checkpoint_dirs(
             root_mappings_dir=args.mappings_dir, 
             root_registered_crops_dir=args.registered_crops_dir, 
             moving_image_path=input_path,
             transformation='diffeomorphic'
     )
 
-    n_registered_crops = len(os.listdir(current_registered_crops_dir))
-    n_mappings = len(os.listdir(current_mappings_dir))
+    # Scale spaces of the fixed crops are shared by all moving images registered to the same fixed image
+    current_scale_space_dir = None
+    if args.scale_space_dir:
+        current_scale_space_dir = get_scale_space_dir(fixed_image_path, args.scale_space_dir, 
+                                                      grid.crop_width_x, grid.crop_width_y, grid.overlap_x, grid.overlap_y)
+
+    registration_params = {
+        'level_iters': args.level_iters or DEFAULT_LEVEL_ITERS, 
+        'opt_tol': args.opt_tol, 
+        'inv_tol': args.inv_tol, 
+        'metric': args.metric, 
+        'radius': args.metric_radius
+    }
+
+    quality_map_path = get_quality_map_path(args.mappings_dir, input_path)
+    telemetry_path = get_telemetry_path(args.mappings_dir, input_path)
+    status_path = get_status_path(args.logs_dir, input_path)
+
+    # A batch registers a subset of the crops, and its files are merged by gather_registration.py
+    crop_indices = grid.crop_indices
+    if args.n_batches > 1:
+        if args.in_memory:
+            raise ValueError("Crop batches are registered from the crop files, and cannot run in memory.")
+        crop_indices = grid.batch_indices(args.batch_index, args.n_batches)
+        quality_map_path = get_batch_path(quality_map_path, args.batch_index)
+        telemetry_path = get_batch_path(telemetry_path, args.batch_index)
+        status_path = get_batch_path(status_path, args.batch_index)
 
-    if not os.path.exists(output_path) or n_registered_crops != n_mappings:
-        # Check if output image directory exists, create it if not
-        output_dir_path = os.path.dirname(output_path)
-        if not os.path.exists(output_dir_path):
-            os.makedirs(output_dir_path)
-            logger.debug(f'Output directory created successfully: {output_dir_path}')
+    current_crops_dir_moving = get_crops_dir(input_path, args.crops_dir_moving)
 
-        # Create intermediate directories for crops and mappings
-        current_crops_dir_fixed = get_crops_dir(fixed_image_path, args.crops_dir_fixed)
-        current_crops_dir_moving = get_crops_dir(input_path, args.crops_dir_moving)
+    if args.in_memory:
+        # The registered image is written directly, so it is the only artifact to check for. It depends on the
+        # affine registered crops, whose keys are kept in their index once they are deleted
+        moving_index = ArtifactIndex(current_crops_dir_moving)
+        moving_keys = [moving_index.get_key(get_crop_path(current_crops_dir_moving, 'affine_split', idx, ch))
+                       for idx in grid.crop_indices for ch in range(3)]
+        output_index = ArtifactIndex(os.path.dirname(output_path))
+        output_key = get_artifact_key('diffeomorphic_image', moving_keys, get_file_identity(fixed_image_path),
+                                      grid.to_dict(), args.skip_threshold, args.similarity_metric, registration_params, args.blend)
+        set_artifact_key(output_key)
+        if not output_index.is_valid(output_path, output_key):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            output_index.invalidate([output_path])
+            # Registered crops of a previous staged run no longer match the image, and checkpoints are not indexed
+            ArtifactIndex(current_registered_crops_dir).invalidate(
+                [get_crop_path(current_registered_crops_dir, 'registered_split', idx, ch) for idx in grid.crop_indices for ch in range(3)])
+            scores, records = diffeomorphic_registration_in_memory(
+                current_crops_dir_moving, fixed_image_path, output_path, grid, args.max_workers,
+                current_registered_crops_dir if args.save_checkpoints else None,
+                current_scale_space_dir, args.skip_threshold, args.similarity_metric, registration_params,
+                args.blend, status_path
+            )
+            output_index.record(output_path, output_key)
+            output_index.flush()
+            if args.skip_threshold is not None:
+                save_quality_map(scores, args.skip_threshold, quality_map_path)
+            save_telemetry(records, registration_params, telemetry_path)
 
-        # Crop images and save them to the crops directories
-        crop_image_channels(input_path, fixed_image_path, current_crops_dir_fixed, 
-                    args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y, which_crop='fixed')
+        if args.delete_checkpoints:
+            # The affine registered crops are consumed once the registered image is recorded, as in the staged registration
+            freed = delete_consumed_crops(grid.crop_indices, current_crops_dir_moving)
+            logger.info(f'{freed / 1e6:.0f} MB of consumed checkpoints deleted.')
+        return
+
+    # Check if output image directory exists, create it if not
+    output_dir_path = os.path.dirname(output_path)
+    if not os.path.exists(output_dir_path):
+        os.makedirs(output_dir_path)
+        logger.debug(f'Output directory created successfully: {output_dir_path}')
+
+    # Create intermediate directories for crops and mappings
+    current_crops_dir_fixed = get_crops_dir(fixed_image_path, args.crops_dir_fixed)
+    if args.adaptive_overlap:
+        # Moving images of the same fixed image may use different grids
+        current_crops_dir_fixed = os.path.join(current_crops_dir_fixed, get_grid_dirname(
+            grid.crop_width_x, grid.crop_width_y, grid.overlap_x, grid.overlap_y))
+
+    # The crops and scale spaces of the fixed image are shared by its moving images and their batches, 
+    # and are only deleted with the last of them
+    holder = f'{input_path}:{args.batch_index}'
+    if args.delete_checkpoints:
+        acquire_lease(current_crops_dir_fixed, holder)
+
+    registered = False
+    try:
+        # Crop the fixed image and save the crops to the crops directory. Every stage only recomputes the 
+        # artifacts whose inputs or parameters changed since they were saved
+        crop_image_channels(fixed_image_path, grid, current_crops_dir_fixed, crop_indices)
 
         # Perform diffeomorphic registration
-        diffeomorphic_registration(current_crops_dir_fixed, current_crops_dir_moving, current_mappings_dir, current_registered_crops_dir, args.max_workers)
+        scores, records = diffeomorphic_registration(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, current_mappings_dir, 
+                                                     current_registered_crops_dir, args.max_workers, current_scale_space_dir, 
+                                                     args.skip_threshold, args.similarity_metric, registration_params,
+                                                     status_path)
+        if args.skip_threshold is not None:
+            save_quality_map(scores, args.skip_threshold, quality_map_path)
+        save_telemetry(records, registration_params, telemetry_path)
+        registered = True
+    finally:
+        if args.delete_checkpoints:
+            # Shared artifacts are kept for a retry if the registration failed
+            shared_paths = ArtifactIndex(current_crops_dir_fixed).paths()
+            if current_scale_space_dir is not None:
+                shared_paths += ArtifactIndex(current_scale_space_dir).paths()
+            freed = release_lease(current_crops_dir_fixed, holder, shared_paths if registered else None)
+
+    if args.delete_checkpoints:
+        freed += delete_consumed_crops(crop_indices, current_crops_dir_moving, current_mappings_dir)
+        logger.info(f'{freed / 1e6:.0f} MB of consumed checkpoints deleted.')
 
 
 if __name__ == "__main__":
@@ -117,6 +347,9 @@ if __name__ == "__main__":
                         help='Root directory to save computed mappings.')
     parser.add_argument('--registered-crops-dir', type=str, required=True, 
                         help='Root directory to save registered crops.')
+    parser.add_argument('--scale-space-dir', type=str,
+                        help='Root directory where the scale spaces of the fixed image crops are cached and reused across moving images. '
+                             'A cached scale space takes about 12 bytes per pixel for a small speed-up per crop, so the cache is disabled if not set.')
     parser.add_argument('--crop-width-x', required=True, type=int, 
                         help='Width of each crop.')
     parser.add_argument('--crop-width-y', required=True, type=int, 
@@ -125,13 +358,50 @@ if __name__ == "__main__":
                         help='Overlap of each crop along the x-axis.')
     parser.add_argument('--overlap-y', type=int, 
                         help='Overlap of each crop along the y-axis.')
+    parser.add_argument('--adaptive-overlap', action='store_true',
+                        help='Use the overlap chosen during affine registration instead of the requested overlap.')
     parser.add_argument('--max-workers', type=int,
                         help='Maximum number of CPUs used for parallel processing.')
-    parser.add_argument('--delete-checkpoints', action='store_false', 
-                        help='Delete intermediate files after processing.')
+    parser.add_argument('--delete-checkpoints', action='store_true', 
+                        help='Delete the moving crops and mappings once the crops are registered, and the fixed crops and scale spaces once no other moving image uses them.')
+    parser.add_argument('--skip-threshold', type=float,
+                        help='Similarity score after affine registration above which the diffeomorphic registration of a crop is skipped.')
+    parser.add_argument('--similarity-metric', type=str, default='ncc', choices=['ncc', 'mi'],
+                        help='Similarity metric used to score crops after affine registration: normalized cross-correlation or normalized mutual information.')
+    parser.add_argument('--level-iters', type=lambda s: [int(n) for n in s.split(',')],
+                        help='Comma separated maximum number of diffeomorphic registration iterations at each level, from coarse to fine. Defaults to DEFAULT_LEVEL_ITERS of utils/image_mapping.py.')
+    parser.add_argument('--opt-tol', type=float, default=1e-03,
+                        help='Tolerance on the energy derivative below which the iterations of a level stop.')
+    parser.add_argument('--inv-tol', type=float, default=0.1,
+                        help='Tolerance of the inversion of the displacement fields.')
+    parser.add_argument('--metric', type=str, default='cc', choices=['cc', 'ssd', 'em'],
+                        help='Similarity metric of the diffeomorphic registration: cross-correlation, sum of squared differences or expectation-maximization.')
+    parser.add_argument('--metric-radius', type=int, default=4,
+                        help='Radius of the cross-correlation metric neighborhood.')
+    parser.add_argument('--n-batches', type=int, default=1,
+                        help='Number of batches the crops are split into, each registered by a separate task.')
+    parser.add_argument('--batch-index', type=int, default=0,
+                        help='Index of the batch of crops to register, from 0 to n-batches - 1.')
+    parser.add_argument('--scratch-budget', type=float,
+                        help='Disk space in gigabytes the intermediate artifacts of all images may take. The share of the image reserved by affine_registration.py is released once the diffeomorphic artifacts of the image are written.')
+    parser.add_argument('--scratch-dirs', type=str, nargs='+',
+                        help='Directories of the intermediate artifacts sharing the scratch budget. Defaults to the registered crops directory.')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='Keep crops in shared memory and write the stitched registered image directly as HDF5, without intermediate files.')
+    parser.add_argument('--save-checkpoints', action='store_true',
+                        help='In memory mode, asynchronously save the registered crops to the registered crops directory.')
+    parser.add_argument('--blend', action='store_true',
+                        help='In memory mode, feather blend neighbouring crops across their overlap when stitching.')
     parser.add_argument('--logs-dir', type=str, required=True, 
                         help='Path to the directory where log files will be stored.')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Directory where the timing spans of each stage, tile and I/O call are written. Profiling is disabled if not set.')
     
     args = parser.parse_args()
+    run_in_service(__file__)
     
-    main(args)
+    setup_profiling(args.profile_dir, args.input_path)
+    # Batches of the crops of an image are tracked as stages of their own
+    stage = 'diffeomorphic_registration' if args.n_batches == 1 else f'diffeomorphic_registration_batch_{args.batch_index}'
+    with span('diffeomorphic_registration', batch_index=args.batch_index), track_stage(stage, args.input_path):
+        main(args)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+import pandas as pd
+from utils import logging_config
+from utils.crop_grid import load_crop_grid
+from utils.misc import get_grid_params_path
+from utils.registration_accuracy import evaluate_registration
+from utils.synthetic_slides import get_ground_truth_path
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def get_registered_path(input_path, output_dir, transformation):
+    """Path of the image exported by a registration stage, laid out as by export_image.py."""
+    return os.path.join(output_dir, transformation, os.path.basename(os.path.dirname(input_path)), os.path.basename(input_path))
+
+def main(args):
+    input_path = args.input_path.replace('.nd2', '.h5')
+    fixed_image_path = args.fixed_image_path.replace('.nd2', '.h5')
+
+    # The diffeomorphic registration starts from the affine registered image
+    registered_path = get_registered_path(input_path, args.output_dir, args.transformation)
+    before_path = get_registered_path(input_path, args.output_dir, 'affine') if args.transformation == 'diffeomorphic' else input_path
+
+    grid = load_crop_grid(get_grid_params_path(args.registered_crops_dir, input_path), input_path, fixed_image_path,
+                          args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y)
+
+    # Synthetic slides come with their ground truth
+    ground_truth_path = args.ground_truth_path
+    if ground_truth_path is None and args.landmarks_path is None and os.path.exists(get_ground_truth_path(input_path)):
+        ground_truth_path = get_ground_truth_path(input_path)
+
+    summary, points = evaluate_registration(fixed_image_path, registered_path, before_path, grid, ground_truth_path,
+                                            args.landmarks_path, args.spacing, args.patch_size)
+
+    # Accuracy is reported next to the runtime, so that each mode documents its trade-off
+    summary = {'label': args.label or args.transformation, 'input_path': input_path, 'transformation': args.transformation,
+               'wall_seconds': args.wall_seconds, **summary}
+    report = pd.DataFrame([summary])
+    if os.path.exists(args.report_path):
+        report = pd.concat([pd.read_csv(args.report_path), report], ignore_index=True)
+    report.to_csv(args.report_path, index=False)
+    logger.info(f'Registration accuracy of {registered_path} added to {args.report_path}.')
+
+    if args.points_path:
+        points.to_csv(args.points_path, index=False)
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Evaluate the accuracy of a registered image: target registration error, per crop NCC before and after registration and seam discontinuity.")
+    parser.add_argument('--input-path', type=str, required=True,
+                        help='Path to the moving image.')
+    parser.add_argument('--fixed-image-path', type=str, required=True,
+                        help='Path to the fixed image.')
+    parser.add_argument('--output-dir', type=str, required=True,
+                        help='Output directory of the registered images.')
+    parser.add_argument('--registered-crops-dir', type=str, required=True,
+                        help='Directory of the registered crops, holding the crop grid manifests.')
+    parser.add_argument('--transformation', type=str, default='diffeomorphic', choices=['affine', 'diffeomorphic'],
+                        help='Registration stage to evaluate. The diffeomorphic registration is compared with the affine one, and the affine registration with the moving image.')
+    parser.add_argument('--crop-width-x', required=True, type=int,
+                        help='Width of each crop, used if no crop grid manifest was saved.')
+    parser.add_argument('--crop-width-y', required=True, type=int,
+                        help='Height of each crop, used if no crop grid manifest was saved.')
+    parser.add_argument('--overlap-x', type=int,
+                        help='Overlap of each crop along the x-axis, used if no crop grid manifest was saved.')
+    parser.add_argument('--overlap-y', type=int,
+                        help='Overlap of each crop along the y-axis, used if no crop grid manifest was saved.')
+    parser.add_argument('--ground-truth-path', type=str,
+                        help='Path to the ground truth transformation of the moving image. Defaults to the one saved next to a synthetic slide.')
+    parser.add_argument('--landmarks-path', type=str,
+                        help='Path to a CSV file of corresponding landmarks, with the columns fixed_x, fixed_y, moving_x and moving_y.')
+    parser.add_argument('--spacing', type=int, default=256,
+                        help='Spacing of the evaluation points, in pixels.')
+    parser.add_argument('--patch-size', type=int, default=128,
+                        help='Size of the patches the residual displacements are measured on.')
+    parser.add_argument('--label', type=str,
+                        help='Name of the evaluated run, e.g. its registration mode. Defaults to the transformation.')
+    parser.add_argument('--wall-seconds', type=float,
+                        help='Runtime of the evaluated run, reported next to its accuracy.')
+    parser.add_argument('--report-path', type=str, required=True,
+                        help='Path to the CSV report, to which a row is added for each evaluated run.')
+    parser.add_argument('--points-path', type=str,
+                        help='Path to a CSV file of the measures at each evaluation point.')
+
+    args = parser.parse_args()
+    main(args)
@@ -3,64 +3,121 @@
 import argparse
 import logging
 import os
-from utils.image_cropping import get_image_file_shape
-from utils.image_cropping import get_padding_shape
-from utils.image_cropping import remove_crops_overlap
-from utils.image_stitching import stitch_crops
-from utils.misc import create_checkpoint_dirs
+from utils.artifact_index import ArtifactIndex, get_artifact_key
+from utils.misc import create_checkpoint_dirs, get_grid_params_path
 from utils import logging_config
-from utils.io_tools import save_h5
+from utils.profiling import setup_profiling, span
+from utils.service import run_in_service
+from utils.sample_store import track_stage, set_artifact_key
 
 logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
-def export_image(input_path, output_dir, fixed_image_path, overlap_x, overlap_y, max_workers, registered_crops_dir, registered_crops_no_overlap_dir, transformation):
+def get_output_path(input_path, output_dir, transformation, output_format='h5'):
     filename = os.path.basename(input_path) # Name of the output file 
     dirname = os.path.basename(os.path.dirname(input_path)) # Name of the parent directory to output file
-    file_output_dir = os.path.join(output_dir, transformation, dirname) # Path to parent directory of the output file
-    output_path = os.path.join(file_output_dir, filename) # Path to output file
+    if output_format == 'ome-zarr':
+        filename = os.path.splitext(filename)[0] + '.ome.zarr'
+
+    return os.path.join(output_dir, transformation, dirname, filename)
+
+def get_export_key(registered_crops_dir, grid, prefix, blend=False, output_format='h5', n_resolutions=3, scale=2, n_channels=3):
+    """
+    Computes the artifact key of an exported image from the keys of its crops, as recorded in the index of
+    the crops directory, and from the stitching parameters.
+
+    Returns:
+        str: The key of the exported image, or None if none of its crops is recorded.
+    """
+    from utils.crop_grid import get_crop_path
+
+    index = ArtifactIndex(registered_crops_dir)
+    crop_keys = [index.get_key(get_crop_path(registered_crops_dir, prefix, idx, ch)) for idx in grid.crop_indices for ch in range(n_channels)]
+    if not any(crop_keys):
+        return None
+
+    return get_artifact_key('exported_image', crop_keys, grid.to_dict(), blend, output_format, n_resolutions, scale)
+
+def export_image(input_path, output_dir, grid, max_workers, registered_crops_dir, transformation, blend=False,
+                 output_format='h5', n_resolutions=3, scale=2):
+    # Imported when needed, so that the script starts quickly and jobs submitted to the service stay light
+    from utils.crop_grid import get_crop_path
+    from utils.image_stitching import stitch_crops, blend_crops
+    from utils.ome_zarr import export_ome_zarr
+    from utils.scratch import check_artifacts
+
+    output_path = get_output_path(input_path, output_dir, transformation, output_format) # Path to output file
+    file_output_dir = os.path.dirname(output_path) # Path to parent directory of the output file
+
+    # The image is exported again when one of its crops or the stitching parameters changed
+    prefix = 'affine_split' if transformation == 'affine' else 'registered_split'
+    index = ArtifactIndex(file_output_dir)
+    key = get_export_key(registered_crops_dir, grid, prefix, blend, output_format, n_resolutions, scale)
+    set_artifact_key(key)
+    if key is None and os.path.exists(get_output_path(input_path, output_dir, transformation)):
+        # Images registered in memory are written directly as HDF5, without crops to stitch into another format
+        if output_format != 'h5':
+            raise ValueError(f"Image {input_path} was registered in memory, which only writes HDF5 images and "
+                             f"cannot be exported to {output_format}. Register it without --in-memory.")
+        return
+    if index.is_valid(output_path, key):
+        logger.info(f'Image {output_path} is up to date.')
+        return
 
     if not os.path.exists(file_output_dir):
         os.makedirs(file_output_dir)
         logger.debug(f'Output directory created successfully: {file_output_dir}')
+    index.invalidate([output_path])
+    check_artifacts([get_crop_path(registered_crops_dir, prefix, idx, ch) for idx in grid.crop_indices for ch in range(3)], 
+                    f'{transformation} registration')
 
-    mov_shape = get_image_file_shape(input_path)  # Shape of moving image
-    fixed_shape = get_image_file_shape(fixed_image_path)  # Shape of fixed image
-    shape = get_padding_shape(mov_shape, fixed_shape)  # Calculate padding shape
-    # Remove overlap from crops
-    positions = remove_crops_overlap(registered_crops_dir, registered_crops_no_overlap_dir, 
-                                    overlap_x, overlap_y, max_workers)
-    # Stitch crops and export image
-    stitched_image = stitch_crops(registered_crops_no_overlap_dir, shape, positions, max_workers)
-    save_h5(stitched_image, output_path)
+    # Stitch crops directly into the exported image, either blending them across their overlap or 
+    # removing it as given by the crop grid
+    if output_format == 'ome-zarr':
+        export_ome_zarr(registered_crops_dir, output_path, grid, max_workers, prefix, n_resolutions=n_resolutions, 
+                        scale=scale, blend=blend)
+    elif blend:
+        blend_crops(registered_crops_dir, output_path, grid, max_workers, prefix)
+    else:
+        stitch_crops(registered_crops_dir, output_path, grid, max_workers, prefix)
+
+    index.record(output_path, key)
+    index.flush()
     logger.info(f'Image {input_path} processed successfully.')
 
 def main(args):
+    from utils.crop_grid import load_crop_grid, get_crop_path
+    from utils.scratch import release_artifacts
+
     handler = logging.FileHandler(os.path.join(args.logs_dir, 'image_registration.log'))
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
-    # Ensure final output directory exists
     input_path = args.input_path.replace('.nd2', '.h5')
     fixed_image_path = args.fixed_image_path.replace('.nd2', '.h5')
 
-    filename = os.path.basename(input_path) # Name of the output file 
-    dirname = os.path.basename(os.path.dirname(input_path)) # Name of the parent directory to output file
-    file_output_dir = os.path.join(args.output_dir, args.transformation, dirname) # Path to parent directory of the output file
-    output_path = os.path.join(file_output_dir, filename) # Path to output file
-        
-    if not os.path.exists(output_path):
-        # Create checkpoint directories
-        _, current_registered_crops_dir, current_registered_crops_no_overlap_dir = create_checkpoint_dirs(
-            root_registered_crops_dir=args.registered_crops_dir, 
-            moving_image_path=input_path,
-            transformation=args.transformation
-        )
-    
-        # Export image      
-        export_image(input_path, args.output_dir, fixed_image_path, args.overlap_x, args.overlap_y, args.max_workers,
-                     current_registered_crops_dir, current_registered_crops_no_overlap_dir, transformation=args.transformation)
+    _, current_registered_crops_dir = create_checkpoint_dirs(
+        root_registered_crops_dir=args.registered_crops_dir, 
+        moving_image_path=input_path,
+        transformation=args.transformation,
+        makedirs=False
+    )
+
+    # Use the crop grid saved during affine registration
+    grid = load_crop_grid(get_grid_params_path(args.registered_crops_dir, input_path), input_path, fixed_image_path,
+                          args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y)
+
+    # Export image      
+    export_image(input_path, args.output_dir, grid, args.max_workers, current_registered_crops_dir, 
+                 transformation=args.transformation, blend=args.blend,
+                 output_format=args.output_format, n_resolutions=args.pyramid_resolutions, scale=args.pyramid_scale)
+
+    if args.delete_checkpoints:
+        # The keys of the crops stay in the index, so the exported image remains up to date
+        freed = release_artifacts([get_crop_path(current_registered_crops_dir, 'registered_split', idx, ch) 
+                                   for idx in grid.crop_indices for ch in range(3)])
+        logger.info(f'{freed / 1e6:.0f} MB of consumed checkpoints deleted.')
 
 if __name__ == '__main__':
     # Set up argument parser for command-line usage
@@ -75,17 +132,36 @@ if __name__ == '__main__':
                         help='Directory to save intermediate registered crops.')
     parser.add_argument('--transformation', type=str, required=True,
                         help='Transformation that was applied to the registered crops. Either "affine" or "diffeomorphic".')
+    parser.add_argument('--crop-width-x', required=True, type=int, 
+                        help='Width of each crop. The crop grid saved during affine registration takes precedence.')
+    parser.add_argument('--crop-width-y', required=True, type=int, 
+                        help='Height of each crop.')
     parser.add_argument('--overlap-x', type=int, 
                         help='Overlap of each crop along the x-axis.')
     parser.add_argument('--overlap-y', type=int, 
                         help='Overlap of each crop along the y-axis.')
     parser.add_argument('--max-workers', type=int,
                         help='Maximum number of CPUs used for parallel processing.')
-    # parser.add_argument('--delete-checkpoints', action='store_true', 
-    #                     help='Delete intermediate files after processing.')
+    parser.add_argument('--blend', action='store_true',
+                        help='Feather blend neighbouring crops across their overlap instead of cutting them at its middle.')
+    parser.add_argument('--output-format', type=str, default='h5', choices=['h5', 'ome-zarr'],
+                        help='Format of the exported image: a single HDF5 dataset, or a multiscale OME-Zarr directory.')
+    parser.add_argument('--pyramid-resolutions', type=int, default=3,
+                        help='Number of resolutions of the OME-Zarr pyramid, including the full resolution.')
+    parser.add_argument('--pyramid-scale', type=int, default=2,
+                        help='Downsampling factor between OME-Zarr pyramid levels.')
+    parser.add_argument('--delete-checkpoints', action='store_true', 
+                        help='Delete the diffeomorphic registered crops once exported. Not allowed with the affine transformation, as the affine registered crops are still needed by the diffeomorphic registration, which deletes them.')
     parser.add_argument('--logs-dir', type=str, required=True, 
                         help='Path to the directory where log files will be stored.')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Directory where the timing spans of each stage, tile and I/O call are written. Profiling is disabled if not set.')
     
     args = parser.parse_args()
-    main(args)
+    if args.delete_checkpoints and args.transformation == 'affine':
+        parser.error('--delete-checkpoints only applies to the diffeomorphic transformation, the diffeomorphic registration deletes the affine registered crops.')
+    run_in_service(__file__)
+    setup_profiling(args.profile_dir, args.input_path)
+    with span(f'export_{args.transformation}'), track_stage(f'export_{args.transformation}', args.input_path):
+        main(args)
 
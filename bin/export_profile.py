@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+from utils import logging_config
+from utils.profiling import load_profile, save_chrome_trace, summarize_profile
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def main(args):
+    events = load_profile(args.profile_dir)
+    if not events:
+        logger.error(f'No profile found in {args.profile_dir}.')
+        return
+
+    save_chrome_trace(events, args.trace_path)
+    logger.info(f'{len(events)} events written to {args.trace_path}.')
+
+    if args.summary_path:
+        summary = summarize_profile(events)
+        summary.to_csv(args.summary_path, index=False)
+        logger.info(f'Summary of {summary["image"].nunique()} images written to {args.summary_path}.')
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Merge the timing spans written by the processes of a profiled run into a Chrome trace and a summary per image.")
+    parser.add_argument('--profile-dir', type=str, required=True,
+                        help='Directory of the profiles, as given to the profiled processes.')
+    parser.add_argument('--trace-path', type=str, required=True,
+                        help='Path to the Chrome trace JSON file, which Perfetto and chrome://tracing open.')
+    parser.add_argument('--summary-path', type=str,
+                        help='Path to a CSV summary of the time spent in each span, per image.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import pandas as pd
+from utils import logging_config
+from utils.sample_store import SampleStore
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def main(args):
+    with SampleStore(args.store_path) as store:
+        for stage, counts in store.get_counts().items():
+            logger.info(f"{stage}: " + ', '.join(f'{count} {state}' for state, count in counts.items()))
+
+        sample_ids = store.get_pending(args.stages) if args.pending_only else None
+        status = pd.DataFrame(store.export(args.stages, sample_ids))
+
+    status.to_csv(args.export_path, index=False)
+    logger.info(f'Status of {len(status)} samples exported to {args.export_path}.')
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Export the state of the samples recorded by the stages of the pipeline to a CSV sample sheet.")
+    parser.add_argument('--store-path', type=str, required=True,
+                        help='Path to the SQLite store of the state of the samples, as set by the state_store parameter.')
+    parser.add_argument('--export-path', type=str, required=True,
+                        help='Path to the exported CSV file.')
+    parser.add_argument('--stages', type=str, nargs='+',
+                        help='Stages to export, e.g. affine_registration export_diffeomorphic. Defaults to every recorded stage.')
+    parser.add_argument('--pending-only', action='store_true',
+                        help='Only export the samples with at least one of the stages not done.')
+
+    args = parser.parse_args()
+    if args.pending_only and not args.stages:
+        parser.error('--pending-only requires --stages.')
+    main(args)
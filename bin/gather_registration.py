@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import os
+from utils import logging_config
+from utils.profiling import setup_profiling, span
+from utils.service import run_in_service
+from utils.sample_store import track_stage
+from utils.misc import create_checkpoint_dirs, get_grid_params_path, get_quality_map_path, get_telemetry_path, get_batch_path
+from utils.artifact_index import ArtifactIndex
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def get_missing_crops(grid, current_mappings_dir, current_moving_crops_dir, current_registered_crops_dir, n_channels=3):
+    """
+    Finds the crops of a grid with at least one channel not registered, or registered from another
+    mapping or moving crop than the current ones.
+
+    Args:
+        grid (CropGrid): Crop grid of the moving image.
+        current_mappings_dir (str): Directory of the mappings.
+        current_moving_crops_dir (str): Directory of the affine registered moving crops.
+        current_registered_crops_dir (str): Directory of the registered crops.
+        n_channels (int, optional): Number of channels.
+
+    Returns:
+        list: Indices (row, column) of the missing crops.
+    """
+    # Imported when needed, so that the script starts quickly and jobs submitted to the service stay light
+    from utils.crop_grid import get_crop_path
+    from utils.wrappers.apply_mappings import get_registered_crop_keys
+
+    keys = get_registered_crop_keys(grid.crop_indices, current_mappings_dir, current_moving_crops_dir, n_channels)
+    index = ArtifactIndex(current_registered_crops_dir)
+
+    return [
+        idx for idx in grid.crop_indices
+        if not all(index.is_valid(get_crop_path(current_registered_crops_dir, 'registered_split', idx, ch), keys[idx + (ch,)])
+                   for ch in range(n_channels))
+    ]
+
+def main(args):
+    from utils.crop_grid import load_crop_grid
+    from utils.registration_telemetry import gather_batch_files
+    from utils.scratch import release_reservation
+
+    handler = logging.FileHandler(os.path.join(args.logs_dir, 'image_registration.log'))
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    input_path = args.input_path.replace('.nd2', '.h5')
+    fixed_image_path = args.fixed_image_path.replace('.nd2', '.h5')
+
+    grid = load_crop_grid(get_grid_params_path(args.registered_crops_dir, input_path), input_path, fixed_image_path,
+                          args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y)
+
+    current_mappings_dir, current_registered_crops_dir = create_checkpoint_dirs(
+        root_mappings_dir=args.mappings_dir,
+        root_registered_crops_dir=args.registered_crops_dir,
+        moving_image_path=input_path,
+        transformation='diffeomorphic',
+        makedirs=False
+    )
+    _, current_moving_crops_dir = create_checkpoint_dirs(
+        root_registered_crops_dir=args.registered_crops_dir,
+        moving_image_path=input_path,
+        transformation='affine',
+        makedirs=False
+    )
+
+    # Every crop of every batch must be registered before the image is exported
+    missing_crops = get_missing_crops(grid, current_mappings_dir, current_moving_crops_dir, current_registered_crops_dir)
+    if missing_crops:
+        batches = sorted({batch_index for batch_index in range(args.n_batches)
+                          if set(grid.batch_indices(batch_index, args.n_batches)) & set(missing_crops)})
+        raise FileNotFoundError(f"{len(missing_crops)}/{grid.n_crops} crops of {input_path} are not registered "
+                                f"(batches {batches}), e.g. {missing_crops[:5]}.")
+
+    for path in (get_quality_map_path(args.mappings_dir, input_path), get_telemetry_path(args.mappings_dir, input_path)):
+        n_merged = gather_batch_files(path, [get_batch_path(path, batch_index) for batch_index in range(args.n_batches)])
+        if n_merged:
+            logger.info(f'{n_merged} batch files merged into {path}.')
+
+    logger.info(f'All {grid.n_crops} crops of {input_path} registered in {args.n_batches} batches.')
+
+    if args.scratch_budget is not None:
+        release_reservation(args.scratch_dirs or [args.registered_crops_dir], input_path)
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Check that all batches of crops of an image are registered and merge their outputs.")
+    parser.add_argument('--input-path', type=str, required=True,
+                        help='Path to the input (moving) image.')
+    parser.add_argument('--fixed-image-path', type=str, required=True,
+                        help='Path to the fixed image used for registration.')
+    parser.add_argument('--mappings-dir', type=str, required=True,
+                        help='Root directory of the computed mappings, holding the quality maps and telemetry.')
+    parser.add_argument('--registered-crops-dir', type=str, required=True,
+                        help='Root directory of the registered crops.')
+    parser.add_argument('--crop-width-x', required=True, type=int,
+                        help='Width of each crop. The crop grid saved during affine registration takes precedence.')
+    parser.add_argument('--crop-width-y', required=True, type=int,
+                        help='Height of each crop.')
+    parser.add_argument('--overlap-x', type=int,
+                        help='Overlap of each crop along the x-axis.')
+    parser.add_argument('--overlap-y', type=int,
+                        help='Overlap of each crop along the y-axis.')
+    parser.add_argument('--n-batches', type=int, required=True,
+                        help='Number of batches the crops were split into.')
+    parser.add_argument('--scratch-budget', type=float,
+                        help='Disk space in gigabytes the intermediate artifacts of all images may take. The share of the image reserved by affine_registration.py is released once every batch of the image is registered.')
+    parser.add_argument('--scratch-dirs', type=str, nargs='+',
+                        help='Directories of the intermediate artifacts sharing the scratch budget. Defaults to the registered crops directory.')
+    parser.add_argument('--logs-dir', type=str, required=True,
+                        help='Directory to store log files.')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Directory where the timing spans of each stage, tile and I/O call are written. Profiling is disabled if not set.')
+
+    args = parser.parse_args()
+    run_in_service(__file__)
+    setup_profiling(args.profile_dir, args.input_path)
+    with span('gather_registration'), track_stage('gather_registration', args.input_path):
+        main(args)
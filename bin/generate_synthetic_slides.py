@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import logging
+import os
+from utils import logging_config
+from utils.synthetic_slides import generate_fixed_slide, generate_moving_cycle, DEFAULT_SLIDE_PARAMS, DEFAULT_DEFORMATION_PARAMS
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def get_slide_path(output_dir, patient_id, cycle):
+    """Path of a synthetic slide, laid out as the acquired images: one directory per staining cycle."""
+    return os.path.join(output_dir, f'cycle_{cycle}', f'{patient_id}_cycle_{cycle}.h5')
+
+def main(args):
+    deformation_params = {
+        'max_rotation': args.max_rotation,
+        'max_scale': args.max_scale,
+        'max_translation': args.max_translation,
+        'max_displacement': args.max_displacement,
+        'displacement_spacing': args.displacement_spacing
+    }
+    shape = (args.height, args.width or args.height)
+
+    rows = []
+    for patient in range(args.n_patients):
+        patient_id = f'P{patient + 1}'
+        fixed_image_path = get_slide_path(args.output_dir, patient_id, 0)
+        seed = args.seed * 1000 + patient * args.n_cycles
+
+        # The first cycle is the fixed image, the following ones are warped from it
+        if args.overwrite or not os.path.exists(fixed_image_path):
+            generate_fixed_slide(fixed_image_path, shape, seed, args.max_workers, nuclei_per_cell=args.nuclei_per_cell)
+        rows.append({'patient_id': patient_id, 'fixed_image_path': fixed_image_path, 'input_path': fixed_image_path})
+
+        for cycle in range(1, args.n_cycles):
+            input_path = get_slide_path(args.output_dir, patient_id, cycle)
+            if args.overwrite or not os.path.exists(input_path):
+                generate_moving_cycle(input_path, fixed_image_path, seed + cycle, args.max_workers, **deformation_params)
+            rows.append({'patient_id': patient_id, 'fixed_image_path': fixed_image_path, 'input_path': input_path})
+
+    if args.sample_sheet_path:
+        for row in rows:
+            row['output_path'] = row['input_path'].replace('.h5', '.ome.tiff')
+        with open(args.sample_sheet_path, mode='w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=['patient_id', 'fixed_image_path', 'input_path', 'output_path'])
+            writer.writeheader()
+            writer.writerows(rows)
+        logger.info(f'Sample sheet of {len(rows)} images written to {args.sample_sheet_path}.')
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Generate synthetic multi-channel slides and moving cycles warped by a known transformation, saved as ground truth.")
+    parser.add_argument('--output-dir', type=str, required=True,
+                        help='Directory of the slides, with one subdirectory per cycle.')
+    parser.add_argument('--height', type=int, required=True,
+                        help='Height of the slides, in pixels.')
+    parser.add_argument('--width', type=int,
+                        help='Width of the slides, in pixels. Defaults to the height.')
+    parser.add_argument('--n-patients', type=int, default=1,
+                        help='Number of patients, each with its own fixed slide.')
+    parser.add_argument('--n-cycles', type=int, default=2,
+                        help='Number of cycles of each patient, including the fixed one.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the slides and transformations.')
+    parser.add_argument('--nuclei-per-cell', type=float, default=DEFAULT_SLIDE_PARAMS['nuclei_per_cell'],
+                        help='Mean number of nuclei in 256x256 pixels of dense tissue.')
+    parser.add_argument('--max-rotation', type=float, default=DEFAULT_DEFORMATION_PARAMS['max_rotation'],
+                        help='Maximum rotation of the moving cycles, in degrees.')
+    parser.add_argument('--max-scale', type=float, default=DEFAULT_DEFORMATION_PARAMS['max_scale'],
+                        help='Maximum relative scale change of the moving cycles.')
+    parser.add_argument('--max-translation', type=float, default=DEFAULT_DEFORMATION_PARAMS['max_translation'],
+                        help='Maximum translation of the moving cycles, in pixels.')
+    parser.add_argument('--max-displacement', type=float, default=DEFAULT_DEFORMATION_PARAMS['max_displacement'],
+                        help='Maximum displacement of the smooth deformation of the moving cycles, in pixels.')
+    parser.add_argument('--displacement-spacing', type=int, default=DEFAULT_DEFORMATION_PARAMS['displacement_spacing'],
+                        help='Spacing of the control points of the smooth deformation, in pixels. Smaller spacings give more local deformations.')
+    parser.add_argument('--sample-sheet-path', type=str,
+                        help='Path to a sample sheet of the generated slides, to run the pipeline on them.')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Generate slides again even if they exist.')
+    parser.add_argument('--max-workers', type=int,
+                        help='Maximum number of CPUs used for parallel processing.')
+
+    args = parser.parse_args()
+    main(args)
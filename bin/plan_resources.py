@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import logging
+import os
+import numpy as np
+import pandas as pd
+from utils import logging_config
+from utils.crop_grid import CropGrid
+from utils.image_mapping import DEFAULT_LEVEL_ITERS
+from utils.misc import get_grid_params_path, get_telemetry_path
+from utils.resource_model import GB, STAGES, get_image_shape, get_syn_time_coefficient, predict_resources, format_requirements
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def calibrate(rows, mappings_dir, registered_crops_dir):
+    """
+    Measures the SyN time coefficient on the images of the sample sheet registered in a previous run,
+    from their telemetry and crop grid.
+
+    Args:
+        rows (list): Rows of the sample sheet.
+        mappings_dir (str): Root directory of the computed mappings, holding the telemetry.
+        registered_crops_dir (str): Root directory of the registered crops, holding the crop grids.
+
+    Returns:
+        dict: Calibrated coefficients, empty if no image was registered.
+    """
+    coefficients = []
+    for row in rows:
+        input_path = row['input_path'].replace('.nd2', '.h5')
+        telemetry_path = get_telemetry_path(mappings_dir, input_path)
+        grid_params_path = get_grid_params_path(registered_crops_dir, input_path)
+        if os.path.exists(telemetry_path) and os.path.exists(grid_params_path):
+            coefficient = get_syn_time_coefficient(pd.read_csv(telemetry_path), CropGrid.load(grid_params_path))
+            if coefficient is not None:
+                coefficients.append(coefficient)
+
+    if not coefficients:
+        return {}
+
+    logger.info(f'SyN time coefficient calibrated on {len(coefficients)} registered images.')
+    return {'syn_seconds_per_pixel': float(np.median(coefficients))}
+
+def plan_sample(row, shapes, args, coefficients):
+    """
+    Predicts the resources of the stages of a sample, and its CPU-hours and scratch disk.
+
+    Args:
+        row (dict): Row of the sample sheet.
+        shapes (dict): Shape of each image, indexed by path.
+        args (argparse.Namespace): Parameters of the pipeline run.
+        coefficients (dict): Coefficients of the stage models.
+
+    Returns:
+        dict: Resource columns of the sample.
+    """
+    max_workers = min(args.max_workers, args.max_cpus) if args.max_cpus else args.max_workers
+    stages = predict_resources(shapes[row['input_path']], shapes[row['fixed_image_path']],
+                               args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y,
+                               max_workers, args.level_iters, args.n_batches, args.blend, coefficients)
+
+    # The fixed image is only converted, the registration processes skip it
+    if row['input_path'] == row['fixed_image_path']:
+        stages = {stage: resources if stage == 'conversion' else {'memory': 0, 'cpus': 1, 'cpu_seconds': 0, 'wall_seconds': 0, 'disk': 0}
+                  for stage, resources in stages.items()}
+
+    # Stages run by the sample, the export running once per transformation
+    if args.fused:
+        runs = {'conversion': 1, 'register': 1}
+    else:
+        runs = {'conversion': 1, 'affine': 1, 'diffeomorphic': 1, 'export': 2}
+
+    columns = format_requirements({stage: stages[stage] for stage in STAGES}, args.headroom,
+                                  args.max_memory, args.max_cpus, args.max_time)
+    columns['cpu_hours'] = round(sum(stages[stage]['cpu_seconds'] * n for stage, n in runs.items()) / 3600, 2)
+    columns['scratch_disk'] = f"{sum(stages[stage]['disk'] * n for stage, n in runs.items()) / GB:.1f} GB"
+
+    return columns
+
+def main(args):
+    with open(args.sample_sheet_path, newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        fieldnames = list(reader.fieldnames)
+        rows = list(reader)
+
+    # Probe each image once, fixed images being shared by the samples of a patient
+    paths = {row['input_path'] for row in rows} | {row['fixed_image_path'] for row in rows}
+    shapes = {path: get_image_shape(path) for path in sorted(paths)}
+
+    coefficients = {}
+    if args.mappings_dir and args.registered_crops_dir:
+        coefficients = calibrate(rows, args.mappings_dir, args.registered_crops_dir)
+
+    for row in rows:
+        columns = plan_sample(row, shapes, args, coefficients)
+        row.update(columns)
+        fieldnames += [column for column in columns if column not in fieldnames]
+        logger.info(f"{row['input_path']}: {columns['cpu_hours']} CPU-hours, {columns['scratch_disk']} of scratch disk.")
+
+    output_path = args.output_path or args.sample_sheet_path
+    with open(output_path, mode='w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    logger.info(f'Resources of {len(rows)} samples written to {output_path}.')
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Predict the memory, CPUs and time of each stage of every sample and write them into the sample sheet.")
+    parser.add_argument('--sample-sheet-path', type=str, required=True,
+                        help='Path to the sample sheet.')
+    parser.add_argument('--output-path', type=str,
+                        help='Path to the planned sample sheet. Defaults to updating the sample sheet in place.')
+    parser.add_argument('--crop-width-x', required=True, type=int,
+                        help='Width of each crop.')
+    parser.add_argument('--crop-width-y', required=True, type=int,
+                        help='Height of each crop.')
+    parser.add_argument('--overlap-x', type=int, required=True,
+                        help='Overlap of each crop along the x-axis.')
+    parser.add_argument('--overlap-y', type=int, required=True,
+                        help='Overlap of each crop along the y-axis.')
+    parser.add_argument('--max-workers', type=int, required=True,
+                        help='Maximum number of CPUs used for parallel processing.')
+    parser.add_argument('--n-batches', type=int, default=1,
+                        help='Number of batches the crops of each image are registered in.')
+    parser.add_argument('--level-iters', type=lambda s: [int(n) for n in s.split(',')], default=DEFAULT_LEVEL_ITERS,
+                        help='Comma separated maximum number of diffeomorphic registration iterations at each level, from coarse to fine.')
+    parser.add_argument('--blend', action='store_true',
+                        help='Whether the crops are feather blended when stitched.')
+    parser.add_argument('--fused', action='store_true',
+                        help='Whether images are registered by the fused engine, for the CPU-hours and scratch disk.')
+    parser.add_argument('--headroom', type=float, default=1.25,
+                        help='Factor applied to the predicted memory and time.')
+    parser.add_argument('--max-memory', type=float,
+                        help='Maximum memory of a task, in gigabytes.')
+    parser.add_argument('--max-cpus', type=int,
+                        help='Maximum number of CPUs of a task.')
+    parser.add_argument('--max-time', type=float,
+                        help='Maximum time of a task, in hours.')
+    parser.add_argument('--mappings-dir', type=str,
+                        help='Root directory of the mappings of a previous run, whose telemetry calibrates the registration time.')
+    parser.add_argument('--registered-crops-dir', type=str,
+                        help='Root directory of the registered crops of a previous run, holding the crop grids.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+
+import argparse
+import gc
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import logging_config
+from utils.profiling import setup_profiling, span
+from utils.service import run_in_service
+from utils.sample_store import track_stage, set_artifact_key
+from utils.misc import create_checkpoint_dirs, get_scale_space_dir, get_grid_params_path, get_quality_map_path, get_telemetry_path, get_status_path
+from utils.artifact_index import ArtifactIndex, get_artifact_key, get_file_identity
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def compute_affine_matrix(input_path, fixed_image_path, grid, crop=False, crop_size=4000, n_features=2000, fixed_channel=None):
+    """
+    Computes the affine transformation matrix of a moving image on a dense region of the images.
+
+    Args:
+        input_path (str): Path to the moving image.
+        fixed_image_path (str): Path to the fixed image.
+        grid (CropGrid): Crop grid of the moving image, whose crops are candidate regions.
+        crop (bool): Whether to compute affine mapping using a smaller region.
+        crop_size (int): Size of the subregion for affine mapping.
+        n_features (int): Number of features to use for the affine transformation.
+        fixed_channel (np.ndarray, optional): DAPI channel of the fixed image, already loaded.
+
+    Returns:
+        np.ndarray: The affine transformation matrix.
+    """
+    # Imported when needed, so that registered images are skipped without loading the registration libraries
+    from utils.image_cropping import get_dense_crop
+    from utils.image_mapping import compute_affine_mapping_cv2
+
+    fixed_crop, moving_crop = get_dense_crop(input_path, fixed_image_path, grid.crop_areas, fixed_channel=fixed_channel)
+
+    logger.info('Computing affine transformation matrix.')
+    matrix = compute_affine_mapping_cv2(fixed_crop, moving_crop, crop, crop_size, n_features)
+    logger.info('Transformation computed successfully.')
+
+    del fixed_crop, moving_crop
+    gc.collect()
+
+    return matrix
+
+def register_image(input_path, fixed_image_path, output_path, grid, matrix, max_workers, current_registered_crops_dir=None,
+                   current_scale_space_dir=None, skip_threshold=None, similarity_metric='ncc', registration_params=None, blend=False,
+                   status_path=None, fixed_crops=None, mp_context=None):
+    """
+    Registers a moving image to its fixed image in a single pass: crops are loaded once into shared memory,
+    and each worker applies the affine transformation and then the diffeomorphic registration to its crop in
+    place, before the crops are stitched into the registered image. The affine registered image, the crops
+    and the mappings are never written to disk.
+
+    Args:
+        input_path (str): Path to the moving image.
+        fixed_image_path (str): Path to the fixed image.
+        output_path (str): Path where the registered image will be saved.
+        grid (CropGrid): Crop grid of the moving image.
+        matrix (np.ndarray): Affine transformation matrix.
+        max_workers (int): Maximum number of workers for parallel processing.
+        current_registered_crops_dir (str, optional): Directory where registered crops are checkpointed
+                                                      asynchronously. No checkpoints are saved if None.
+        current_scale_space_dir (str, optional): Directory where the scale spaces of the fixed crops are cached.
+        skip_threshold (float, optional): Crops whose similarity score reaches this threshold after affine
+                                          registration are not registered again.
+        similarity_metric (str, optional): Similarity metric used for the pre-check, either 'ncc' or 'mi'.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+        blend (bool, optional): Feather blend the crops across their overlap instead of cutting them at its middle.
+        status_path (str, optional): Path to the status file where the progress of the workers is written.
+        fixed_crops (dict, optional): Shared DAPI crops of the fixed image along the grid, prepared by the caller
+                                      and released by it. They are cropped from fixed_image_path if None.
+        mp_context (multiprocessing.context.BaseContext, optional): Context starting the workers.
+
+    Returns:
+        tuple: Similarity score and telemetry record of each crop, indexed by (row, column).
+    """
+    from utils.image_cropping import crop_image_channels_shared
+    from utils.image_stitching import stitch_shared_crops, blend_shared_crops
+    from utils.shared_memory import release_shared_arrays
+    from utils.wrappers.shared_mappings import register_crops_shared, get_scale_space_keys
+
+    n_channels = 3
+
+    owned_crops, moving_crops = {}, {}
+    try:
+        # Only the DAPI channel of the fixed image is used to compute the mappings
+        if fixed_crops is None:
+            fixed_crops = owned_crops = crop_image_channels_shared(fixed_image_path, grid, channels=[2])
+        moving_crops = crop_image_channels_shared(input_path, grid, channels=range(n_channels))
+
+        scores, records = register_crops_shared(fixed_crops, moving_crops, grid.crop_indices, n_channels,
+                                                current_registered_crops_dir, max_workers, current_scale_space_dir,
+                                                skip_threshold, similarity_metric, registration_params, affine_matrix=matrix,
+                                                scale_space_keys=get_scale_space_keys(fixed_image_path, grid, registration_params),
+                                                status_path=status_path, mp_context=mp_context)
+
+        if blend:
+            blend_shared_crops(moving_crops, grid, output_path, n_channels)
+        else:
+            stitch_shared_crops(moving_crops, grid, output_path, n_channels)
+        logger.info(f'Image {input_path} processed successfully.')
+    finally:
+        release_shared_arrays([crop[0] for crop in owned_crops.values()])
+        release_shared_arrays([crop[0] for crop in moving_crops.values()])
+
+    scores = {idx: score for idx, score in scores.items() if score is not None}
+    records = {idx: record for idx, record in records.items() if record is not None}
+
+    return scores, records
+
+class FixedImage:
+    """
+    Fixed image of a patient, prepared once for the registration of all its cycles: its DAPI channel is read
+    once, and cropped into shared memory once for each crop grid of the cycles. Cycles padded to the same
+    shape with the same crops share the same fixed crops.
+
+    Attributes:
+        path (str): Path to the fixed image.
+        channel (np.ndarray): DAPI channel of the fixed image.
+        crops (dict): Shared DAPI crops, indexed by the geometry of their crop grid.
+    """
+    def __init__(self, path):
+        from utils.io_tools import load_h5_channel
+
+        self.path = path
+        self.channel = load_h5_channel(path, 2)
+        self.crops = {}
+        self.lock = threading.Lock()
+
+    def get_crops(self, grid):
+        """Shared DAPI crops of the fixed image along a crop grid, cropped on first use."""
+        from utils.image_cropping import crop_channel_shared
+
+        key = (grid.shape, grid.crop_width_x, grid.crop_width_y, grid.overlap_x, grid.overlap_y)
+        with self.lock:
+            if key not in self.crops:
+                self.crops[key] = crop_channel_shared(self.channel, grid, 2)
+            return self.crops[key]
+
+    def release(self):
+        from utils.shared_memory import release_shared_arrays
+
+        for crops in self.crops.values():
+            release_shared_arrays([crop[0] for crop in crops.values()])
+        self.crops = {}
+
+def get_output_path(output_dir, input_path):
+    filename = os.path.basename(input_path) # Name of the output file
+    dirname = os.path.basename(os.path.dirname(input_path)) # Name of the parent directory to output file
+    return os.path.join(output_dir, 'diffeomorphic', dirname, filename) # Path to output file
+
+def get_output_key(args, input_path, fixed_image_path, registration_params):
+    # The registered image is the only artifact to check for, and depends on the images and on every parameter.
+    # Default iterations are left unset in its key, so that it is checked before the registration libraries load
+    return get_artifact_key('registered_image', get_file_identity(input_path), get_file_identity(fixed_image_path),
+                            args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y, args.adaptive_overlap,
+                            args.crop, args.crop_size, args.n_features, args.skip_threshold, args.similarity_metric,
+                            registration_params, args.blend)
+
+def is_registered(args, input_path, fixed_image_path, registration_params):
+    output_path = get_output_path(args.output_dir, input_path)
+    return ArtifactIndex(os.path.dirname(output_path)).is_valid(
+        output_path, get_output_key(args, input_path, fixed_image_path, registration_params))
+
+def register_cycle(args, input_path, fixed_image_path, registration_params, max_workers, fixed_image=None, mp_context=None):
+    """
+    Registers a moving image to its fixed image, unless its registered image is up to date.
+
+    Args:
+        args (argparse.Namespace): Arguments of the script.
+        input_path (str): Path to the moving image.
+        fixed_image_path (str): Path to the fixed image.
+        registration_params (dict): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+        max_workers (int): Maximum number of workers for parallel processing.
+        fixed_image (FixedImage, optional): Fixed image prepared for all the cycles of the patient. The fixed
+                                            image is read from fixed_image_path if None.
+        mp_context (multiprocessing.context.BaseContext, optional): Context starting the workers.
+    """
+    with track_stage('register_image', input_path):
+        output_path = get_output_path(args.output_dir, input_path)
+        output_index = ArtifactIndex(os.path.dirname(output_path))
+        output_key = get_output_key(args, input_path, fixed_image_path, registration_params)
+        set_artifact_key(output_key)
+        if output_index.is_valid(output_path, output_key):
+            logger.info(f'Registered image {output_path} is up to date.')
+            return
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        output_index.invalidate([output_path])
+
+        from utils.crop_grid import CropGrid, get_grid_key, load_grid_manifest
+        from utils.image_mapping import DEFAULT_LEVEL_ITERS
+        from utils.overlap_estimation import estimate_overlap
+        from utils.registration_telemetry import save_telemetry, save_quality_map
+
+        registration_params = {**registration_params, 'level_iters': args.level_iters or DEFAULT_LEVEL_ITERS}
+
+        grid = CropGrid.from_image_files(input_path, fixed_image_path,
+                                         args.crop_width_x, args.crop_width_y, args.overlap_x, args.overlap_y)
+        matrix = compute_affine_matrix(input_path, fixed_image_path, grid, args.crop, args.crop_size, args.n_features,
+                                       fixed_image.channel if fixed_image is not None else None)
+
+        # Use the crop grid chosen by a previous adaptive run of the same images and parameters, as the staged pipeline does
+        grid_params_path = get_grid_params_path(args.registered_crops_dir, input_path)
+        grid_key = get_grid_key(input_path, fixed_image_path, args.crop_width_x, args.crop_width_y, args.overlap_x,
+                                args.overlap_y, args.adaptive_overlap, args.crop, args.crop_size, args.n_features)
+        saved_grid = load_grid_manifest(grid_params_path, grid_key) if args.adaptive_overlap else None
+        if saved_grid is not None:
+            logger.info(f'Crop grid loaded from {grid_params_path}.')
+            grid = saved_grid
+        elif args.adaptive_overlap:
+            # Choose the smallest overlap covering the residual deformation
+            overlap_x, overlap_y = estimate_overlap(fixed_image_path, input_path, matrix, grid.shape,
+                                                    grid.crop_width_x, grid.crop_width_y, grid.overlap_x, grid.overlap_y)
+            grid = CropGrid(grid.shape, grid.crop_width_x, grid.crop_width_y, overlap_x, overlap_y)
+
+        # Record the crop grid alongside the checkpoints, as the staged pipeline does
+        grid.save(grid_params_path, grid_key)
+
+        current_registered_crops_dir = None
+        if args.save_checkpoints:
+            _, current_registered_crops_dir = create_checkpoint_dirs(
+                root_registered_crops_dir=args.registered_crops_dir,
+                moving_image_path=input_path,
+                transformation='diffeomorphic'
+            )
+
+        # Scale spaces of the fixed crops are shared by all moving images registered to the same fixed image
+        current_scale_space_dir = None
+        if args.scale_space_dir:
+            current_scale_space_dir = get_scale_space_dir(fixed_image_path, args.scale_space_dir,
+                                                          grid.crop_width_x, grid.crop_width_y, grid.overlap_x, grid.overlap_y)
+
+        scores, records = register_image(input_path, fixed_image_path, output_path, grid, matrix, max_workers,
+                                         current_registered_crops_dir, current_scale_space_dir, args.skip_threshold,
+                                         args.similarity_metric, registration_params, args.blend,
+                                         get_status_path(args.logs_dir, input_path),
+                                         fixed_image.get_crops(grid) if fixed_image is not None else None, mp_context)
+        output_index.record(output_path, output_key)
+        output_index.flush()
+
+        if args.skip_threshold is not None:
+            save_quality_map(scores, args.skip_threshold, get_quality_map_path(args.mappings_dir, input_path))
+        save_telemetry(records, registration_params, get_telemetry_path(args.mappings_dir, input_path))
+
+def main(args):
+    # Set up logging to a file
+    handler = logging.FileHandler(os.path.join(args.logs_dir, 'image_registration.log'))
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    fixed_image_path = args.fixed_image_path.replace('.nd2', '.h5')
+    input_paths = [path.replace('.nd2', '.h5') for path in args.input_path if path != args.fixed_image_path]
+
+    registration_params = {
+        'level_iters': args.level_iters,
+        'opt_tol': args.opt_tol,
+        'inv_tol': args.inv_tol,
+        'metric': args.metric,
+        'radius': args.metric_radius
+    }
+
+    # The fixed image is prepared once when several cycles of the patient are registered to it
+    pending = [path for path in input_paths if not is_registered(args, path, fixed_image_path, registration_params)]
+    if len(pending) < 2:
+        for input_path in input_paths:
+            register_cycle(args, input_path, fixed_image_path, registration_params, args.max_workers)
+        return
+
+    logger.info(f'Registering {len(pending)} cycles to fixed image {fixed_image_path}, {args.max_concurrent} at a time.')
+    fixed_image = FixedImage(fixed_image_path)
+    failed = []
+    try:
+        # The first cycle runs alone, so that the following ones reuse the scale spaces it cached
+        for input_path in input_paths:
+            if input_path not in pending[1:]:
+                try:
+                    register_cycle(args, input_path, fixed_image_path, registration_params, args.max_workers, fixed_image)
+                except Exception:
+                    logger.exception(f'Registration of {input_path} failed.')
+                    failed.append(input_path)
+
+        # Concurrent cycles share the workers. Their pools are started from a forkserver, as forking a process
+        # whose other threads hold logging or HDF5 locks may leave the workers deadlocked
+        max_workers = max((args.max_workers or os.cpu_count()) // args.max_concurrent, 1)
+        mp_context = multiprocessing.get_context('forkserver')
+        mp_context.set_forkserver_preload(['utils.wrappers.shared_mappings'])
+        with ThreadPoolExecutor(max_workers=args.max_concurrent) as executor:
+            futures = {
+                executor.submit(register_cycle, args, input_path, fixed_image_path, registration_params, max_workers,
+                                fixed_image, mp_context): input_path
+                for input_path in pending[1:]
+            }
+            for future, input_path in futures.items():
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception(f'Registration of {input_path} failed.')
+                    failed.append(input_path)
+    finally:
+        fixed_image.release()
+
+    # The other cycles are kept, and only the failed ones are registered again on retry
+    if failed:
+        raise RuntimeError(f'Registration of {len(failed)} of {len(pending)} cycles failed: {", ".join(failed)}')
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Register an image with affine and diffeomorphic transformations in a single process.")
+    parser.add_argument('--input-path', type=str, required=True, nargs='+',
+                        help='Paths to the input (moving) images, registered to the same fixed image. The fixed image of several images, '
+                             'e.g. the cycles of a patient, is read and cropped once. The fixed image itself is skipped if listed.')
+    parser.add_argument('--output-dir', type=str, required=True,
+                        help='Path to save the registered image.')
+    parser.add_argument('--fixed-image-path', type=str, required=True,
+                        help='Path to the fixed image used for registration.')
+    parser.add_argument('--mappings-dir', type=str, required=True,
+                        help='Root directory of the quality maps and registration telemetry.')
+    parser.add_argument('--registered-crops-dir', type=str, required=True,
+                        help='Directory of the crop grid manifests and of the registered crops checkpoints.')
+    parser.add_argument('--scale-space-dir', type=str,
+                        help='Directory where the scale spaces of the fixed crops are cached and reused across moving images. '
+                             'A cached scale space takes about 12 bytes per pixel for a small speed-up per crop, so the cache is disabled if not set.')
+    parser.add_argument('--crop-width-x', required=True, type=int,
+                        help='Width of each crop.')
+    parser.add_argument('--crop-width-y', required=True, type=int,
+                        help='Height of each crop.')
+    parser.add_argument('--overlap-x', type=int,
+                        help='Overlap of each crop along the x-axis.')
+    parser.add_argument('--overlap-y', type=int,
+                        help='Overlap of each crop along the y-axis.')
+    parser.add_argument('--adaptive-overlap', action='store_true',
+                        help='Choose the smallest overlap covering the deformation measured on a coarse pass, instead of the requested overlap.')
+    parser.add_argument('--crop', action='store_true',
+                        help='Whether to compute the affine mapping using a smaller subregion of the image.')
+    parser.add_argument('--crop-size', type=int, default=4000,
+                        help='Size of the subregion to use for affine mapping (if cropping is enabled).')
+    parser.add_argument('--n-features', type=int, default=2000,
+                        help='Number of features to detect for computing the affine transformation.')
+    parser.add_argument('--max-workers', type=int,
+                        help='Maximum number of CPUs used for parallel processing.')
+    parser.add_argument('--max-concurrent', type=int, default=1,
+                        help='Maximum number of images registered at once, after the first one, sharing the workers.')
+    parser.add_argument('--skip-threshold', type=float,
+                        help='Similarity score after affine registration above which the diffeomorphic registration of a crop is skipped.')
+    parser.add_argument('--similarity-metric', type=str, default='ncc', choices=['ncc', 'mi'],
+                        help='Similarity metric used to score crops after affine registration: normalized cross-correlation or normalized mutual information.')
+    parser.add_argument('--level-iters', type=lambda s: [int(n) for n in s.split(',')],
+                        help='Comma separated maximum number of diffeomorphic registration iterations at each level, from coarse to fine. Defaults to DEFAULT_LEVEL_ITERS of utils/image_mapping.py.')
+    parser.add_argument('--opt-tol', type=float, default=1e-03,
+                        help='Tolerance on the energy derivative below which the iterations of a level stop.')
+    parser.add_argument('--inv-tol', type=float, default=0.1,
+                        help='Tolerance of the inversion of the displacement fields.')
+    parser.add_argument('--metric', type=str, default='cc', choices=['cc', 'ssd', 'em'],
+                        help='Similarity metric of the diffeomorphic registration: cross-correlation, sum of squared differences or expectation-maximization.')
+    parser.add_argument('--metric-radius', type=int, default=4,
+                        help='Radius of the cross-correlation metric neighborhood.')
+    parser.add_argument('--blend', action='store_true',
+                        help='Feather blend neighbouring crops across their overlap when stitching.')
+    parser.add_argument('--save-checkpoints', action='store_true',
+                        help='Asynchronously save the registered crops to the registered crops directory.')
+    parser.add_argument('--logs-dir', type=str, required=True,
+                        help='Directory to store log files.')
+    parser.add_argument('--profile-dir', type=str,
+                        help='Directory where the timing spans of each stage, tile and I/O call are written. Profiling is disabled if not set.')
+
+    args = parser.parse_args()
+    run_in_service(__file__)
+    setup_profiling(args.profile_dir, args.input_path[0] if len(args.input_path) == 1 else None)
+    with span('register_image'):
+        main(args)
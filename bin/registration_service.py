@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import argparse
+import importlib
+import logging
+import multiprocessing
+import os
+import runpy
+import signal
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Client, Listener, wait
+from utils import logging_config
+from utils.profiling import PROFILE_DIR_ENV, setup_profiling
+from utils.service import SERVICE_ADDRESS_ENV, FORWARDED_ENV_PREFIX, receive_job
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Modules imported once by the service, and inherited by every job and its workers
+PRELOADED_MODULES = [
+    'utils.crop_grid',
+    'utils.image_cropping',
+    'utils.image_mapping',
+    'utils.image_stitching',
+    'utils.io_tools',
+    'utils.ome_tiff',
+    'utils.ome_zarr',
+    'utils.overlap_estimation',
+    'utils.registration_telemetry',
+    'utils.resource_model',
+    'utils.scratch',
+    'utils.wrappers.apply_mappings',
+    'utils.wrappers.compute_mappings',
+    'utils.wrappers.shared_mappings'
+]
+
+def cancel_on_disconnect(conn, reported):
+    """
+    Kills the job and its workers when its client disconnects before the job reported its exit code, e.g.
+    when the task of the client was killed by the scheduler.
+    """
+    # The client sends nothing after its job, so the connection only becomes readable when it is closed
+    wait([conn])
+    if reported.is_set():
+        return
+    logger.warning(f'Client of job {os.getpid()} disconnected, cancelling the job.')
+    os.killpg(0, signal.SIGTERM)
+
+def run_job(conn):
+    """
+    Runs a submitted script as its own interpreter would, in a process forked from the service. The process
+    starts with the modules of the service imported, and its worker pools are forked from it in turn.
+    """
+    # The job and its workers form a process group, killed together if the job is cancelled. A terminated
+    # job dies as a script would, instead of exiting like the service with a successful exit code
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    with conn:
+        job, fds = receive_job(conn)
+        reported = threading.Event()
+        threading.Thread(target=cancel_on_disconnect, args=(conn, reported), daemon=True).start()
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        # The job sees the working directory and the variables of its client, and runs locally
+        os.chdir(job['cwd'])
+        for name in [name for name in os.environ if name.startswith(FORWARDED_ENV_PREFIX)]:
+            del os.environ[name]
+        os.environ.update(job['env'])
+        os.environ.pop(SERVICE_ADDRESS_ENV, None)
+        setup_profiling(os.environ.get(PROFILE_DIR_ENV))
+
+        sys.argv = [job['script_path']] + job['argv']
+        sys.path[0] = os.path.dirname(job['script_path'])
+        try:
+            runpy.run_path(job['script_path'], run_name='__main__')
+            exitcode = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                exitcode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                exitcode = 1
+        except BaseException:
+            traceback.print_exc()
+            exitcode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        reported.set()
+        conn.send({'exitcode': exitcode})
+
+def remove_stale_socket(address):
+    """Removes the socket left by a service that did not shut down, and fails if a service still listens on it."""
+    if not os.path.exists(address):
+        return
+
+    try:
+        Client(address, family='AF_UNIX').close()
+    except OSError:
+        os.unlink(address)
+        return
+    raise RuntimeError(f'A registration service is already listening at {address}.')
+
+def main(args):
+    for module in PRELOADED_MODULES:
+        importlib.import_module(module)
+    logger.info(f'{len(PRELOADED_MODULES)} modules preloaded.')
+
+    # Jobs are forked, so that they start with the preloaded modules and none of the state of previous jobs
+    context = multiprocessing.get_context('fork')
+    remove_stale_socket(args.address)
+
+    # The socket is removed when the listener closes, including on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with Listener(args.address, family='AF_UNIX', backlog=args.backlog) as listener:
+        os.chmod(args.address, 0o600)
+        logger.info(f'Registration service listening at {args.address}, running up to {args.max_jobs} jobs at once. '
+                    f'Set {SERVICE_ADDRESS_ENV}={args.address} to submit jobs to it.')
+        try:
+            while True:
+                conn = listener.accept()
+
+                # Jobs beyond the limit wait for a running job to end
+                while len(context.active_children()) >= args.max_jobs:
+                    wait([process.sentinel for process in context.active_children()])
+
+                context.Process(target=run_job, args=(conn,)).start()
+                conn.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info(f'Registration service stopped, waiting for {len(context.active_children())} jobs.')
+
+if __name__ == '__main__':
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Run the jobs of the pipeline scripts in processes forked from a long-lived service, "
+                                                 "which imported their dependencies once. The scripts submit their jobs to it when "
+                                                 f"{SERVICE_ADDRESS_ENV} is set, and the service must run on the host of their tasks.")
+    parser.add_argument('--address', type=str, required=True,
+                        help='Path to the Unix socket the service listens on.')
+    parser.add_argument('--max-jobs', type=int, default=1,
+                        help='Maximum number of jobs running at once. Each job starts its own worker pools.')
+    parser.add_argument('--backlog', type=int, default=64,
+                        help='Maximum number of submitted jobs waiting to be accepted.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import os
+import logging
+import pandas as pd
+from utils import logging_config
+from utils.registration_telemetry import summarize_telemetry
+
+# Set up logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def main(args):
+    # Telemetry files are stored as <telemetry dir>/<cycle>/<image>.csv
+    telemetry_files = sorted(glob.glob(os.path.join(args.mappings_dir, 'telemetry', '*', '*.csv')))
+    if not telemetry_files:
+        logger.error(f'No telemetry found in {args.mappings_dir}.')
+        return
+
+    telemetry = pd.concat([pd.read_csv(file) for file in telemetry_files], ignore_index=True)
+    summary = summarize_telemetry(telemetry)
+
+    summary.to_csv(args.output_path, index=False)
+    logger.info(f'Telemetry of {len(telemetry)} crops from {len(telemetry_files)} images summarized to {args.output_path}.')
+
+if __name__ == "__main__":
+    # Set up argument parser for command-line usage
+    parser = argparse.ArgumentParser(description="Aggregate the convergence telemetry of the diffeomorphic registration per level schedule.")
+    parser.add_argument('--mappings-dir', type=str, required=True,
+                        help='Root directory of the computed mappings, holding the telemetry files.')
+    parser.add_argument('--output-path', type=str, required=True,
+                        help='Path to the summary CSV file.')
+
+    args = parser.parse_args()
+
+    main(args)
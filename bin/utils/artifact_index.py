@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import os
+import json
+import fcntl
+import hashlib
+import logging
+from . import logging_config
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = '.artifact_index.json'
+
+"""
+Artifact keys
+"""
+
+def get_file_identity(path):
+    """
+    Identity of an input file: its absolute path, size and modification time, which change whenever
+    the file is rewritten.
+
+    Parameters:
+        path (str): Path to the file.
+
+    Returns:
+        list: Absolute path, size and modification time (ns) of the file.
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+def get_artifact_key(kind, *inputs):
+    """
+    Hashes the identity of an artifact: its kind and everything it is computed from, i.e. the identity of
+    its input files, the keys of the artifacts it depends on and its parameters.
+
+    Parameters:
+        kind (str): Kind of the artifact.
+        *inputs: JSON serializable inputs of the artifact. Numpy values are converted to lists and scalars.
+
+    Returns:
+        str: The key of the artifact.
+    """
+    payload = json.dumps([kind, *inputs], sort_keys=True, default=lambda obj: obj.tolist())
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+def get_crop_key(image_identity, area, ch):
+    """
+    Key of a channel of a crop of an image, which only depends on the image and on the crop area.
+
+    Parameters:
+        image_identity (list): Identity of the image, as returned by get_file_identity.
+        area (tuple): Crop area (start_row, end_row, start_col, end_col) in the padded image.
+        ch (int): Channel of the crop.
+
+    Returns:
+        str: The key of the crop.
+    """
+    return get_artifact_key('crop', image_identity, area, ch)
+
+def get_scale_space_key(fixed_crop_key, levels):
+    """
+    Key of the scale space of a fixed crop, which is shared by the moving images registered to it.
+
+    Parameters:
+        fixed_crop_key (str): Key of the DAPI channel of the fixed crop.
+        levels (int): Number of levels of the scale space.
+
+    Returns:
+        str: The key of the scale space.
+    """
+    return get_artifact_key('scale_space', fixed_crop_key, levels)
+
+"""
+Artifact index
+"""
+
+class ArtifactIndex:
+    """
+    Keys of the artifacts of a directory, recorded in a JSON file next to them. An artifact is valid when
+    its file exists and its recorded key is the key expected from its current inputs and parameters, so
+    a changed input or parameter only invalidates the artifacts computed from it.
+
+    Keys are recorded in memory and written by flush, which merges them into the index file under a lock,
+    as several processes may write the artifacts of a directory (e.g. the batches of crops of an image).
+
+    Attributes:
+        directory (str): Directory of the artifacts.
+        path (str): Path to the index file.
+        keys (dict): Key of each artifact filename, as last read from or written to the index file.
+        pending (dict): Keys recorded since the last flush. None marks an invalidated artifact.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_FILENAME)
+        self.keys = self._read()
+        self.pending = {}
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            logger.warning(f'Artifact index {self.path} is corrupted, its artifacts will be recomputed.')
+            return {}
+
+    def get_key(self, path):
+        """Recorded key of an artifact, None if it was never recorded or was invalidated."""
+        filename = os.path.basename(path)
+        if filename in self.pending:
+            return self.pending[filename]
+        return self.keys.get(filename)
+
+    def is_valid(self, path, key):
+        """Whether an artifact exists and was computed from the inputs and parameters identified by key."""
+        return key is not None and self.get_key(path) == key and os.path.exists(path)
+
+    def is_consumed(self, path, key):
+        """Whether an artifact was computed from the inputs and parameters identified by key, then deleted once consumed."""
+        return key is not None and self.get_key(path) == key and not os.path.exists(path)
+
+    def paths(self):
+        """Paths of the recorded artifacts of the directory."""
+        filenames = {filename for filename, key in {**self.keys, **self.pending}.items() if key is not None}
+        return [os.path.join(self.directory, filename) for filename in sorted(filenames)]
+
+    def record(self, path, key):
+        """Records the key of an artifact once its file is written."""
+        self.pending[os.path.basename(path)] = key
+
+    def invalidate(self, paths):
+        """
+        Removes artifacts about to be recomputed from the index, so that an interrupted recomputation never
+        leaves a file recorded with the key of its previous content.
+        """
+        for path in paths:
+            self.pending[os.path.basename(path)] = None
+        self.flush()
+
+    def flush(self):
+        """Merges the recorded keys into the index file."""
+        if not self.pending:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Keys recorded by other processes since the index was read are kept
+            keys = self._read()
+            for filename, key in self.pending.items():
+                if key is None:
+                    keys.pop(filename, None)
+                else:
+                    keys[filename] = key
+
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(keys, f)
+            os.replace(tmp_path, self.path)
+
+        self.keys = keys
+        self.pending = {}
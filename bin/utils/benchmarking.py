@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import time
+import resource
+import threading
+import logging
+from . import logging_config
+from .progress import get_tree_rss
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Metrics compared between two benchmark runs, and whether a higher value is better. Accuracy metrics
+# gate speed optimizations that degrade the registration
+COMPARED_METRICS = {
+    'wall_seconds': False,
+    'cpu_seconds': False,
+    'peak_rss': False,
+    'megapixels_per_second': True,
+    'tre_after_median': False,
+    'tre_after_p90': False,
+    'ncc_after_median': True,
+    'seam_ratio_mean': False
+}
+
+# Metrics too noisy to be compared on short stages
+TIME_METRICS = ['wall_seconds', 'cpu_seconds', 'megapixels_per_second']
+
+"""
+Process metrics
+"""
+
+def read_io_counters():
+    """
+    Reads the bytes read and written by the process, including its children that exited and were waited for,
+    which the kernel adds to their parent. Counted at the system call level, so reads served by the page cache
+    are included.
+
+    Returns:
+        tuple: Bytes read and written, zeros if the counters are not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError):
+        return 0, 0
+
+class RssSampler:
+    """
+    Samples the resident memory of the current process tree in a background thread, and keeps its peak. The
+    peak of the tree is what a task needs, unlike the peak of the largest process reported by getrusage.
+
+    Attributes:
+        interval (float): Seconds between two samples.
+        peak (int): Peak resident memory of the tree, in bytes.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        pid = os.getpid()
+        while not self._stop.is_set():
+            self.peak = max(self.peak, get_tree_rss(pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, get_tree_rss(os.getpid()))
+
+def measure(function, *args, **kwargs):
+    """
+    Runs a function and measures its wall time, CPU time, peak memory and I/O, its child processes included.
+    Run it in a fresh process, as the peak memory reported by getrusage never decreases.
+
+    Parameters:
+        function (callable): Function to measure.
+        *args, **kwargs: Arguments of the function.
+
+    Returns:
+        tuple: Result of the function and its metrics.
+    """
+    def cpu_seconds():
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return self_usage.ru_utime + self_usage.ru_stime + children_usage.ru_utime + children_usage.ru_stime
+
+    start_read, start_written = read_io_counters()
+    start_cpu = cpu_seconds()
+    start = time.perf_counter()
+
+    with RssSampler() as sampler:
+        result = function(*args, **kwargs)
+
+    wall_seconds = time.perf_counter() - start
+    read, written = read_io_counters()
+
+    # ru_maxrss is in kilobytes on Linux
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+    return result, {
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds() - start_cpu,
+        'peak_rss': sampler.peak,
+        'max_process_rss': max_rss,
+        'bytes_read': read - start_read,
+        'bytes_written': written - start_written
+    }
+
+"""
+Comparison
+"""
+
+def get_cell_key(result, parameters):
+    """Identifies a benchmark cell by its stage and the values of the parameters of the matrix."""
+    return (result['stage'],) + tuple(result.get(parameter) for parameter in parameters)
+
+def compare_results(baseline, current, parameters, threshold=0.1, min_seconds=0.5):
+    """
+    Compares the cells of two benchmark runs and flags the metrics that got worse by more than a threshold.
+    Cells faster than min_seconds in both runs are dominated by noise, and not compared on time.
+
+    Parameters:
+        baseline (list): Results of the baseline run.
+        current (list): Results of the current run.
+        parameters (list): Parameters of the matrix identifying the cells.
+        threshold (float, optional): Relative change above which a metric is flagged.
+        min_seconds (float, optional): Wall time below which time metrics are not compared.
+
+    Returns:
+        list: One comparison per metric of each cell present in both runs, with its relative change and
+              whether it is a regression.
+    """
+    baseline = {get_cell_key(result, parameters): result for result in baseline}
+
+    comparisons = []
+    for result in current:
+        key = get_cell_key(result, parameters)
+        if key not in baseline:
+            continue
+        reference = baseline[key]
+        too_short = max(reference['wall_seconds'], result['wall_seconds']) < min_seconds
+
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric in TIME_METRICS and too_short:
+                continue
+            before, after = reference.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+
+            change = (after - before) / before
+            comparisons.append({
+                'cell': key,
+                'metric': metric,
+                'baseline': before,
+                'current': after,
+                'change': change,
+                'regression': (-change if higher_is_better else change) > threshold
+            })
+
+    return comparisons
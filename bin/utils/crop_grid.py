@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+from .io_tools import save_json, load_json
+from .artifact_index import ArtifactIndex, get_artifact_key, get_file_identity
+from .image_cropping import get_cropping_positions, get_image_file_shape, get_padding_shape
+
+"""
+Crop grid
+"""
+
+class CropGrid:
+    """
+    Geometry of the crops an image is split into for registration, and of their stitching.
+
+    The grid is separable: every crop of a row shares its vertical extent and every crop of a column its
+    horizontal extent. Start and end positions, the region kept after removing the overlap (trim) and the
+    stitching offset are therefore stored once per row and once per column, and the geometry of crop
+    (row, col) is looked up in constant time.
+
+    Attributes:
+        shape (tuple): Shape (height, width) of the padded image.
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Overlap between crops along the x-axis.
+        overlap_y (int): Overlap between crops along the y-axis.
+        row_starts, row_ends (np.ndarray): Extent of each crop row in the padded image.
+        col_starts, col_ends (np.ndarray): Extent of each crop column in the padded image.
+        row_trims, col_trims (np.ndarray): Region (start, end) of each crop row and column kept after
+                                           removing the overlap, in crop coordinates. Shape (n, 2).
+        row_offsets, col_offsets (np.ndarray): Position of the trimmed crops in the stitched image.
+    """
+    def __init__(self, shape, crop_width_x, crop_width_y, overlap_x, overlap_y, row_positions=None, col_positions=None):
+        self.shape = tuple(int(n) for n in shape[:2])
+        self.crop_width_x = int(crop_width_x)
+        self.crop_width_y = int(crop_width_y)
+        self.overlap_x = int(overlap_x)
+        self.overlap_y = int(overlap_y)
+
+        # Rows follow the y parameters and columns the x parameters, as in get_crop_areas
+        if row_positions is None:
+            row_positions = get_cropping_positions(self.crop_width_y, self.overlap_y, axis=1, shape=self.shape)
+        if col_positions is None:
+            col_positions = get_cropping_positions(self.crop_width_x, self.overlap_x, axis=0, shape=self.shape)
+        self.row_starts, self.row_ends = (np.asarray(positions, dtype=np.int64) for positions in row_positions)
+        self.col_starts, self.col_ends = (np.asarray(positions, dtype=np.int64) for positions in col_positions)
+
+        self.row_trims = self._get_trims(self.row_starts, self.row_ends, self.overlap_y)
+        self.col_trims = self._get_trims(self.col_starts, self.col_ends, self.overlap_x)
+        self.row_offsets = self.row_starts + self.row_trims[:, 0]
+        self.col_offsets = self.col_starts + self.col_trims[:, 0]
+
+    @staticmethod
+    def _get_trims(starts, ends, overlap):
+        # Half of the overlap is removed on each side of the inner crop borders
+        trims = np.stack([np.zeros_like(starts), ends - starts], axis=1)
+        trims[1:, 0] += overlap // 2
+        trims[:-1, 1] -= overlap - overlap // 2
+
+        return trims
+
+    @classmethod
+    def from_image_files(cls, input_path, fixed_image_path, crop_width_x, crop_width_y, overlap_x, overlap_y):
+        """
+        Create the grid of a moving image, padded to the shape shared with its fixed image.
+
+        Args:
+            input_path (str): Path to the moving image.
+            fixed_image_path (str): Path to the fixed image.
+            crop_width_x (int): Width of each crop.
+            crop_width_y (int): Height of each crop.
+            overlap_x (int): Overlap between crops along the x-axis.
+            overlap_y (int): Overlap between crops along the y-axis.
+
+        Returns:
+            CropGrid: The crop grid.
+        """
+        padding_shape = get_padding_shape(get_image_file_shape(input_path), get_image_file_shape(fixed_image_path))
+
+        return cls(padding_shape, crop_width_x, crop_width_y, overlap_x, overlap_y)
+
+    @property
+    def n_rows(self):
+        return len(self.row_starts)
+
+    @property
+    def n_cols(self):
+        return len(self.col_starts)
+
+    @property
+    def n_crops(self):
+        return self.n_rows * self.n_cols
+
+    @property
+    def crop_indices(self):
+        """Crop indices (row, column), in the order of get_crop_areas."""
+        return [(row, col) for col in range(self.n_cols) for row in range(self.n_rows)]
+
+    @property
+    def crop_areas(self):
+        """Crop areas (start_row, end_row, start_col, end_col), in the order of crop_indices."""
+        return [self.area(idx) for idx in self.crop_indices]
+
+    def batch_indices(self, batch_index, n_batches):
+        """
+        Crop indices of one of n_batches batches of consecutive crops, so that the crops of a grid can be
+        registered by independent tasks.
+
+        Args:
+            batch_index (int): Index of the batch, from 0 to n_batches - 1.
+            n_batches (int): Number of batches the crops are split into.
+
+        Returns:
+            list: The crop indices (row, column) of the batch, in the order of crop_indices.
+        """
+        if not 0 <= batch_index < n_batches:
+            raise ValueError(f"Batch index {batch_index} is out of range for {n_batches} batches.")
+
+        bounds = np.linspace(0, self.n_crops, n_batches + 1).round().astype(int)
+
+        return self.crop_indices[bounds[batch_index]:bounds[batch_index + 1]]
+
+    def area(self, idx):
+        """Area (start_row, end_row, start_col, end_col) of a crop in the padded image."""
+        row, col = idx[0], idx[1]
+        return (int(self.row_starts[row]), int(self.row_ends[row]), int(self.col_starts[col]), int(self.col_ends[col]))
+
+    def trim(self, idx):
+        """Region (start_row, end_row, start_col, end_col) of a crop kept after removing the overlap."""
+        row, col = idx[0], idx[1]
+        return (int(self.row_trims[row, 0]), int(self.row_trims[row, 1]), int(self.col_trims[col, 0]), int(self.col_trims[col, 1]))
+
+    def position(self, idx):
+        """Position (row, col) of a trimmed crop in the stitched image."""
+        return (int(self.row_offsets[idx[0]]), int(self.col_offsets[idx[1]]))
+
+    def to_dict(self):
+        return {
+            'shape': list(self.shape),
+            'crop_width_x': self.crop_width_x,
+            'crop_width_y': self.crop_width_y,
+            'overlap_x': self.overlap_x,
+            'overlap_y': self.overlap_y,
+            'row_starts': self.row_starts.tolist(),
+            'row_ends': self.row_ends.tolist(),
+            'col_starts': self.col_starts.tolist(),
+            'col_ends': self.col_ends.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, params):
+        return cls(params['shape'], params['crop_width_x'], params['crop_width_y'], params['overlap_x'], params['overlap_y'],
+                   row_positions=(params['row_starts'], params['row_ends']),
+                   col_positions=(params['col_starts'], params['col_ends']))
+
+    def save(self, path, key=None):
+        """Save the grid to a JSON manifest, recording its key when given (see get_grid_key)."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index = ArtifactIndex(os.path.dirname(path))
+        index.invalidate([path])
+        save_json(self.to_dict(), path)
+        if key is not None:
+            index.record(path, key)
+            index.flush()
+
+    @classmethod
+    def load(cls, path):
+        """Load a grid from a JSON manifest."""
+        return cls.from_dict(load_json(path))
+
+    def __eq__(self, other):
+        return isinstance(other, CropGrid) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return (f'CropGrid(shape={self.shape}, crop={self.crop_width_x}x{self.crop_width_y}, '
+                f'overlap={self.overlap_x}x{self.overlap_y}, crops={self.n_rows}x{self.n_cols})')
+
+"""
+Crop files
+"""
+
+def get_crop_filename(prefix, idx, ch=None):
+    """
+    Name of the file of a crop, generated from its index.
+
+    Args:
+        prefix (str): Kind of file, e.g. 'crop', 'affine_split', 'registered_split' or 'mapping'.
+        idx (tuple): Index (row, column) of the crop.
+        ch (int, optional): Channel of the crop. Files shared by all channels (mappings) have none.
+
+    Returns:
+        str: The filename.
+    """
+    if ch is None:
+        return f'{prefix}_{idx[0]}_{idx[1]}.pkl'
+
+    return f'{prefix}_{idx[0]}_{idx[1]}_{ch}.pkl'
+
+def get_crop_path(crops_dir, prefix, idx, ch=None):
+    """
+    Path of the file of a crop, generated from its index.
+
+    Args:
+        crops_dir (str): Directory of the crops.
+        prefix (str): Kind of file, e.g. 'crop', 'affine_split', 'registered_split' or 'mapping'.
+        idx (tuple): Index (row, column) of the crop.
+        ch (int, optional): Channel of the crop.
+
+    Returns:
+        str: The path.
+    """
+    return os.path.join(crops_dir, get_crop_filename(prefix, idx, ch))
+
+def get_grid_key(input_path, fixed_image_path, crop_width_x, crop_width_y, overlap_x, overlap_y, adaptive_overlap,
+                 crop, crop_size, n_features):
+    """
+    Key of the crop grid manifest of a moving image. An adaptive grid depends on the images, on the initial
+    crop parameters and on the affine transformation its overlap was estimated with.
+
+    Args:
+        input_path (str): Path to the moving image.
+        fixed_image_path (str): Path to the fixed image.
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Initial overlap between crops along the x-axis.
+        overlap_y (int): Initial overlap between crops along the y-axis.
+        adaptive_overlap (bool): Whether the overlap is estimated from the residual deformation.
+        crop (bool): Whether the affine mapping is computed on a smaller region.
+        crop_size (int): Size of the subregion for affine mapping.
+        n_features (int): Number of features used for the affine transformation.
+
+    Returns:
+        str: The key of the manifest.
+    """
+    return get_artifact_key('crop_grid', get_file_identity(input_path), get_file_identity(fixed_image_path),
+                            crop_width_x, crop_width_y, overlap_x, overlap_y, adaptive_overlap, crop, crop_size, n_features)
+
+def load_grid_manifest(manifest_path, key):
+    """
+    Load a crop grid from its manifest, if it was saved with the given key.
+
+    Args:
+        manifest_path (str): Path to the crop grid manifest.
+        key (str): Key expected from the current images and parameters, as returned by get_grid_key.
+
+    Returns:
+        CropGrid: The crop grid, or None if the manifest is missing or was saved for other images or parameters.
+    """
+    if not ArtifactIndex(os.path.dirname(manifest_path)).is_valid(manifest_path, key):
+        return None
+
+    return CropGrid.load(manifest_path)
+
+def load_crop_grid(manifest_path, input_path, fixed_image_path, crop_width_x, crop_width_y, overlap_x, overlap_y):
+    """
+    Load the crop grid of a moving image from its manifest, or create it from the crop parameters
+    when no manifest was saved.
+
+    Args:
+        manifest_path (str): Path to the crop grid manifest.
+        input_path (str): Path to the moving image.
+        fixed_image_path (str): Path to the fixed image.
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Overlap between crops along the x-axis.
+        overlap_y (int): Overlap between crops along the y-axis.
+
+    Returns:
+        CropGrid: The crop grid.
+    """
+    if os.path.exists(manifest_path):
+        return CropGrid.load(manifest_path)
+
+    return CropGrid.from_image_files(input_path, fixed_image_path, crop_width_x, crop_width_y, overlap_x, overlap_y)
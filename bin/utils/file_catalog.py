@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sqlite3
+import logging
+from . import logging_config
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+CATALOG_FILENAME = 'file_catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    stem TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    patient_id TEXT,
+    date TEXT
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_stem ON files (stem);
+CREATE INDEX IF NOT EXISTS files_patient_id ON files (patient_id);
+"""
+
+"""
+File attributes
+"""
+
+def remove_extensions(filename):
+    """Removes every extension of a filename, e.g. '.ome.tiff'."""
+    return re.sub(r'(\.\w+)+$', '', filename)
+
+def get_patient_id(filename):
+    """Patient id of an image, the prefix of its filename before the first underscore."""
+    return filename.split('_', 1)[0]
+
+def get_date(path):
+    """
+    Acquisition date of an image, read from its path.
+
+    Returns:
+        str: Date as YYYY-MM-DD, or None if the path has no date like '2024.08.30'.
+    """
+    match = re.search(r'\d{4}\.\d{2}\.\d{2}', path)
+    if match:
+        return match.group().replace('.', '-')
+    return None
+
+def get_subtree_range(directory):
+    """Bounds of the paths under a directory, so that they are selected from the primary key index."""
+    # '0' follows '/' in the ASCII table
+    return directory + '/', directory + '0'
+
+"""
+File catalog
+"""
+
+class FileCatalog:
+    """
+    Catalog of the files of the input and output trees, with their size, modification time, patient id
+    and date, stored in an SQLite database. It is updated incrementally: the files of a directory are only
+    listed again when its modification time changed, i.e. when files were added, removed or renamed in it,
+    and the subdirectories of unchanged directories are read from the catalog. Updating a tree therefore
+    costs one stat per directory instead of a walk listing and stating every file.
+
+    Files rewritten in place do not change the modification time of their directory, so their size and
+    modification time are only refreshed by a full update.
+
+    Attributes:
+        path (str): Path to the database.
+        conn (sqlite3.Connection): Connection to the database.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _remove_tree(self, directory):
+        """Removes a directory, its subdirectories and their files from the catalog."""
+        start, end = get_subtree_range(directory)
+        self.conn.execute('DELETE FROM files WHERE directory = ? OR (path >= ? AND path < ?)', (directory, start, end))
+        self.conn.execute('DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)', (directory, start, end))
+
+    def _scan_directory(self, directory, parent, mtime_ns):
+        """
+        Lists the files and subdirectories of a directory into the catalog.
+
+        Returns:
+            list: Paths to the subdirectories.
+        """
+        files, subdirectories = [], []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.path, directory, entry.name, remove_extensions(entry.name), stat.st_size,
+                                  stat.st_mtime_ns, get_patient_id(entry.name), get_date(entry.path)))
+
+        self.conn.execute('DELETE FROM files WHERE directory = ?', (directory,))
+        self.conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', files)
+
+        # Subdirectories removed since the last scan are removed with their content
+        known = {row[0] for row in self.conn.execute('SELECT path FROM directories WHERE parent = ?', (directory,))}
+        for removed in known - set(subdirectories):
+            self._remove_tree(removed)
+        self.conn.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)', (directory, parent, mtime_ns))
+
+        return subdirectories
+
+    def update(self, root, full=False):
+        """
+        Brings the catalog of a directory tree up to date.
+
+        Parameters:
+            root (str): Root directory of the tree.
+            full (bool, optional): List every directory and stat every file, even in unchanged directories.
+
+        Returns:
+            int: Number of directories listed again.
+        """
+        root = os.path.abspath(root)
+        mtimes = dict(self.conn.execute('SELECT path, mtime_ns FROM directories'))
+
+        n_scanned = 0
+        stack = [(root, None)]
+        with self.conn:
+            while stack:
+                directory, parent = stack.pop()
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except FileNotFoundError:
+                    self._remove_tree(directory)
+                    continue
+
+                if not full and mtimes.get(directory) == mtime_ns:
+                    subdirectories = [row[0] for row in self.conn.execute('SELECT path FROM directories WHERE parent = ?', (directory,))]
+                else:
+                    subdirectories = self._scan_directory(directory, parent, mtime_ns)
+                    n_scanned += 1
+                stack.extend((subdirectory, directory) for subdirectory in subdirectories)
+
+        logger.debug(f'File catalog of {root} updated, {n_scanned} directories listed again.')
+        return n_scanned
+
+    def _select(self, root, ext, columns):
+        """Selects columns of the files of a directory tree whose name ends with ext, from the path index."""
+        start, end = get_subtree_range(os.path.abspath(root))
+        query = f'SELECT {columns} FROM files WHERE path >= ? AND path < ?'
+        params = [start, end]
+        if ext:
+            query += ' AND substr(name, -?) = ?'
+            params += [len(ext), ext]
+
+        return self.conn.execute(query + ' ORDER BY path', params)
+
+    def _relative_to(self, root, path):
+        """Path of a cataloged file given the way its root was, e.g. relative to the working directory."""
+        return os.path.join(root, os.path.relpath(path, os.path.abspath(root)))
+
+    def list_files(self, root, ext=''):
+        """
+        Paths to the files of a directory tree, as of the last update.
+
+        Parameters:
+            root (str): Root directory of the tree.
+            ext (str, optional): Extension the filenames end with.
+
+        Returns:
+            list: Sorted paths, starting with root as it was given.
+        """
+        return [self._relative_to(root, path) for path, in self._select(root, ext, 'path')]
+
+    def get_files(self, root, ext=''):
+        """
+        Files of a directory tree and their attributes, as of the last update.
+
+        Parameters:
+            root (str): Root directory of the tree.
+            ext (str, optional): Extension the filenames end with.
+
+        Returns:
+            list: Dictionaries with the path, stem, size, modification time, patient id and date of each file.
+        """
+        return [
+            {'path': self._relative_to(root, path), 'stem': stem, 'size': size, 'mtime_ns': mtime_ns,
+             'patient_id': patient_id, 'date': date}
+            for path, stem, size, mtime_ns, patient_id, date in self._select(root, ext, 'path, stem, size, mtime_ns, patient_id, date')
+        ]
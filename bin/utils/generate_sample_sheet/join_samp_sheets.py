@@ -4,51 +4,48 @@ import sys
 import os 
 # Add the parent directory of the current script to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'utils')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 
 import pandas as pd
 import argparse
-import datetime
 import os
-from functools import reduce
+from utils.sample_store import SampleStore, SAMPLE_SHEET_STAGES
 
-def main(args):
-    # Create path to backup file
-    filename = os.path.basename(args.export_path)
-    formatted_datetime = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    sample_sheet_backup_path = os.path.join(args.backup_dir, formatted_datetime + '_' + filename)
-
-    # Merge sample sheets
-    samp_sheets = [pd.read_csv(path) for path in args.samp_sheets_paths]
+def export_samp_sheet(store, key_col_name, sample_ids=None):
+    """
+    Sample sheet of the samples of the store, keyed by key_col_name. Each status column is done when one of
+    its stages is, and the durations and output keys of the stages are kept.
+    """
+    stages = sorted({stage for column_stages in SAMPLE_SHEET_STAGES.values() for stage in column_stages})
+    samp_sheet = pd.DataFrame(store.export(stages, sample_ids)).rename(columns={'sample_id': key_col_name})
+    for column, column_stages in SAMPLE_SHEET_STAGES.items():
+        samp_sheet[column] = samp_sheet[list(column_stages)].any(axis=1)
+    samp_sheet = samp_sheet.drop(columns=stages)
 
-    for idx, df in enumerate(samp_sheets):
-        if idx > 0:
-            samp_sheets[idx] = df.drop([df.columns[0]], axis=1)
+    return samp_sheet[[key_col_name, *samp_sheet.columns.drop(key_col_name)]]
 
-    key = samp_sheets[0].columns[4]
-    samp_sheets_joined = reduce(lambda left, right: pd.merge(left, right, on=key, how='left'), samp_sheets)
-    samp_sheets_joined = samp_sheets_joined.drop(columns=key)
-
-    # Export full sample sheet and backup to csv
-    samp_sheets_joined.to_csv(args.export_path, index=False)
-    samp_sheets_joined.to_csv(sample_sheet_backup_path, index=False)
+def main(args):
+    # The store is the state of the samples, and sample sheets are views of it
+    with SampleStore(args.store_path or os.path.join(os.path.dirname(args.export_path), 'sample_store.sqlite')) as store:
+        for path in args.samp_sheets_paths:
+            samp_sheet = pd.read_csv(path)
+            samp_sheet = samp_sheet.loc[:, ~samp_sheet.columns.str.startswith('Unnamed')]
+            # Status columns found from the output files only seed the states of the stages of new samples
+            store.add_samples(samp_sheet.to_dict('records'), args.key_col_name, 
+                              {column: stages[0] for column, stages in SAMPLE_SHEET_STAGES.items() if column in samp_sheet.columns})
 
-    # Export filtered sample sheet
-    if args.filter_pending:
-        ref_colname = 'output_path_conv'
-        samp_sheet_filtered = samp_sheets_joined[
-            (
-                (samp_sheets_joined['converted'] == False) | 
-                (samp_sheets_joined['registered_1'] == False) | 
-                (samp_sheets_joined['registered_1'] == '') |
-                (samp_sheets_joined['registered_2'] == False) | 
-                (samp_sheets_joined['registered_2'] == '')
-            )
-        ]
+        # Export full sample sheet
+        samp_sheets_joined = export_samp_sheet(store, args.key_col_name)
+        samp_sheets_joined.to_csv(args.export_path, index=False)
 
-        samp_sheet_filtered = samp_sheet_filtered.copy()
-        samp_sheet_filtered['fixed_image'] = samp_sheet_filtered[ref_colname] == samp_sheet_filtered['fixed_image_path']
+        # Export filtered sample sheet
+        if args.filter_pending:
+            ref_colname = 'output_path_conv'
+            samp_sheet_filtered = export_samp_sheet(store, args.key_col_name, store.get_pending(list(SAMPLE_SHEET_STAGES.values())))
+            samp_sheet_filtered = samp_sheet_filtered.reindex(columns=samp_sheets_joined.columns)
+            samp_sheet_filtered['fixed_image'] = samp_sheet_filtered[ref_colname] == samp_sheet_filtered['fixed_image_path']
 
-        samp_sheet_filtered.to_csv(args.export_path_filtered, index=False)
+            samp_sheet_filtered.to_csv(args.export_path_filtered, index=False)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -62,7 +59,8 @@ if __name__ == '__main__':
                         help='Path where the full sample sheet will be saved.')
     parser.add_argument('--export-path-filtered', type=str, required=True, 
                         help='Path where the filtered sample sheet will be saved.')
-    parser.add_argument('--backup-dir', type=str, required=True, 
-                        help='Path to directory where sample sheet backups will be saved')
+    parser.add_argument('--store-path', type=str,
+                        help='Path to the SQLite store of the state of the samples, where the pipeline records its stages (state_store parameter). '
+                             'Defaults to sample_store.sqlite next to the exported sample sheet.')
     args = parser.parse_args()
     main(args)
\ No newline at end of file
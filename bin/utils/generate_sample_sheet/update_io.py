@@ -4,8 +4,10 @@ import sys
 import os
 # Add the parent directory of the current script to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'utils')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
 # import utils.logging_config as logging_config
 import logging_config
+from utils.file_catalog import FileCatalog, CATALOG_FILENAME
 
 import os
 import re
@@ -91,7 +93,7 @@ def get_base_directory_and_file(path):
     file_name = os.path.basename(path)
     return os.path.join(dir_name, file_name)
 
-def generate_sample_sheet(input_dir:str, output_dir:str, input_ext:str, output_ext:str):
+def generate_sample_sheet(input_dir:str, output_dir:str, input_ext:str, output_ext:str, catalog:FileCatalog=None):
     """
     Generate a sample sheet with input and output paths.
 
@@ -100,6 +102,8 @@ def generate_sample_sheet(input_dir:str, output_dir:str, input_ext:str, output_e
         output_dir (str): The directory to store output files.
         input_ext (str): The extension of the input files.
         output_ext (str): The extension of the output files.
+        catalog (FileCatalog, optional): Up to date catalog of the input and output directories. The directories
+                                         are walked if None.
     Returns:
         pd.DataFrame: The generated sample sheet.
     """
@@ -115,7 +119,12 @@ def generate_sample_sheet(input_dir:str, output_dir:str, input_ext:str, output_e
     def remove_extension(filename):
         return re.sub(r'(\.\w+)+$', '', filename)
     
-    input_paths = [path for path in list_files(input_dir) if path.endswith(input_ext)]
+    if catalog is not None:
+        input_paths = catalog.list_files(input_dir, input_ext)
+        output_paths = {os.path.normpath(path) for path in catalog.list_files(output_dir)}
+    else:
+        input_paths = [path for path in list_files(input_dir) if path.endswith(input_ext)]
+        output_paths = {os.path.normpath(path) for path in list_files(output_dir)}
     patient_ids = [os.path.basename(path).split('_', 1)[0] for path in input_paths]
 
     if input_paths:
@@ -123,7 +132,7 @@ def generate_sample_sheet(input_dir:str, output_dir:str, input_ext:str, output_e
         sample_sheet['base_dir'] = sample_sheet['input_path'].apply(get_base_directory_and_file)
         sample_sheet['output_path'] = sample_sheet['base_dir'].apply(join_path)
         sample_sheet['output_path'] = sample_sheet['output_path'].apply(remove_extension) + output_ext
-        sample_sheet['processed'] = sample_sheet['output_path'].apply(lambda x: os.path.exists(x))
+        sample_sheet['processed'] = sample_sheet['output_path'].apply(os.path.normpath).isin(output_paths)
         sample_sheet['filename'] = sample_sheet['output_path'].apply(remove_extension).apply(os.path.basename)
         sample_sheet = sample_sheet.drop(columns=['base_dir'])
         logger.debug('Sample sheet generated successfully.')
@@ -152,32 +161,36 @@ def main(args):
     formatted_datetime = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     sample_sheet_backup_path = os.path.join(args.backup_dir, formatted_datetime + '_' + os.path.basename(args.export_path))
     
+    # Only the directories changed since the last run are listed again
+    catalog = FileCatalog(args.catalog_path or os.path.join(args.logs_dir, 'io', CATALOG_FILENAME))
+    for directory in (args.input_dir, args.output_dir):
+        catalog.update(directory, full=args.full_rescan)
+
     # Check that all files in output directory have a correspondence in the input directory
-    input_files = [path for path in list_files(args.input_dir) if path.endswith(args.input_ext)]
-    output_files = [path for path in list_files(args.output_dir) if path.endswith(args.output_ext)]
-    input_filenames = [os.path.basename(re.sub(r'(\.\w+)+$', '', file)) for file in input_files if input_files]
-    output_filenames = [os.path.basename(re.sub(r'(\.\w+)+$', '', file) )for file in output_files if output_files]
-    
-    if output_filenames:
-        for filename, file_path in zip(output_filenames, output_files):
-            if filename not in input_filenames:
-                logger.warning(f'Output file "{file_path}": no correspondence found in input directory.')
+    input_files = catalog.get_files(args.input_dir, args.input_ext)
+    output_files = catalog.get_files(args.output_dir, args.output_ext)
+    input_filenames = {file['stem'] for file in input_files}
+
+    for file in output_files:
+        if file['stem'] not in input_filenames:
+            logger.warning(f'Output file "{file["path"]}": no correspondence found in input directory.')
 
     if os.path.exists(args.export_path):
         sample_sheet = pd.read_csv(args.export_path)
         # Check that all output files are in log
-        if output_files:
-            for element in output_files:
-                if element not in list(sample_sheet[args.colnames[2]]):
-                    logger.warning(f'Output file "{element}" not found in output files log.')
+        logged_output_files = set(sample_sheet[args.colnames[2]])
+        for file in output_files:
+            if file['path'] not in logged_output_files:
+                logger.warning(f'Output file "{file["path"]}" not found in output files log.')
 
         # Check that all logged input files exist
-        input_files = list_files(args.input_dir)
-        for element in list(sample_sheet[args.colnames[1]]):
-            if element not in input_files:
+        existing_input_files = set(catalog.list_files(args.input_dir))
+        for element in sample_sheet[args.colnames[1]]:
+            if element not in existing_input_files:
                 logger.warning(f'Input file "{element}" not found in input directory.')
     
-    sample_sheet = generate_sample_sheet(args.input_dir, args.output_dir, args.input_ext, args.output_ext)
+    sample_sheet = generate_sample_sheet(args.input_dir, args.output_dir, args.input_ext, args.output_ext, catalog)
+    catalog.close()
 
     if not sample_sheet.empty:
         if args.colnames:
@@ -228,6 +241,10 @@ if __name__ == '__main__':
                         help='Path where to save the sample sheet.')
     parser.add_argument('--make-dirs', action='store_true',
                         help='Path where to save the sample sheet.')
+    parser.add_argument('--catalog-path', type=str,
+                        help='Path to the SQLite catalog of the input and output files, updated incrementally. Defaults to <logs-dir>/io/file_catalog.sqlite.')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='List every directory of the catalog again, to refresh files rewritten in place.')
     
     args = parser.parse_args()
     main(args)
\ No newline at end of file
@@ -7,7 +7,10 @@ import tifffile
 import nd2
 import h5py
 import numpy as np
-from .io_tools import load_pickle, save_pickle, load_h5
+from .io_tools import save_pickle, load_h5, load_h5_channel
+from .shared_memory import create_shared_array
+from .artifact_index import ArtifactIndex, get_crop_key, get_file_identity
+from .profiling import span
 from . import logging_config 
 
 logging_config.setup_logging()
@@ -203,8 +206,11 @@ def load_h5_region(file_path, loading_region):
     """
 
     start_row, end_row, start_col, end_col = loading_region
-    with h5py.File(file_path, 'r') as f:
-        return f['dataset'][start_col:end_col, start_row:end_row]
+    with span('load_h5_region', 'io', path=file_path) as io_span, h5py.File(file_path, 'r') as f:
+        region = f['dataset'][start_col:end_col, start_row:end_row]
+        io_span.set(bytes=region.nbytes)
+
+    return region
 
 def get_image_file_shape(path, format='.h5'):
     """
@@ -266,205 +272,162 @@ def zero_pad_array(array, target_shape):
     """
     arr_shape = array.shape
 
-    print(f"ARRAY SHAPE: {arr_shape}")
-    print(f"TARGET SHAPE: {target_shape}")
-
     # Only pad if necessary
     if arr_shape != target_shape:
         # Calculate the padding width for each dimension
         pad_width = [(0, target_shape[i] - arr_shape[i]) for i in range(len(arr_shape))]
-        print(f"PAD WIDTH: {pad_width}")
         # Apply zero padding
         array = np.pad(array, pad_width, mode='constant')
     
     return array
 
-def crop_image_channels(input_path, fixed_image_path, current_crops_dir, crop_width_x, crop_width_y, overlap_x, overlap_y, which_crop='fixed'):
+def binarize_image(image, thresh=None, alpha=1.5):
+    if thresh == None:
+        thresh = np.mean(image)
+    return (image > thresh * alpha).astype('int8')
+
+def get_dense_crop(input_path, fixed_image_path, crop_areas, nonzero_thresh=0.15, fixed_channel=None):
     """
-    Crops both the moving and fixed images and saves the crops to directories.
+    Loads and pads image crops, ensuring minimal zero-valued pixels in the moving image.
     
     Args:
         input_path (str): Path to the moving image.
         fixed_image_path (str): Path to the fixed image.
-        current_crops_dir (str): Directory where the image crops will be saved.
-        crop_width_x (int): Width of each crop.
-        crop_width_y (int): Height of each crop.
-        overlap_x (int): Overlap between crops along the x-axis.
-        overlap_y (int): Overlap between crops along the y-axis.
-        which_crop (str): Which image to crop. Either 'fixed' or 'moving'.
-        
+        crop_areas (list): List of areas to crop from the input images.
+        fixed_channel (np.ndarray, optional): DAPI channel of the fixed image, already loaded. Its regions are
+                                              cropped from it instead of being read from fixed_image_path.
+    
     Returns:
-        tuple: Directories for fixed image crops and moving image crops. The saved arrays have shape (height, width, n_channels).
+        tuple: Fixed crop and moving crop arrays after padding.
     """
-    # Define image to be loaded
-    if which_crop == 'fixed':
-        path_to_load = fixed_image_path
-    if which_crop == 'moving':
-        path_to_load = input_path
+    for area in crop_areas:
+        # Load specific region of the images for comparison
+        moving_crop = load_h5_region(input_path, area)
+
+        # Select DAPI channel (channel 2)
+        moving_crop = np.squeeze(moving_crop[:, :, 2])
+        if fixed_channel is not None:
+            fixed_crop = crop_2d_array(fixed_channel, crop_areas=area)
+        else:
+            fixed_crop = np.squeeze(load_h5_region(fixed_image_path, area)[:, :, 2])
+
+        # Pad the crops if needed
+        moving_shape = moving_crop.shape
+        fixed_shape = fixed_crop.shape
+        padding_shape = get_padding_shape(moving_shape, fixed_shape)
+        moving_crop = zero_pad_array(moving_crop, padding_shape)
+        fixed_crop = zero_pad_array(fixed_crop, padding_shape)
+        nonzero_prop = np.mean(binarize_image(moving_crop))
+        
+        # Stop cropping if sufficient non-zero pixels are found
+        if nonzero_prop >= nonzero_thresh:
+            break
 
-    # Get image shapes and compute padding
-    mov_shape = get_image_file_shape(input_path)  # Shape of moving image
-    fixed_shape = get_image_file_shape(fixed_image_path)  # Shape of fixed image
-    padding_shape = get_padding_shape(mov_shape, fixed_shape)  # Calculate padding shape
+    return fixed_crop, moving_crop
 
-    # Compute crop areas
-    crop_areas = get_crop_areas(shape=padding_shape, crop_width_x=crop_width_x, crop_width_y=crop_width_y, overlap_x=overlap_x, overlap_y=overlap_y)
+def crop_image_channels(path, grid, current_crops_dir, crop_indices=None):
+    """
+    Crops an image along a crop grid and saves each channel of each crop to a directory. Crops recorded in 
+    the artifact index of the directory for the same image and crop area are not cropped again.
+    
+    Args:
+        path (str): Path to the image.
+        grid (CropGrid): Crop grid of the image, defining the padding shape and crop areas.
+        current_crops_dir (str): Directory where the image crops will be saved.
+        crop_indices (list, optional): Indices (row, column) of the crops to save. Defaults to every crop of the grid.
+        
+    Returns:
+        None. The saved crops have shape (height, width) and are named after their (row, column, channel) index.
+    """
+    # Imported when needed, as crop_grid builds on this module
+    from .crop_grid import get_crop_path
 
     # Pre-allocate the array to hold the padded images
     n_channels = 3  # Number of channels in the image
-    if not os.path.exists(current_crops_dir):
+    crop_indices = grid.crop_indices if crop_indices is None else crop_indices
+    artifact_index = ArtifactIndex(current_crops_dir)
+    image_identity = get_file_identity(path)
+    keys = {
+        (idx, ch): get_crop_key(image_identity, grid.area(idx), ch) for idx in crop_indices for ch in range(n_channels)
+    }
+    missing_crops = {
+        (idx, ch) for (idx, ch), key in keys.items()
+        if not artifact_index.is_valid(get_crop_path(current_crops_dir, 'crop', idx, ch), key)
+    }
+
+    if missing_crops:
         os.makedirs(current_crops_dir, exist_ok=True)
-        # Fixed image: load, pad to size and crop
-        logger.debug(f"Loading image {path_to_load}")
-        image = load_h5(path_to_load)
+        artifact_index.invalidate([get_crop_path(current_crops_dir, 'crop', idx, ch) for idx, ch in missing_crops])
+        # Load the image, pad to size and crop
+        logger.debug(f"Loading image {path}")
+        image = load_h5(path)
         # Loop through each channel and apply padding
         for ch in range(n_channels):
-            # Read the fixed image and select the current channel
-            for index, area in zip(crop_areas[0], crop_areas[1]):
+            channel = zero_pad_array(np.squeeze(image[:,:,ch]), grid.shape)
+            for index in crop_indices:
+                if (index, ch) not in missing_crops:
+                    continue
                 logger.debug(f'Processing crop_{index[0]}_{index[1]}_{ch}')
         
-                # Crop the image using the specified crop area
-                crop = (
-                    index + (ch,), 
-                    crop_2d_array(zero_pad_array(np.squeeze(image[:,:,ch]), padding_shape), crop_areas=area)
-                )
+                # Crop the image using the crop area of the grid
+                crop = (index + (ch,), crop_2d_array(channel, crop_areas=grid.area(index)))
 
                 # Save each crop individually with a unique name
-                crop_save_path = os.path.join(current_crops_dir, f'crop_{index[0]}_{index[1]}_{ch}.pkl')
+                crop_save_path = get_crop_path(current_crops_dir, 'crop', index, ch)
                 save_pickle(crop, crop_save_path)  # Save the crop using pickle
+                artifact_index.record(crop_save_path, keys[(index, ch)])
                 
                 logger.debug(f'Saved crop_{index[0]}_{index[1]}_{ch} to {crop_save_path}')
                 del crop
                 gc.collect()
 
+            # Record the crops of each channel, so that an interrupted run keeps them
+            artifact_index.flush()
+            del channel
+            gc.collect()
+
         del image  # Delete the array to free up memory
         gc.collect()  # Force garbage collection
 
-"""
-Overlap removal
-"""
-
-import itertools
-from utils.misc import get_indexed_filepaths
-from concurrent.futures import ProcessPoolExecutor
-
-def remove_overlap(crop, indices: list, overlap: int, axis: int = 0):
+def crop_image_channels_shared(path, grid, channels=(0, 1, 2)):
     """
-    Remove overlapping regions from adjacent crops along a specified axis.
+    Crops the selected channels of an image into shared memory blocks, one block per crop.
 
     Args:
-        crops (list): List of tuples where each tuple contains an index and a 2D numpy array.
-                      The index tuple consists of (row, column, image channel).
-        overlap (int): Size of overlap between adjacent crops.
-        axis (int): Axis along which to remove the overlap:
-                    - 0 for rows
-                    - 1 for columns
+        path (str): Path to the image.
+        grid (CropGrid): Crop grid of the image, defining the padding shape and crop areas.
+        channels (iterable): Channels to crop.
 
     Returns:
-        list: List of tuples containing the adjusted crops without overlaps.
+        dict: Maps each crop index (row, column, channel) to a tuple (shared memory block, crop array, descriptor).
     """
-    overlap_half_left = overlap // 2
-    overlap_half_right = overlap - overlap_half_left
-
-    idx, crop = crop[0], crop[1]
+    crops = {}
+    for ch in channels:
+        logger.debug(f"Loading channel {ch} of image {path}")
+        channel = load_h5_channel(path, ch)
+        crops.update(crop_channel_shared(channel, grid, ch))
 
-    max_rows = max(idx[0] for idx in indices)
-    max_cols = max(idx[1] for idx in indices)
+        del channel
+        gc.collect()
 
-    # Sort crops by row and then by column
-    indices = sorted(indices, key=lambda x: (x[0], x[1]))
+    return crops
 
-    start_row, end_row, start_col, end_col = 0, crop.shape[0], 0, crop.shape[1]
-
-    # Handle row overlap
-    if axis == 0:
-        if idx[0] != 0:  # If not the first crop in the row
-            start_row += overlap_half_left
-        if idx[0] != max_rows:  # If not the last crop in the row
-            end_row -= overlap_half_right
-
-    # Handle column overlap
-    elif axis == 1:
-        if idx[1] != 0:  # If not the first crop in the column
-            start_col += overlap_half_left
-        if idx[1] != max_cols:  # If not the last crop in the column
-            end_col -= overlap_half_right
-
-    # Extract the crop area without overlap
-    crop = crop[start_row:end_row, start_col:end_col]
-    
-    return (idx, crop)
-
-def get_stitching_positions(shapes: list):
+def crop_channel_shared(channel, grid, ch):
     """
-    Calculate the positions where each cropped image will be placed in the final stitched image.
+    Pads a loaded channel of an image to the shape of a crop grid and crops it into shared memory blocks.
 
     Args:
-        crops (list): List of tuples where each tuple contains an index and a 2D numpy array 
-                      representing the cropped image. The index tuple consists of (row, column, image channel).
+        channel (np.ndarray): Channel of the image, of shape (height, width).
+        grid (CropGrid): Crop grid of the image, defining the padding shape and crop areas.
+        ch (int): Index of the channel, used in the crop indices.
 
     Returns:
-        list: A list of (row, col) positions where each crop will be placed in the final stitched image.
+        dict: Maps each crop index (row, column, channel) to a tuple (shared memory block, crop array, descriptor).
     """
-    # Determine the number of crop rows and columns
-    n_crop_rows = np.max([element[0][0] for element in shapes]) + 2
-    n_crop_cols = np.max([element[0][1] for element in shapes]) + 2
-
-    # Calculate row stitching positions
-    sorted_shapes = sorted(shapes, key=lambda x: x[0][1])
-    if n_crop_rows - 1 > 1:
-        crops_rows = [shape[0] for idx, shape in sorted_shapes][:n_crop_rows - 2]
-    else:
-        crops_rows = [shape[0] for idx, shape in sorted_shapes][:n_crop_rows - 1]
-
-    crops_rows = np.insert(crops_rows, 0, 0)
-    stitching_positions_h = np.cumsum(crops_rows)
-
-    # Calculate column stitching positions
-    sorted_shapes = sorted(shapes, key=lambda x: x[0][0])
-    if n_crop_cols - 1 > 1:
-        crops_cols = [shape[1] for idx, shape in sorted_shapes][:n_crop_cols - 2]
-    else:
-        crops_cols = [shape[1] for idx, shape in sorted_shapes][:n_crop_cols - 1]
-
-    crops_cols = np.insert(crops_cols, 0, 0)
-    stitching_positions_v = np.cumsum(crops_cols)
+    crops = {}
+    channel = zero_pad_array(channel, grid.shape)
+    for index in grid.crop_indices:
+        crop = crop_2d_array(channel, crop_areas=grid.area(index))
+        crops[index + (ch,)] = create_shared_array(crop.shape, crop.dtype, crop)
 
-    # Generate stitching positions
-    stitching_positions = list(itertools.product(stitching_positions_h, stitching_positions_v))
-
-    return stitching_positions
-
-def process_crop(path, indices, overlap_x, overlap_y, checkpoint_dir):
-    crop = load_pickle(path)
-    # Assuming 'indices' are defined or passed as arguments if necessary
-    crop = remove_overlap(crop, indices, overlap_x, 0)
-    crop = remove_overlap(crop, indices, overlap_y, 1)
-    checkpoint_path = os.path.join(checkpoint_dir, f'crop_{crop[0][0]}_{crop[0][1]}_{crop[0][2]}.pkl')
-    shape_info = (crop[0], crop[1].shape)
-    save_pickle(crop, checkpoint_path)
-    return shape_info
-
-def remove_crops_overlap(registered_crops_dir, checkpoint_dir, overlap_x, overlap_y, max_workers):
-    n_channels = 3
-    crops_paths = get_indexed_filepaths(registered_crops_dir)
-    
-    # List to store the resulting shapes for stitching
-    shapes = []
-    
-    # Create a ProcessPoolExecutor to parallelize crop processing
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for ch in range(n_channels):
-            indices = [path[0] for path in crops_paths if path[0][2] == ch]
-            paths = [path[1] for path in crops_paths if path[0][2] == ch]
-            for path in paths:
-                # Submit the crop processing to the pool
-                futures.append(executor.submit(process_crop, path, indices, overlap_x, overlap_y, checkpoint_dir))
-        
-        # Collect the results as they complete
-        for future in futures:
-            shapes.append(future.result())
-    
-    positions = get_stitching_positions(shapes)
-    return positions
+    return crops
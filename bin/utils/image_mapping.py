@@ -1,26 +1,159 @@
 #!/usr/bin/env python
 
 # Import necessary libraries
+import os
 import cv2
 import numpy as np
 import logging
 from . import logging_config
-from dipy.align.imwarp import SymmetricDiffeomorphicRegistration
-from dipy.align.metrics import CCMetric
+from .io_tools import load_pickle, save_pickle
+from dipy.align import floating
+from dipy.align.imwarp import SymmetricDiffeomorphicRegistration, DiffeomorphicMap, get_direction_and_spacings
+from dipy.align.metrics import CCMetric, SSDMetric, EMMetric
+from dipy.align.scalespace import ScaleSpace
 
 # Set up logging configuration
 logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
-def compute_diffeomorphic_mapping_dipy(y: np.ndarray, x: np.ndarray, sigma_diff=5, radius=4):
+# Maximum number of iterations at each level of the diffeomorphic registration, from coarse to fine
+DEFAULT_LEVEL_ITERS = [100, 100, 25]
+
+class CachedStaticSymmetricDiffeomorphicRegistration(SymmetricDiffeomorphicRegistration):
+    """
+    Symmetric diffeomorphic registration that reuses a precomputed scale space of the static image.
+
+    The scale space of the static image only depends on the static image, the number of levels and the 
+    smoothing factor, so it can be computed once per fixed crop and shared by all the moving images 
+    registered against it. The metric gradients are computed on the images warped at each iteration and 
+    are therefore still computed by the optimizer.
+    """
+    def __init__(self, metric, static_scale_space=None, **kwargs):
+        super().__init__(metric, **kwargs)
+        self.static_scale_space = static_scale_space
+
+    def _init_optimizer(self, static, moving, static_grid2world, moving_grid2world, prealign):
+        if self.static_scale_space is None:
+            return super()._init_optimizer(static, moving, static_grid2world, moving_grid2world, prealign)
+
+        if self.static_scale_space.num_levels != self.levels:
+            raise ValueError("The cached static scale space does not match the number of optimization levels.")
+
+        self._connect_functions()
+        static_direction, _ = get_direction_and_spacings(static_grid2world, self.dim)
+        moving_direction, moving_spacing = get_direction_and_spacings(moving_grid2world, self.dim)
+
+        # The images' directions don't change with scale
+        self.static_direction = np.eye(self.dim + 1)
+        self.moving_direction = np.eye(self.dim + 1)
+        self.static_direction[:self.dim, :self.dim] = static_direction
+        self.moving_direction[:self.dim, :self.dim] = moving_direction
+
+        # Only the scale space of the moving image needs to be built
+        self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
+                                    moving_spacing, self.ss_sigma_factor, self.mask0)
+        self.static_ss = self.static_scale_space
+
+        # The coarsest level of the static image is the reference discretization
+        disp_shape = self.static_ss.get_domain_shape(self.levels - 1)
+        disp_grid2world = self.static_ss.get_affine(self.levels - 1)
+
+        self.static_to_ref = DiffeomorphicMap(self.dim, disp_shape, disp_grid2world,
+                                              static.shape, static_grid2world,
+                                              static.shape, static_grid2world, None)
+        self.static_to_ref.allocate()
+
+        prealign_inv = None if prealign is None else np.linalg.inv(prealign)
+        self.moving_to_ref = DiffeomorphicMap(self.dim, disp_shape, disp_grid2world,
+                                              moving.shape, moving_grid2world,
+                                              static.shape, static_grid2world, prealign_inv)
+        self.moving_to_ref.allocate()
+
+def compute_static_scale_space(y: np.ndarray, levels=3, ss_sigma_factor=0.2):
+    """
+    Compute the scale space of a reference image, as built by the DIPY diffeomorphic optimizer.
+
+    Parameters:
+        y (ndarray): Reference image.
+        levels (int, optional): Number of levels of the scale space. Default is 3.
+        ss_sigma_factor (float, optional): Smoothing factor of the scale space. Default is 0.2.
+
+    Returns:
+        ScaleSpace: The scale space of the reference image.
+    """
+    return ScaleSpace(y.astype(floating), levels, None, np.ones(y.ndim), ss_sigma_factor, False)
+
+def load_static_scale_space(y: np.ndarray, cache_path=None, levels=3, ss_sigma_factor=0.2, reuse=True):
+    """
+    Load the scale space of a reference image from the cache, computing and caching it if missing.
+
+    Parameters:
+        y (ndarray): Reference image.
+        cache_path (str, optional): Path of the cached scale space. Nothing is cached if None.
+        levels (int, optional): Number of levels of the scale space. Default is 3.
+        ss_sigma_factor (float, optional): Smoothing factor of the scale space. Default is 0.2.
+        reuse (bool, optional): Whether the cached scale space may be loaded. It is recomputed and cached again 
+                                otherwise, e.g. when it was cached for another reference image.
+
+    Returns:
+        ScaleSpace: The scale space of the reference image.
+    """
+    if reuse and cache_path is not None and os.path.exists(cache_path):
+        scale_space = load_pickle(cache_path)
+        # Scale spaces cached for another level schedule are recomputed
+        if scale_space.num_levels == levels:
+            return scale_space
+
+    scale_space = compute_static_scale_space(y, levels, ss_sigma_factor)
+
+    if cache_path is not None:
+        # Write to a temporary file first, so that concurrent registrations never read a partial cache
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        save_pickle(scale_space, tmp_path)
+        os.replace(tmp_path, cache_path)
+        logger.debug(f"Cached static scale space to {cache_path}")
+
+    return scale_space
+
+def get_diffeomorphic_metric(metric='cc', sigma_diff=5, radius=4):
+    """
+    Create the similarity metric of the DIPY diffeomorphic registration.
+
+    Parameters:
+        metric (str, optional): Either 'cc' (cross-correlation), 'ssd' (sum of squared differences) or 
+                                'em' (expectation-maximization). Default is 'cc'.
+        sigma_diff (int, optional): Standard deviation of the smoothing of the CCMetric gradient. Default is 5.
+        radius (int, optional): Radius of the CCMetric neighborhood. Default is 4.
+
+    Returns:
+        SimilarityMetric: The DIPY metric.
+    """
+    if metric == 'cc':
+        return CCMetric(2, sigma_diff=sigma_diff, radius=radius)
+    elif metric == 'ssd':
+        return SSDMetric(2)
+    elif metric == 'em':
+        return EMMetric(2)
+    else:
+        raise ValueError("Invalid metric specified. Choose either 'cc', 'ssd' or 'em'.")
+
+def compute_diffeomorphic_mapping_dipy(y: np.ndarray, x: np.ndarray, sigma_diff=5, radius=4, static_scale_space=None,
+                                       level_iters=None, opt_tol=1e-03, inv_tol=0.1, metric='cc', telemetry=None):
     """
     Compute diffeomorphic mapping using DIPY.
     
     Parameters:
         y (ndarray): Reference image.
         x (ndarray): Moving image to be registered.
-        sigma_diff (int, optional): Standard deviation for the CCMetric. Default is 20.
-        radius (int, optional): Radius for the CCMetric. Default is 20.
+        sigma_diff (int, optional): Standard deviation for the CCMetric. Default is 5.
+        radius (int, optional): Radius for the CCMetric. Default is 4.
+        static_scale_space (ScaleSpace, optional): Precomputed scale space of the reference image.
+        level_iters (list, optional): Maximum number of iterations at each level, from coarse to fine. 
+                                      Default is DEFAULT_LEVEL_ITERS.
+        opt_tol (float, optional): Tolerance on the energy derivative to stop the iterations of a level. Default is 1e-03.
+        inv_tol (float, optional): Tolerance of the inversion of the displacement fields. Default is 0.1.
+        metric (str, optional): Similarity metric, either 'cc', 'ssd' or 'em'. Default is 'cc'.
+        telemetry (RegistrationTelemetry, optional): Callback recording the convergence of the optimization.
 
     Returns:
         mapping: A mapping object containing the transformation information.
@@ -29,15 +162,59 @@ def compute_diffeomorphic_mapping_dipy(y: np.ndarray, x: np.ndarray, sigma_diff=
     if y.shape != x.shape:
         raise ValueError("Reference image (y) and moving image (x) must have the same shape.")
 
+    if level_iters is None:
+        level_iters = DEFAULT_LEVEL_ITERS
+
     # Define the metric and create the Symmetric Diffeomorphic Registration object
-    metric = CCMetric(2, sigma_diff=sigma_diff, radius=radius)
-    sdr = SymmetricDiffeomorphicRegistration(metric, opt_tol=1e-03, inv_tol=0.1)
+    metric = get_diffeomorphic_metric(metric, sigma_diff=sigma_diff, radius=radius)
+    sdr = CachedStaticSymmetricDiffeomorphicRegistration(metric, static_scale_space=static_scale_space, level_iters=list(level_iters),
+                                                         opt_tol=opt_tol, inv_tol=inv_tol, callback=telemetry)
 
     # Perform the diffeomorphic registration using the pre-alignment from affine registration
     mapping = sdr.optimize(y, x)
 
     return mapping
 
+def compute_similarity(y: np.ndarray, x: np.ndarray, metric='ncc', downsample=4, bins=32):
+    """
+    Compute a fast similarity score between two images on a downsampled grid.
+
+    Parameters:
+        y (ndarray): Reference image.
+        x (ndarray): Moving image.
+        metric (str, optional): Either 'ncc' (normalized cross-correlation) or 'mi' (mutual information 
+                                normalized by the mean entropy of the images). Default is 'ncc'.
+        downsample (int, optional): Keep one pixel every 'downsample' pixels along each axis. Default is 4.
+        bins (int, optional): Number of histogram bins used for mutual information. Default is 32.
+
+    Returns:
+        float: Similarity score, at most 1 for identical images.
+    """
+    # Validate the metric parameter
+    if metric not in ['ncc', 'mi']:
+        raise ValueError("Invalid metric specified. Choose either 'ncc' or 'mi'.")
+
+    y = y[::downsample, ::downsample].astype(np.float64).ravel()
+    x = x[::downsample, ::downsample].astype(np.float64).ravel()
+
+    if metric == 'ncc':
+        y = y - y.mean()
+        x = x - x.mean()
+        denominator = np.sqrt(np.dot(y, y) * np.dot(x, x))
+        return float(np.dot(y, x) / denominator) if denominator > 0 else 0.0
+
+    joint, _, _ = np.histogram2d(y, x, bins=bins)
+    joint = joint / joint.sum()
+    p_y, p_x = joint.sum(axis=1), joint.sum(axis=0)
+
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+
+    h_y, h_x = entropy(p_y), entropy(p_x)
+    mutual_information = h_y + h_x - entropy(joint.ravel())
+    return float(2 * mutual_information / (h_y + h_x)) if h_y + h_x > 0 else 0.0
+
 def compute_affine_mapping_cv2(y: np.ndarray, x: np.ndarray, crop=False, crop_size=4000, n_features=2000):
     """
     Compute affine mapping using OpenCV.
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
+import os
+import itertools
+import functools
+import h5py
 import numpy as np
 from .io_tools import load_pickle
-from .misc import get_indexed_filepaths
-from concurrent.futures import ProcessPoolExecutor
+from .crop_grid import get_crop_path
+from .profiling import span
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 def stitch_rectangle(stitched_image: np.array, rectangle: np.array, position: tuple):
     """
@@ -25,31 +30,362 @@ def stitch_rectangle(stitched_image: np.array, rectangle: np.array, position: tu
     
     return stitched_image
 
-def process_stitch_channel(paths, positions, shape):
-    stitched_image = np.zeros(shape, dtype='uint16')
-    for path, position in zip(paths, positions):
-        crop = load_pickle(path)
-        stitched_image = stitch_rectangle(stitched_image, crop[1], position)
-    return stitched_image
+def create_stitched_dataset(h5_file, shape, n_channels=3, chunk_size=512):
+    """
+    Creates the chunked dataset the stitched image is written into. Regions that are never written read as zeros.
 
-def stitch_crops(crops_dir, shape, positions, max_workers):
-    crops_paths = get_indexed_filepaths(crops_dir)
-    n_channels = 3
-    stitched_images = []
-    
-    # Create a ProcessPoolExecutor to parallelize stitching across channels
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    Parameters:
+        h5_file (h5py.File): HDF5 file opened for writing.
+        shape (tuple): Shape (height, width) of the stitched image.
+        n_channels (int, optional): Number of channels.
+        chunk_size (int, optional): Height and width of the chunks.
+
+    Returns:
+        h5py.Dataset: The empty stitched image with shape (height, width, n_channels).
+    """
+    shape = tuple(shape[:2]) + (n_channels,)
+    chunks = (min(chunk_size, shape[0]), min(chunk_size, shape[1]), n_channels)
+
+    return h5_file.create_dataset('dataset', shape=shape, dtype='uint16', chunks=chunks, fillvalue=0)
+
+def load_tile(paths, trim):
+    """
+    Loads the channel crops of a tile, removes their overlap and stacks them along the channel axis.
+
+    Parameters:
+        paths (list): Paths to the crops of each channel, ordered by channel.
+        trim (tuple): Region (start_row, end_row, start_col, end_col) of the crops kept after removing the overlap.
+
+    Returns:
+        np.array: The trimmed tile with shape (height, width, n_channels).
+    """
+    start_row, end_row, start_col, end_col = trim
+
+    return np.stack([load_pickle(path)[1][start_row:end_row, start_col:end_col] for path in paths], axis=-1).astype('uint16')
+
+def stitch_crops(crops_dir, output_path, grid, max_workers, prefix='registered_split', n_channels=3, chunk_size=512):
+    """
+    Removes the overlap from registered crops and stitches them directly into a chunked HDF5 file. Workers 
+    load and trim the tiles in parallel and the parent process, which is the only writer, writes each tile 
+    into its region as soon as it is loaded. The number of tiles in flight is bounded, so memory usage is 
+    a few tiles rather than the whole image.
+
+    Parameters:
+        crops_dir (str): Directory of the registered crops.
+        output_path (str): Path where the stitched image is saved.
+        grid (CropGrid): Crop grid of the image, defining the trimmed region and position of each crop.
+        max_workers (int): Maximum number of workers for parallel processing.
+        prefix (str, optional): Prefix of the crop filenames.
+        n_channels (int, optional): Number of channels.
+        chunk_size (int, optional): Height and width of the chunks of the output dataset.
+    """
+    pending_tiles = iter(grid.crop_indices)
+    max_in_flight = 2 * (max_workers or os.cpu_count())
+
+    def submit(executor, idx):
+        paths = [get_crop_path(crops_dir, prefix, idx, ch) for ch in range(n_channels)]
+        return executor.submit(load_tile, paths, grid.trim(idx))
+
+    # Write to a temporary file, so that an interrupted export never leaves a partial image behind
+    tmp_path = f'{output_path}.tmp'
+    with h5py.File(tmp_path, 'w') as h5_file:
+        stitched_image = create_stitched_dataset(h5_file, grid.shape, n_channels, chunk_size)
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {submit(executor, idx): idx for idx in itertools.islice(pending_tiles, max_in_flight)}
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    idx = futures.pop(future)
+                    tile = future.result()
+                    with span('write_tile', 'io', tile=idx, bytes=tile.nbytes):
+                        stitch_rectangle(stitched_image, tile, grid.position(idx))
+
+                    # Keep the number of loaded tiles bounded
+                    for next_idx in itertools.islice(pending_tiles, 1):
+                        futures[submit(executor, next_idx)] = next_idx
+
+    os.replace(tmp_path, output_path)
+
+def stitch_shared_crops(crops, grid, output_path, n_channels=3, chunk_size=512):
+    """
+    Removes the overlap from crops held in memory and writes them directly into a chunked HDF5 file, 
+    without assembling the stitched image in memory.
+
+    Parameters:
+        crops (dict): Crops indexed by (row, column, channel), as returned by crop_image_channels_shared.
+        grid (CropGrid): Crop grid of the image, defining the trimmed region and position of each crop.
+        output_path (str): Path where the stitched image is saved.
+        n_channels (int, optional): Number of channels.
+        chunk_size (int, optional): Height and width of the chunks of the output dataset.
+    """
+    tmp_path = f'{output_path}.tmp'
+    with h5py.File(tmp_path, 'w') as h5_file:
+        stitched_image = create_stitched_dataset(h5_file, grid.shape, n_channels, chunk_size)
+
+        for idx in grid.crop_indices:
+            start_row, end_row, start_col, end_col = grid.trim(idx)
+            tile = np.stack([crops[idx + (ch,)][1][start_row:end_row, start_col:end_col] for ch in range(n_channels)], axis=-1)
+            stitch_rectangle(stitched_image, tile, grid.position(idx))
+
+    os.replace(tmp_path, output_path)
+
+"""
+Blending
+"""
+
+@functools.lru_cache(maxsize=64)
+def get_blending_ramp(length, overlap_before, overlap_after):
+    """
+    Blending weights of a crop along one axis. Weights ramp linearly across the overlap with each 
+    neighbouring crop, so that the weights of two neighbouring crops sum to one over their overlap.
+
+    Parameters:
+        length (int): Length of the crop along the axis.
+        overlap_before (int): Overlap with the previous crop along the axis, 0 if there is none.
+        overlap_after (int): Overlap with the next crop along the axis, 0 if there is none.
+
+    Returns:
+        np.array: The 1D weights, with shape (length,).
+    """
+    ramp = np.ones(length, dtype=np.float32)
+    if overlap_before > 0:
+        ramp[:overlap_before] = (np.arange(overlap_before, dtype=np.float32) + 0.5) / overlap_before
+    if overlap_after > 0:
+        ramp[-overlap_after:] = np.minimum(ramp[-overlap_after:], 
+                                           (np.arange(overlap_after, 0, -1, dtype=np.float32) - 0.5) / overlap_after)
+    ramp.flags.writeable = False
+
+    return ramp
+
+@functools.lru_cache(maxsize=64)
+def get_blending_weights(row_ramp, col_ramp):
+    """
+    Blending weights of a crop, computed once per tile shape and overlaps. Interior crops of a grid 
+    all share the same weights.
+
+    Parameters:
+        row_ramp (tuple): Arguments (length, overlap_before, overlap_after) of the ramp along the rows.
+        col_ramp (tuple): Arguments (length, overlap_before, overlap_after) of the ramp along the columns.
+
+    Returns:
+        np.array: The 2D weights, with shape (height, width).
+    """
+    weights = np.outer(get_blending_ramp(*row_ramp), get_blending_ramp(*col_ramp))
+    weights.flags.writeable = False
+
+    return weights
+
+def get_ramp_params(starts, ends):
+    """
+    Ramp arguments (length, overlap_before, overlap_after) of each crop along one axis of the grid.
+
+    Parameters:
+        starts (np.array): Start positions of the crops along the axis.
+        ends (np.array): End positions of the crops along the axis.
+
+    Returns:
+        list: The ramp arguments of each crop.
+    """
+    overlaps = np.maximum(ends[:-1] - starts[1:], 0).tolist()
+
+    return [(int(end - start), before, after) 
+            for start, end, before, after in zip(starts, ends, [0] + overlaps, overlaps + [0])]
+
+def normalize_blended_rows(accumulator, weight_sum):
+    """
+    Normalizes accumulated rows by their blending weights.
+
+    Parameters:
+        accumulator (np.array): Weighted sum of the crops, with shape (n_rows, width, n_channels).
+        weight_sum (np.array): Sum of the weights, with shape (n_rows, width).
+
+    Returns:
+        np.array: The blended rows, as uint16.
+    """
+    # Pixels covered by no crop stay zero
+    weight_sum = np.where(weight_sum > 0, weight_sum, 1)[..., None]
+
+    return np.clip(np.rint(accumulator / weight_sum), 0, np.iinfo(np.uint16).max).astype('uint16')
+
+def write_blended_rows(dataset, accumulator, weight_sum, top):
+    """
+    Normalizes accumulated rows by their blending weights and writes them to the stitched image.
+
+    Parameters:
+        dataset (h5py.Dataset): The stitched image.
+        accumulator (np.array): Weighted sum of the crops, with shape (n_rows, width, n_channels).
+        weight_sum (np.array): Sum of the weights, with shape (n_rows, width).
+        top (int): Row of the stitched image where the first accumulated row is written.
+    """
+    if len(accumulator) == 0:
+        return
+
+    dataset[top:top + len(accumulator)] = normalize_blended_rows(accumulator, weight_sum)
+
+def blend_bands(dataset, grid, bands):
+    """
+    Stitches crops into a dataset, blending them across their overlap. The crops of each row of the grid
+    (a band) are accumulated, weighted, into an output buffer and a weight buffer. Once a band is 
+    accumulated, the rows above the next band receive no more crops, so they are normalized, written and 
+    dropped from the buffers. Only about one band of the stitched image is held in memory.
+
+    Parameters:
+        dataset (h5py.Dataset): The stitched image, with shape (height, width, n_channels).
+        grid (CropGrid): Crop grid of the image.
+        bands (iterable): Crops of each row of the grid, in order, as lists of (index, crop) with crops of 
+                          shape (height, width, n_channels).
+    """
+    width, n_channels = dataset.shape[1], dataset.shape[2]
+    row_ramps = get_ramp_params(grid.row_starts, grid.row_ends)
+    col_ramps = get_ramp_params(grid.col_starts, grid.col_ends)
+
+    top = 0
+    accumulator = np.zeros((0, width, n_channels), dtype=np.float32)
+    weight_sum = np.zeros((0, width), dtype=np.float32)
+
+    for row, tiles in enumerate(bands):
+        start, end = int(grid.row_starts[row]), int(grid.row_ends[row])
+
+        # Extend the buffers down to the end of the band
+        n_new_rows = end - top - len(accumulator)
+        if n_new_rows > 0:
+            accumulator = np.concatenate([accumulator, np.zeros((n_new_rows, width, n_channels), dtype=np.float32)])
+            weight_sum = np.concatenate([weight_sum, np.zeros((n_new_rows, width), dtype=np.float32)])
+
+        for idx, tile in tiles:
+            weights = get_blending_weights(row_ramps[idx[0]], col_ramps[idx[1]])
+            col_start, col_end = int(grid.col_starts[idx[1]]), int(grid.col_ends[idx[1]])
+            accumulator[start - top:end - top, col_start:col_end] += tile * weights[..., None]
+            weight_sum[start - top:end - top, col_start:col_end] += weights
+
+        # Rows above the next band are complete
+        n_complete = (int(grid.row_starts[row + 1]) if row + 1 < grid.n_rows else end) - top
+        write_blended_rows(dataset, accumulator[:n_complete], weight_sum[:n_complete], top)
+        accumulator, weight_sum = accumulator[n_complete:], weight_sum[n_complete:]
+        top += n_complete
+
+def blend_crops(crops_dir, output_path, grid, max_workers, prefix='registered_split', n_channels=3, chunk_size=512):
+    """
+    Stitches registered crops into a chunked HDF5 file, feather blending them across their whole overlap 
+    instead of cutting them at its middle. Workers load the crops of the next band while the parent 
+    process accumulates the current one.
+
+    Parameters:
+        crops_dir (str): Directory of the registered crops.
+        output_path (str): Path where the stitched image is saved.
+        grid (CropGrid): Crop grid of the image.
+        max_workers (int): Maximum number of workers for parallel processing.
+        prefix (str, optional): Prefix of the crop filenames.
+        n_channels (int, optional): Number of channels.
+        chunk_size (int, optional): Height and width of the chunks of the output dataset.
+    """
+    def submit_band(executor, row):
         futures = []
-        for ch in range(n_channels):
-            # Get the paths corresponding to the current channel
-            paths = [path[1] for path in crops_paths if path[0][2] == ch]
-            
-            # Submit the stitching task for each channel
-            futures.append(executor.submit(process_stitch_channel, paths, positions, shape))
-        
-        # Collect the stitched images for each channel as the tasks complete
-        for future in futures:
-            stitched_images.append(future.result())
-    
-    # Stack the stitched images along the channel axis to form the final image
-    return np.stack(stitched_images, axis=-1)
+        for col in range(grid.n_cols):
+            paths = [get_crop_path(crops_dir, prefix, (row, col), ch) for ch in range(n_channels)]
+            start_row, end_row, start_col, end_col = grid.area((row, col))
+            futures.append(((row, col), executor.submit(load_tile, paths, (0, end_row - start_row, 0, end_col - start_col))))
+        return futures
+
+    def load_bands(executor):
+        futures = submit_band(executor, 0)
+        for row in range(grid.n_rows):
+            next_futures = submit_band(executor, row + 1) if row + 1 < grid.n_rows else []
+            yield [(idx, future.result()) for idx, future in futures]
+            futures = next_futures
+
+    tmp_path = f'{output_path}.tmp'
+    with h5py.File(tmp_path, 'w') as h5_file:
+        stitched_image = create_stitched_dataset(h5_file, grid.shape, n_channels, chunk_size)
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            blend_bands(stitched_image, grid, load_bands(executor))
+
+    os.replace(tmp_path, output_path)
+
+def blend_shared_crops(crops, grid, output_path, n_channels=3, chunk_size=512):
+    """
+    Stitches crops held in memory into a chunked HDF5 file, feather blending them across their overlap.
+
+    Parameters:
+        crops (dict): Crops indexed by (row, column, channel), as returned by crop_image_channels_shared.
+        grid (CropGrid): Crop grid of the image.
+        output_path (str): Path where the stitched image is saved.
+        n_channels (int, optional): Number of channels.
+        chunk_size (int, optional): Height and width of the chunks of the output dataset.
+    """
+    bands = (
+        [((row, col), np.stack([crops[(row, col, ch)][1] for ch in range(n_channels)], axis=-1)) for col in range(grid.n_cols)]
+        for row in range(grid.n_rows)
+    )
+
+    tmp_path = f'{output_path}.tmp'
+    with h5py.File(tmp_path, 'w') as h5_file:
+        stitched_image = create_stitched_dataset(h5_file, grid.shape, n_channels, chunk_size)
+        blend_bands(stitched_image, grid, bands)
+
+    os.replace(tmp_path, output_path)
+
+"""
+Band assembly
+"""
+
+def assemble_band(crops_dir, grid, start, end, prefix='registered_split', n_channels=3, blend=False):
+    """
+    Assembles rows [start, end) of the stitched image from the crops covering them, so that independent 
+    workers can each produce a band of the output.
+
+    Parameters:
+        crops_dir (str): Directory of the registered crops.
+        grid (CropGrid): Crop grid of the image.
+        start (int): First row of the band.
+        end (int): Row after the last row of the band.
+        prefix (str, optional): Prefix of the crop filenames.
+        n_channels (int, optional): Number of channels.
+        blend (bool, optional): Feather blend the crops across their overlap instead of cutting them at its middle.
+
+    Returns:
+        np.array: The band, with shape (end - start, width, n_channels).
+    """
+    end = min(end, grid.shape[0])
+    width = grid.shape[1]
+
+    if blend:
+        row_ramps = get_ramp_params(grid.row_starts, grid.row_ends)
+        col_ramps = get_ramp_params(grid.col_starts, grid.col_ends)
+        accumulator = np.zeros((end - start, width, n_channels), dtype=np.float32)
+        weight_sum = np.zeros((end - start, width), dtype=np.float32)
+        # Blended crops contribute their whole area
+        row_regions = zip(grid.row_starts, grid.row_ends)
+    else:
+        band = np.zeros((end - start, width, n_channels), dtype='uint16')
+        # Cut crops contribute their trimmed region
+        row_regions = zip(grid.row_offsets, grid.row_starts + grid.row_trims[:, 1])
+
+    for row, (region_start, region_end) in enumerate(row_regions):
+        top, bottom = max(int(region_start), start), min(int(region_end), end)
+        if top >= bottom:
+            continue
+
+        for col in range(grid.n_cols):
+            paths = [get_crop_path(crops_dir, prefix, (row, col), ch) for ch in range(n_channels)]
+
+            if blend:
+                start_row, _, start_col, end_col = grid.area((row, col))
+                tile = load_tile(paths, (top - start_row, bottom - start_row, 0, end_col - start_col))
+                weights = get_blending_weights(row_ramps[row], col_ramps[col])[top - start_row:bottom - start_row]
+                accumulator[top - start:bottom - start, start_col:end_col] += tile * weights[..., None]
+                weight_sum[top - start:bottom - start, start_col:end_col] += weights
+            else:
+                trim_start_row, _, trim_start_col, trim_end_col = grid.trim((row, col))
+                position_row, position_col = grid.position((row, col))
+                tile = load_tile(paths, (trim_start_row + top - position_row, trim_start_row + bottom - position_row, 
+                                         trim_start_col, trim_end_col))
+                band[top - start:bottom - start, position_col:position_col + tile.shape[1]] = tile
+
+    if blend:
+        return normalize_blended_rows(accumulator, weight_sum)
+
+    return band
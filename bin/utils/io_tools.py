@@ -1,24 +1,44 @@
 #!/usr/bin/env python
 
 import nd2
+import json
 import pickle
 import numpy as np
 import h5py
+from .profiling import span
 
 """
 Pickle
 """
 def save_pickle(object, path):
-    # Open a file in binary write mode
-    with open(path, 'wb') as file:
-        # Serialize the object and write it to the file
-        pickle.dump(object, file)
+    with span('save_pickle', 'io', path=path) as io_span:
+        # Open a file in binary write mode
+        with open(path, 'wb') as file:
+            # Serialize the object and write it to the file
+            pickle.dump(object, file)
+            io_span.set(bytes=file.tell())
 
 def load_pickle(path):
-    # Open the file in binary read mode
-    with open(path, 'rb') as file:
-    # Deserialize the object from the file
-        loaded_data = pickle.load(file)
+    with span('load_pickle', 'io', path=path) as io_span:
+        # Open the file in binary read mode
+        with open(path, 'rb') as file:
+        # Deserialize the object from the file
+            loaded_data = pickle.load(file)
+            io_span.set(bytes=file.tell())
+
+    return loaded_data
+
+"""
+JSON
+"""
+def save_json(object, path):
+    # Serialize the object to a human readable file
+    with open(path, 'w') as file:
+        json.dump(object, file, indent=4)
+
+def load_json(path):
+    with open(path, 'r') as file:
+        loaded_data = json.load(file)
 
     return loaded_data
 
@@ -26,14 +46,26 @@ def load_pickle(path):
 h5
 """
 def save_h5(data, path):
+    with span('save_h5', 'io', path=path, bytes=data.nbytes):
         # Save the NumPy array to an HDF5 file
-    with h5py.File(path, 'w') as hdf5_file:
-        hdf5_file.create_dataset('dataset', data=data)
+        with h5py.File(path, 'w') as hdf5_file:
+            hdf5_file.create_dataset('dataset', data=data)
         
 def load_h5(path):
-    # Read the NumPy array from the HDF5 file
-    with h5py.File(path, 'r') as hdf5_file:
-        loaded_array = hdf5_file['dataset'][:]
+    with span('load_h5', 'io', path=path) as io_span:
+        # Read the NumPy array from the HDF5 file
+        with h5py.File(path, 'r') as hdf5_file:
+            loaded_array = hdf5_file['dataset'][:]
+        io_span.set(bytes=loaded_array.nbytes)
+
+    return loaded_array
+
+def load_h5_channel(path, channel):
+    with span('load_h5_channel', 'io', path=path, channel=channel) as io_span:
+        # Read a single channel of the NumPy array from the HDF5 file
+        with h5py.File(path, 'r') as hdf5_file:
+            loaded_array = hdf5_file['dataset'][:, :, channel]
+        io_span.set(bytes=loaded_array.nbytes)
 
     return loaded_array
 
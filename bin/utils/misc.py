@@ -19,15 +19,6 @@ def empty_folder(folder_path):
         elif os.path.isdir(item_path):
             shutil.rmtree(item_path)  # Remove directory and its contents
 
-def get_indexed_filepaths(registered_crops_dir):
-    crops_filenames = os.listdir(registered_crops_dir)
-    crops_paths = sorted([os.path.join(registered_crops_dir, file) for file in crops_filenames])
-    indices = sorted([tuple(map(int, re.search(r'\d+_\d+_\d+', filename).group(0).split('_'))) for filename in crops_filenames])
-    
-    crops_paths = [(idx, path) for idx, path in zip(indices, crops_paths)]
-
-    return crops_paths
-
 def remove_file_extension(filename):
     """
     Recursively remove all file extensions from a given filename.
@@ -54,8 +45,7 @@ def create_checkpoint_dirs(root_mappings_dir=None, root_registered_crops_dir=Non
         moving_image_path (str): Path to the moving image.
 
     Returns:
-        tuple: Paths for the current mappings directory, affine crops directory, 
-               and diffeomorphic crops directory.
+        tuple: Paths for the current mappings directory and registered crops directory.
     """
     # Extract filename and image directory name from the moving image path
     filename = remove_file_extension(os.path.basename(moving_image_path))
@@ -75,15 +65,12 @@ def create_checkpoint_dirs(root_mappings_dir=None, root_registered_crops_dir=Non
     if root_registered_crops_dir is not None:
 
         current_registered_crops_dir = os.path.join(root_registered_crops_dir, transformation, image_dirname, filename)
-        current_registered_crops_no_overlap_dir = os.path.join(root_registered_crops_dir, transformation, 'no_overlap', image_dirname, filename)
         if makedirs:
             os.makedirs(current_registered_crops_dir, exist_ok=True)
-            os.makedirs(current_registered_crops_no_overlap_dir, exist_ok=True)
     else:
         current_registered_crops_dir = None
-        current_registered_crops_no_overlap_dir = None
 
-    return current_mappings_dir, current_registered_crops_dir, current_registered_crops_no_overlap_dir
+    return current_mappings_dir, current_registered_crops_dir
 
 def get_crops_dir(image_path, crops_dir):
     """
@@ -104,3 +91,133 @@ def get_crops_dir(image_path, crops_dir):
     crops_wd = os.path.join(crops_dir, cycle_dir, filename_dir)
 
     return crops_wd
+
+def get_scale_space_dir(fixed_image_path, scale_space_dir, crop_width_x, crop_width_y, overlap_x, overlap_y):
+    """
+    Create a directory path for caching the scale spaces of the fixed image crops. Each crop grid 
+    of the fixed image gets its own directory.
+
+    Args:
+        fixed_image_path (str): Path to the fixed image.
+        scale_space_dir (str): Base directory for storing scale spaces.
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Overlap between crops along the x-axis.
+        overlap_y (int): Overlap between crops along the y-axis.
+
+    Returns:
+        str: The constructed directory path for storing scale spaces.
+    """
+    grid_dirname = get_grid_dirname(crop_width_x, crop_width_y, overlap_x, overlap_y)
+
+    return os.path.join(get_crops_dir(fixed_image_path, scale_space_dir), grid_dirname)
+
+def get_grid_dirname(crop_width_x, crop_width_y, overlap_x, overlap_y):
+    """
+    Name of the directory holding the artifacts that depend on a specific crop grid.
+
+    Args:
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Overlap between crops along the x-axis.
+        overlap_y (int): Overlap between crops along the y-axis.
+
+    Returns:
+        str: The directory name.
+    """
+    return f'grid_{crop_width_x}_{crop_width_y}_{overlap_x}_{overlap_y}'
+
+def get_grid_params_path(root_registered_crops_dir, moving_image_path):
+    """
+    Path of the crop grid manifest of a moving image, saved during affine registration and loaded by the following stages.
+
+    Args:
+        root_registered_crops_dir (str): Root directory for storing registered crops.
+        moving_image_path (str): Path to the moving image.
+
+    Returns:
+        str: Path to the crop grid manifest.
+    """
+    filename = remove_file_extension(os.path.basename(moving_image_path))
+    image_dirname = os.path.basename(os.path.dirname(moving_image_path))
+
+    return os.path.join(root_registered_crops_dir, 'grids', image_dirname, f'{filename}.json')
+
+def get_affine_matrix_path(root_registered_crops_dir, moving_image_path):
+    """
+    Path of the affine transformation matrix of a moving image, saved during affine registration.
+
+    Args:
+        root_registered_crops_dir (str): Root directory for storing registered crops.
+        moving_image_path (str): Path to the moving image.
+
+    Returns:
+        str: Path to the affine transformation matrix.
+    """
+    filename = remove_file_extension(os.path.basename(moving_image_path))
+    image_dirname = os.path.basename(os.path.dirname(moving_image_path))
+
+    return os.path.join(root_registered_crops_dir, 'matrices', image_dirname, f'{filename}.npy')
+
+def get_quality_map_path(root_mappings_dir, moving_image_path):
+    """
+    Path of the file storing the per-crop similarity scores of a moving image after affine registration.
+
+    Args:
+        root_mappings_dir (str): Root directory for storing mappings.
+        moving_image_path (str): Path to the moving image.
+
+    Returns:
+        str: Path to the quality map file.
+    """
+    filename = remove_file_extension(os.path.basename(moving_image_path))
+    image_dirname = os.path.basename(os.path.dirname(moving_image_path))
+
+    return os.path.join(root_mappings_dir, 'quality_maps', image_dirname, f'{filename}.csv')
+
+def get_telemetry_path(root_mappings_dir, moving_image_path):
+    """
+    Path of the file storing the per-crop convergence telemetry of the diffeomorphic registration of a moving image.
+
+    Args:
+        root_mappings_dir (str): Root directory for storing mappings.
+        moving_image_path (str): Path to the moving image.
+
+    Returns:
+        str: Path to the telemetry file.
+    """
+    filename = remove_file_extension(os.path.basename(moving_image_path))
+    image_dirname = os.path.basename(os.path.dirname(moving_image_path))
+
+    return os.path.join(root_mappings_dir, 'telemetry', image_dirname, f'{filename}.csv')
+
+def get_batch_path(path, batch_index):
+    """
+    Path of the part of a per-image file written by one batch of crops, before the batches are gathered.
+
+    Args:
+        path (str): Path to the per-image file.
+        batch_index (int): Index of the batch.
+
+    Returns:
+        str: Path to the batch file, in a directory named after the per-image file.
+    """
+    root, ext = os.path.splitext(path)
+
+    return os.path.join(root, f'batch_{batch_index}{ext}')
+
+def get_status_path(logs_dir, moving_image_path):
+    """
+    Path of the file where the progress of the registration of a moving image is periodically written.
+
+    Args:
+        logs_dir (str): Directory of the logs.
+        moving_image_path (str): Path to the moving image.
+
+    Returns:
+        str: Path to the status file.
+    """
+    filename = remove_file_extension(os.path.basename(moving_image_path))
+    image_dirname = os.path.basename(os.path.dirname(moving_image_path))
+
+    return os.path.join(logs_dir, 'status', image_dirname, f'{filename}.json')
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os
+import math
+import h5py
+import numpy as np
+import tifffile
+
+"""
+Pyramid levels
+"""
+
+def downsample_rows(rows, scale):
+    """
+    Downsamples a block of rows by averaging non-overlapping scale x scale blocks. Incomplete blocks at
+    the bottom and right borders are averaged over the pixels they contain.
+
+    Parameters:
+        rows (np.ndarray): 2D block of rows.
+        scale (int): Downsampling factor.
+
+    Returns:
+        np.ndarray: The downsampled rows, with shape (ceil(height / scale), ceil(width / scale)).
+    """
+    height, width = rows.shape
+    padded_height, padded_width = math.ceil(height / scale) * scale, math.ceil(width / scale) * scale
+    padded = np.pad(rows.astype(np.float32), ((0, padded_height - height), (0, padded_width - width)), mode='edge')
+    blocks = padded.reshape(padded_height // scale, scale, padded_width // scale, scale)
+
+    return np.rint(blocks.mean(axis=(1, 3))).astype(rows.dtype)
+
+def get_level_shape(shape, scale, level):
+    """Shape (height, width) of a pyramid level."""
+    height, width = shape
+    for _ in range(level):
+        height, width = math.ceil(height / scale), math.ceil(width / scale)
+
+    return height, width
+
+def iter_tiles(source, tile_shape, next_level=None, scale=2):
+    """
+    Iterates over the tiles of an image in the order they are written to the TIFF pages: channel by channel,
+    and row by row within a channel. The image is read one band of tiles at a time. When next_level is
+    given, each band is also downsampled into it, so the next pyramid level is built while this one is written.
+
+    Parameters:
+        source (array-like): Image with shape (height, width, n_channels), e.g. an HDF5 dataset.
+        tile_shape (tuple): Shape (height, width) of the tiles.
+        next_level (array-like, optional): Image the downsampled bands are written to.
+        scale (int, optional): Downsampling factor between pyramid levels.
+
+    Yields:
+        np.ndarray: The tiles. Tiles on the bottom and right borders may be smaller than tile_shape.
+    """
+    height, width, n_channels = source.shape
+    tile_height, tile_width = tile_shape
+
+    for ch in range(n_channels):
+        carry, next_row = None, 0
+
+        for y in range(0, height, tile_height):
+            band = source[y:y + tile_height, :, ch]
+
+            if next_level is not None:
+                # Only complete groups of scale rows are downsampled, except on the last band
+                rows = band if carry is None else np.concatenate([carry, band])
+                n_rows = len(rows) if y + tile_height >= height else len(rows) // scale * scale
+                if n_rows > 0:
+                    downsampled = downsample_rows(rows[:n_rows], scale)
+                    next_level[next_row:next_row + len(downsampled), :, ch] = downsampled
+                    next_row += len(downsampled)
+                carry = rows[n_rows:]
+
+            for x in range(0, width, tile_width):
+                yield np.ascontiguousarray(band[:, x:x + tile_width])
+
+"""
+Writer
+"""
+
+def write_ome_tiff(source, output_path, tile_shape=(512, 512), n_resolutions=3, scale=2, compression='zlib', max_workers=None):
+    """
+    Writes an image to a tiled, pyramidal BigTIFF OME file. The image is streamed tile by tile, tiles are
+    compressed in parallel by a thread pool, and each pyramid level is downsampled from the previous one
+    while that one is written. Levels are kept in a temporary chunked HDF5 file until they are written, so
+    memory usage is a band of tiles rather than the whole image.
+
+    Parameters:
+        source (array-like): Image with shape (height, width, n_channels), e.g. an HDF5 dataset.
+        output_path (str): Path to the OME-TIFF file.
+        tile_shape (tuple, optional): Shape (height, width) of the tiles. Both must be multiples of 16.
+        n_resolutions (int, optional): Number of resolutions of the pyramid, including the full resolution.
+        scale (int, optional): Downsampling factor between pyramid levels.
+        compression (str, optional): Compression of the tiles, as accepted by tifffile.
+        max_workers (int, optional): Maximum number of threads compressing tiles.
+    """
+    height, width, n_channels = source.shape
+    tmp_path = f'{output_path}.tmp'
+    levels_path = f'{output_path}.levels.h5'
+
+    try:
+        with h5py.File(levels_path, 'w') as levels, tifffile.TiffWriter(tmp_path, bigtiff=True, ome=True) as tif:
+            level_source = source
+
+            for level in range(n_resolutions):
+                level_shape = get_level_shape((height, width), scale, level)
+
+                # Dataset the next level is downsampled into while this level is written
+                next_level = None
+                if level + 1 < n_resolutions:
+                    next_shape = get_level_shape((height, width), scale, level + 1) + (n_channels,)
+                    chunks = (min(tile_shape[0], next_shape[0]), min(tile_shape[1], next_shape[1]), 1)
+                    next_level = levels.create_dataset(str(level + 1), shape=next_shape, dtype=source.dtype, chunks=chunks)
+
+                options = dict(shape=(n_channels,) + level_shape, dtype=source.dtype, tile=tile_shape,
+                               photometric='minisblack', compression=compression, maxworkers=max_workers)
+                tiles = iter_tiles(level_source, tile_shape, next_level, scale)
+                if level == 0:
+                    # Reduced resolutions are stored as sub-IFDs of each channel page
+                    tif.write(tiles, subifds=n_resolutions - 1, metadata={'axes': 'CYX'}, **options)
+                else:
+                    tif.write(tiles, subfiletype=1, metadata=None, **options)
+
+                level_source = next_level
+
+        os.replace(tmp_path, output_path)
+    finally:
+        for path in (tmp_path, levels_path):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import os
+import math
+import shutil
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from . import logging_config
+from .image_stitching import assemble_band
+from .ome_tiff import downsample_rows, get_level_shape
+
+# zarr is only needed for OME-Zarr export
+try:
+    import zarr
+    from numcodecs import Blosc
+except ImportError:
+    zarr = None
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+"""
+Store layout
+"""
+
+def create_ome_zarr(path, shape, n_channels=3, dtype='uint16', chunk_size=512, n_resolutions=3, scale=2, name=None):
+    """
+    Creates an empty OME-Zarr (NGFF 0.4) image: one chunked, compressed array per pyramid level, with
+    axes (c, y, x), and the multiscales metadata describing them.
+
+    Parameters:
+        path (str): Path to the OME-Zarr directory.
+        shape (tuple): Shape (height, width) of the full resolution image.
+        n_channels (int, optional): Number of channels.
+        dtype (str, optional): Data type of the image.
+        chunk_size (int, optional): Height and width of the chunks. Each chunk holds a single channel.
+        n_resolutions (int, optional): Number of resolutions of the pyramid, including the full resolution.
+        scale (int, optional): Downsampling factor between pyramid levels.
+        name (str, optional): Name of the image.
+    """
+    if zarr is None:
+        raise ImportError('OME-Zarr export requires the zarr package.')
+
+    root = zarr.open_group(path, mode='w')
+    compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+    datasets = []
+    for level in range(n_resolutions):
+        level_shape = get_level_shape(shape[:2], scale, level)
+        root.create_dataset(str(level), shape=(n_channels,) + level_shape, chunks=(1, chunk_size, chunk_size), dtype=dtype,
+                            compressor=compressor, fill_value=0, dimension_separator='/')
+        factor = float(scale ** level)
+        datasets.append({
+            'path': str(level),
+            'coordinateTransformations': [{'type': 'scale', 'scale': [1.0, factor, factor]}]
+        })
+
+    root.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': name or os.path.basename(path),
+        'axes': [
+            {'name': 'c', 'type': 'channel'},
+            {'name': 'y', 'type': 'space'},
+            {'name': 'x', 'type': 'space'}
+        ],
+        'datasets': datasets,
+        'type': 'mean'
+    }]
+
+"""
+Band writers
+"""
+
+def write_crops_band(path, crops_dir, grid, start, end, prefix='registered_split', n_channels=3, blend=False):
+    """
+    Stitches rows [start, end) of the image from the registered crops and writes them to the full
+    resolution level. Bands are aligned to the chunks, so workers never write to the same chunk.
+    """
+    band = assemble_band(crops_dir, grid, start, end, prefix, n_channels, blend)
+    zarr.open_array(os.path.join(path, '0'), mode='r+')[:, start:start + len(band)] = np.moveaxis(band, -1, 0)
+
+def write_downsampled_band(path, level, start, end, scale=2):
+    """
+    Downsamples the rows of the previous level covering rows [start, end) of a pyramid level, and writes them.
+    """
+    source = zarr.open_array(os.path.join(path, str(level - 1)), mode='r')
+    target = zarr.open_array(os.path.join(path, str(level)), mode='r+')
+
+    rows = source[:, start * scale:end * scale]
+    target[:, start:start + math.ceil(rows.shape[1] / scale)] = np.stack([downsample_rows(channel, scale) for channel in rows])
+
+"""
+Export
+"""
+
+def export_ome_zarr(crops_dir, output_path, grid, max_workers, prefix='registered_split', n_channels=3, chunk_size=512,
+                    n_resolutions=3, scale=2, blend=False):
+    """
+    Stitches registered crops into an OME-Zarr image with a multiscale pyramid. The full resolution level
+    is written in bands of chunk rows by parallel workers, each stitching its band from the crops covering
+    it. Each lower level is then downsampled band by band from the level above.
+
+    Parameters:
+        crops_dir (str): Directory of the registered crops.
+        output_path (str): Path to the OME-Zarr directory.
+        grid (CropGrid): Crop grid of the image.
+        max_workers (int): Maximum number of workers for parallel processing.
+        prefix (str, optional): Prefix of the crop filenames.
+        n_channels (int, optional): Number of channels.
+        chunk_size (int, optional): Height and width of the chunks.
+        n_resolutions (int, optional): Number of resolutions of the pyramid, including the full resolution.
+        scale (int, optional): Downsampling factor between pyramid levels.
+        blend (bool, optional): Feather blend the crops across their overlap instead of cutting them at its middle.
+    """
+    # Write to a temporary directory, so that an interrupted export never leaves a partial image behind
+    tmp_path = f'{output_path}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    create_ome_zarr(tmp_path, grid.shape, n_channels, 'uint16', chunk_size, n_resolutions, scale,
+                    name=os.path.basename(output_path))
+
+    # Bands span whole chunk rows, about as high as a crop so that each crop is read by few bands
+    band_height = chunk_size * max(1, round(grid.crop_width_y / chunk_size))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        height = grid.shape[0]
+        futures = [
+            executor.submit(write_crops_band, tmp_path, crops_dir, grid, start, start + band_height, prefix, n_channels, blend)
+            for start in range(0, height, band_height)
+        ]
+        for future in futures:
+            future.result()
+
+        for level in range(1, n_resolutions):
+            height = get_level_shape(grid.shape, scale, level)[0]
+            futures = [
+                executor.submit(write_downsampled_band, tmp_path, level, start, start + band_height, scale)
+                for start in range(0, height, band_height)
+            ]
+            for future in futures:
+                future.result()
+
+    os.replace(tmp_path, output_path)
+    logger.debug(f'OME-Zarr image with {n_resolutions} resolutions written to {output_path}.')
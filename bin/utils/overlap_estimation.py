@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import math
+import logging
+import h5py
+import numpy as np
+from . import logging_config
+from .image_cropping import get_crop_areas, get_padding_shape, zero_pad_array, crop_2d_array
+from .image_mapping import compute_diffeomorphic_mapping_dipy, apply_mapping
+from .crop_grid import CropGrid
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+"""
+Deformation estimation
+"""
+
+def load_h5_downsampled(path, downsample, channel=2):
+    """
+    Read one channel of an HDF5 image, keeping one pixel every 'downsample' pixels along each axis.
+
+    Parameters:
+        path (str): Path to the HDF5 file.
+        downsample (int): Downsampling factor.
+        channel (int, optional): Channel to read. Defaults to the DAPI channel (2).
+
+    Returns:
+        np.ndarray: The downsampled channel.
+    """
+    with h5py.File(path, 'r') as f:
+        return f['dataset'][::downsample, ::downsample, channel]
+
+def select_sample_areas(image, crop_areas, n_samples, alpha=1.5):
+    """
+    Select the crop areas with the largest proportion of bright pixels.
+
+    Parameters:
+        image (np.ndarray): 2D image the crop areas refer to.
+        crop_areas (list): Candidate crop areas (start_row, end_row, start_col, end_col).
+        n_samples (int): Number of areas to select.
+        alpha (float, optional): Pixels brighter than alpha times the image mean are considered bright.
+
+    Returns:
+        list: The selected crop areas.
+    """
+    thresh = np.mean(image) * alpha
+    density = [np.mean(crop_2d_array(image, crop_areas=area) > thresh) for area in crop_areas]
+    order = np.argsort(density)[::-1]
+
+    return [crop_areas[i] for i in order[:n_samples] if density[i] > 0]
+
+def estimate_max_displacement(fixed_image_path, moving_image_path, matrix, crop_width_x, crop_width_y,
+                              downsample=8, n_samples=4):
+    """
+    Estimate the largest displacement the diffeomorphic registration has to recover, by registering
+    a few low resolution sample crops after applying the affine transformation.
+
+    Parameters:
+        fixed_image_path (str): Path to the fixed image.
+        moving_image_path (str): Path to the moving image.
+        matrix (np.ndarray): Affine transformation matrix computed at full resolution.
+        crop_width_x (int): Width of each crop at full resolution.
+        crop_width_y (int): Height of each crop at full resolution.
+        downsample (int, optional): Downsampling factor of the coarse pass.
+        n_samples (int, optional): Number of sample crops to register.
+
+    Returns:
+        float: Largest displacement found, in full resolution pixels.
+    """
+    fixed_image = load_h5_downsampled(fixed_image_path, downsample)
+    moving_image = load_h5_downsampled(moving_image_path, downsample)
+    padding_shape = get_padding_shape(fixed_image.shape, moving_image.shape)
+    fixed_image = zero_pad_array(fixed_image, padding_shape)
+    moving_image = zero_pad_array(moving_image, padding_shape)
+
+    # Crops are affinely transformed in their own frame, so only the translation depends on the resolution
+    low_res_matrix = np.array(matrix, dtype=np.float64)
+    low_res_matrix[:, 2] /= downsample
+
+    # Sample crops are laid out without overlap, as the overlap is what is being estimated
+    low_res_width_x = int(np.clip(crop_width_x // downsample, 2, padding_shape[1] // 2))
+    low_res_width_y = int(np.clip(crop_width_y // downsample, 2, padding_shape[0] // 2))
+    crop_areas = get_crop_areas(shape=padding_shape, crop_width_x=low_res_width_x, crop_width_y=low_res_width_y,
+                                overlap_x=0, overlap_y=0, get_indices=False)
+    sample_areas = select_sample_areas(fixed_image, crop_areas, n_samples)
+
+    max_displacement = 0.0
+    for area in sample_areas:
+        fixed_crop = crop_2d_array(fixed_image, crop_areas=area)
+        moving_crop = apply_mapping(low_res_matrix, crop_2d_array(moving_image, crop_areas=area), method='cv2')
+
+        # Check for single valued crops (white areas)
+        if len(np.unique(fixed_crop)) == 1 or len(np.unique(moving_crop)) == 1:
+            continue
+
+        mapping = compute_diffeomorphic_mapping_dipy(fixed_crop, moving_crop)
+        displacement = max(np.max(np.linalg.norm(mapping.forward, axis=-1)),
+                           np.max(np.linalg.norm(mapping.backward, axis=-1)))
+        logger.debug(f'Sample crop {area}: maximum displacement {displacement * downsample:.1f} px.')
+        max_displacement = max(max_displacement, float(displacement) * downsample)
+
+    return max_displacement
+
+"""
+Overlap selection
+"""
+
+def choose_overlap(max_displacement, crop_width, radius=4, safety_factor=1.5, min_overlap=0):
+    """
+    Choose the smallest overlap whose half covers the displacement plus the metric radius. Overlap
+    removal keeps half of the overlap on each side of a crop border, so that margin is what hides
+    edge artifacts of the registration.
+
+    Parameters:
+        max_displacement (float): Largest displacement expected, in pixels.
+        crop_width (int): Width of each crop.
+        radius (int, optional): Radius of the similarity metric, in pixels.
+        safety_factor (float, optional): Factor applied to the margin.
+        min_overlap (int, optional): Smallest overlap allowed.
+
+    Returns:
+        int: The overlap, always smaller than the crop width.
+    """
+    margin = math.ceil((max_displacement + radius) * safety_factor)
+    overlap = max(2 * margin, min_overlap)
+
+    return int(min(overlap, crop_width - 1))
+
+def get_registered_pixel_ratio(shape, crop_width_x, crop_width_y, overlap_x, overlap_y):
+    """
+    Number of times each pixel of the image is registered on average, given the crop grid.
+
+    Parameters:
+        shape (tuple): Shape of the image.
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Overlap between crops along the x-axis.
+        overlap_y (int): Overlap between crops along the y-axis.
+
+    Returns:
+        tuple: Number of crops and average number of registrations per pixel.
+    """
+    grid = CropGrid(shape, crop_width_x, crop_width_y, overlap_x, overlap_y)
+    registered_pixels = np.sum(grid.row_ends - grid.row_starts) * np.sum(grid.col_ends - grid.col_starts)
+
+    return grid.n_crops, registered_pixels / (shape[0] * shape[1])
+
+def estimate_overlap(fixed_image_path, moving_image_path, matrix, shape, crop_width_x, crop_width_y,
+                     overlap_x, overlap_y, downsample=8, n_samples=4, radius=4, safety_factor=1.5):
+    """
+    Choose the crop overlap from the deformation measured on a coarse pass, and report the chosen
+    grid against the requested one.
+
+    Parameters:
+        fixed_image_path (str): Path to the fixed image.
+        moving_image_path (str): Path to the moving image.
+        matrix (np.ndarray): Affine transformation matrix.
+        shape (tuple): Shape of the padded images.
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Requested overlap along the x-axis, reported for comparison.
+        overlap_y (int): Requested overlap along the y-axis, reported for comparison.
+        downsample (int, optional): Downsampling factor of the coarse pass.
+        n_samples (int, optional): Number of sample crops registered on the coarse pass.
+        radius (int, optional): Radius of the similarity metric, in pixels.
+        safety_factor (float, optional): Factor applied to the margin.
+
+    Returns:
+        tuple: Chosen overlaps along the x and y axes.
+    """
+    max_displacement = estimate_max_displacement(fixed_image_path, moving_image_path, matrix,
+                                                 crop_width_x, crop_width_y, downsample, n_samples)
+
+    new_overlap_x = choose_overlap(max_displacement, crop_width_x, radius, safety_factor)
+    new_overlap_y = choose_overlap(max_displacement, crop_width_y, radius, safety_factor)
+
+    n_crops, ratio = get_registered_pixel_ratio(shape, crop_width_x, crop_width_y, overlap_x, overlap_y)
+    new_n_crops, new_ratio = get_registered_pixel_ratio(shape, crop_width_x, crop_width_y, new_overlap_x, new_overlap_y)
+
+    logger.info(f'Maximum displacement on coarse pass: {max_displacement:.1f} px.')
+    logger.info(f'Requested grid: crop {crop_width_x}x{crop_width_y}, overlap {overlap_x}x{overlap_y}, '
+                f'{n_crops} crops, {ratio:.2f} registrations per pixel.')
+    logger.info(f'Chosen grid: crop {crop_width_x}x{crop_width_y}, overlap {new_overlap_x}x{new_overlap_y}, '
+                f'{new_n_crops} crops, {new_ratio:.2f} registrations per pixel '
+                f'({100 * (1 - new_ratio / ratio):.0f}% less registration work).')
+
+    return new_overlap_x, new_overlap_y
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import json
+import time
+import socket
+import resource
+import threading
+import logging
+from . import logging_config
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Profiling is enabled by setting the directory of the profiles, inherited by the worker processes
+PROFILE_DIR_ENV = 'REGISTRATION_PROFILE_DIR'
+PROFILE_IMAGE_ENV = 'REGISTRATION_PROFILE_IMAGE'
+
+_profile_dir = os.environ.get(PROFILE_DIR_ENV) or None
+_image = os.environ.get(PROFILE_IMAGE_ENV)
+_writer = None
+
+"""
+Spans
+"""
+
+def setup_profiling(profile_dir=None, image_path=None):
+    """
+    Enables profiling in the current process and in the processes it starts, if a profile directory is
+    given or was set in the environment.
+
+    Parameters:
+        profile_dir (str, optional): Directory of the profiles. Defaults to the REGISTRATION_PROFILE_DIR variable.
+        image_path (str, optional): Path to the processed image, whose name is attached to every span.
+    """
+    global _profile_dir, _image
+    if profile_dir:
+        os.environ[PROFILE_DIR_ENV] = profile_dir
+        _profile_dir = profile_dir
+    if image_path and _profile_dir:
+        _image = os.path.basename(image_path)
+        os.environ[PROFILE_IMAGE_ENV] = _image
+
+def is_profiling():
+    return _profile_dir is not None
+
+def _write(event):
+    """Appends an event to the profile of the current process, opened again in forked workers."""
+    global _writer
+    pid = os.getpid()
+    if _writer is None or _writer[0] != pid:
+        os.makedirs(_profile_dir, exist_ok=True)
+        path = os.path.join(_profile_dir, f'{socket.gethostname()}_{pid}.jsonl')
+        _writer = (pid, open(path, 'a', buffering=1))
+        _writer[1].write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': f'{_image or "pipeline"} ({pid})'}}) + '\n')
+
+    # Each event is written as soon as its span ends, as pool workers exit without running exit handlers
+    _writer[1].write(json.dumps(event, default=str) + '\n')
+
+class Span:
+    """
+    Times a block of code and records it as a complete event of the Chrome trace format, with the image,
+    the peak resident memory of the process and the arguments of the span.
+
+    Attributes:
+        name (str): Name of the span.
+        category (str): Category of the span, e.g. 'stage', 'tile' or 'io'.
+        args (dict): Arguments of the span, e.g. the tile index or the bytes read.
+    """
+    __slots__ = ('name', 'category', 'args', 'start')
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **args):
+        """Adds arguments known once the block ran, such as the bytes read."""
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.time_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+
+        _write({
+            'name': self.name,
+            'cat': self.category,
+            'ph': 'X',
+            'ts': self.start / 1e3,
+            'dur': (end - self.start) / 1e3,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'args': {
+                'image': _image,
+                # ru_maxrss is in kilobytes on Linux
+                'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                **self.args
+            }
+        })
+
+class _NullSpan:
+    """Span doing nothing, returned while profiling is disabled."""
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+def span(name, category='stage', **args):
+    """
+    Times a block of code if profiling is enabled. While it is disabled, a shared span doing nothing is
+    returned, so instrumented code only pays for a function call.
+
+    Parameters:
+        name (str): Name of the span.
+        category (str, optional): Category of the span, e.g. 'stage', 'tile' or 'io'.
+        **args: Arguments of the span, e.g. the tile index.
+
+    Returns:
+        Span: Context manager timing the block.
+    """
+    if _profile_dir is None:
+        return _NULL_SPAN
+    return Span(name, category, args)
+
+"""
+Profiles
+"""
+
+def load_profile(profile_dir):
+    """
+    Loads the events written by every process into a profile directory.
+
+    Returns:
+        list: Events of the Chrome trace format, sorted by start time.
+    """
+    events = []
+    for path in sorted(glob.glob(os.path.join(profile_dir, '*.jsonl'))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Last line of a process killed while writing
+                    logger.warning(f'Truncated event in {path} skipped.')
+
+    return sorted(events, key=lambda event: event.get('ts', 0))
+
+def save_chrome_trace(events, path):
+    """Saves events as a Chrome trace, which Perfetto and chrome://tracing open."""
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def summarize_profile(events):
+    """
+    Summarizes the spans of each image: their number, total, mean and maximum duration, share of the time
+    of the stages of the image, bytes and peak resident memory. Spans of parallel workers overlap, so the
+    total duration of tile spans can exceed the time of their stage.
+
+    Parameters:
+        events (list): Events of the Chrome trace format.
+
+    Returns:
+        pd.DataFrame: One row per image and span name, the slowest first.
+    """
+    # pandas is only needed to export a profile, not by the profiled stages
+    import pandas as pd
+
+    spans = pd.DataFrame([
+        {'image': event['args'].get('image'), 'category': event['cat'], 'name': event['name'], 'seconds': event['dur'] / 1e6,
+         'bytes': event['args'].get('bytes', 0), 'peak_rss': event['args'].get('peak_rss')}
+        for event in events if event.get('ph') == 'X'
+    ])
+    if spans.empty:
+        return spans
+
+    spans['image'] = spans['image'].fillna('')
+    summary = spans.groupby(['image', 'category', 'name']).agg(
+        count=('seconds', 'size'),
+        total_seconds=('seconds', 'sum'),
+        mean_seconds=('seconds', 'mean'),
+        max_seconds=('seconds', 'max'),
+        total_bytes=('bytes', 'sum'),
+        max_peak_rss=('peak_rss', 'max')
+    ).reset_index()
+
+    stage_seconds = spans[spans['category'] == 'stage'].groupby('image')['seconds'].sum()
+    summary['stage_share'] = summary['total_seconds'] / summary['image'].map(stage_seconds)
+
+    return summary.sort_values(['image', 'total_seconds'], ascending=[True, False], ignore_index=True)
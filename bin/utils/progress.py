@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import resource
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from . import logging_config
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+"""
+Process memory
+"""
+
+def get_tree_rss(pid):
+    """
+    Sums the resident memory of a process and of its descendants, such as the workers of its process pools.
+
+    Parameters:
+        pid (int): Process identifier of the root of the tree.
+
+    Returns:
+        int: Resident memory in bytes.
+    """
+    parents = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, the fields after it are fixed
+                fields = f.read().rsplit(')', 1)[1].split()
+            parents[int(entry)] = int(fields[1])
+            rss[int(entry)] = int(fields[21]) * resource.getpagesize()
+        except (OSError, IndexError, ValueError):
+            continue
+
+    tree, frontier = {pid}, [pid]
+    while frontier:
+        parent = frontier.pop()
+        children = [child for child, ppid in parents.items() if ppid == parent and child not in tree]
+        tree.update(children)
+        frontier.extend(children)
+
+    return sum(rss.get(process, 0) for process in tree)
+
+"""
+Worker side
+"""
+
+def run_timed(function, *args, **kwargs):
+    """
+    Runs a tile task in a worker and reports its duration and the memory of the worker to the parent,
+    along with the result of the task.
+
+    Parameters:
+        function (callable): Tile task.
+        *args, **kwargs: Arguments of the task.
+
+    Returns:
+        tuple: Result of the task, and a report with its duration in seconds, the worker pid and its peak
+               resident memory in bytes.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+
+    # ru_maxrss is in kilobytes on Linux
+    return result, {
+        'seconds': time.perf_counter() - start,
+        'pid': os.getpid(),
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+
+"""
+Parent side
+"""
+
+class ProgressReporter:
+    """
+    Tracks the tiles of a stage completed by a worker pool and periodically writes its status to a JSON
+    file, so that a monitoring script can follow a long run. The ETA is derived from the rate at which
+    the last tiles completed, which accounts for the workers running in parallel.
+
+    Attributes:
+        status_path (str): Path to the status file. Nothing is written if None.
+        stage (str): Name of the stage.
+        total (int): Number of tiles of the stage.
+        done (int): Number of tiles completed.
+        interval (float): Minimum number of seconds between two writes of the status file.
+    """
+    def __init__(self, status_path, stage, total, window=20, interval=10):
+        self.status_path = status_path
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.start = time.time()
+        self.last_write = 0
+        self.tile_seconds = deque(maxlen=window)
+        self.completion_times = deque(maxlen=window)
+        self.worker_rss = {}
+
+    def __enter__(self):
+        self.write('running')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.write('failed' if exc_type is not None else 'done')
+
+    def update(self, report=None):
+        """
+        Records a completed tile.
+
+        Parameters:
+            report (dict, optional): Report of the worker, as returned by run_timed.
+        """
+        self.done += 1
+        self.completion_times.append(time.time())
+        if report is not None:
+            self.tile_seconds.append(report['seconds'])
+            self.worker_rss[report['pid']] = report['peak_rss']
+
+        if time.time() - self.last_write >= self.interval:
+            self.write('running')
+
+    def get_eta(self):
+        """Seconds left, from the completion rate of the last tiles, or None before two tiles completed."""
+        remaining = self.total - self.done
+        if remaining == 0:
+            return 0.0
+        if len(self.completion_times) < 2:
+            return None
+
+        rate = (len(self.completion_times) - 1) / max(self.completion_times[-1] - self.completion_times[0], 1e-6)
+        return remaining / rate
+
+    def get_status(self, state):
+        eta = self.get_eta()
+        return {
+            'stage': self.stage,
+            'state': state,
+            'done': self.done,
+            'total': self.total,
+            'fraction': self.done / self.total if self.total else 1.0,
+            'elapsed_seconds': time.time() - self.start,
+            'mean_tile_seconds': sum(self.tile_seconds) / len(self.tile_seconds) if self.tile_seconds else None,
+            'eta_seconds': eta,
+            'eta': datetime.fromtimestamp(time.time() + eta, timezone.utc).isoformat() if eta is not None else None,
+            'rss': get_tree_rss(os.getpid()),
+            'worker_peak_rss': max(self.worker_rss.values(), default=None),
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }
+
+    def write(self, state):
+        """Writes the status file atomically, so a reader never sees a partial file, and logs the progress."""
+        status = self.get_status(state)
+        self.last_write = time.time()
+        eta = f"{status['eta_seconds'] / 60:.1f} min" if status['eta_seconds'] is not None else 'unknown'
+        logger.info(f"{self.stage}: {self.done}/{self.total} tiles {state}, ETA {eta}, {status['rss'] / 1e9:.2f} GB resident.")
+        if self.status_path is None:
+            return
+
+        os.makedirs(os.path.dirname(self.status_path), exist_ok=True)
+        tmp_path = f'{self.status_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, self.status_path)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+import h5py
+import logging
+from numpy.lib.stride_tricks import sliding_window_view
+from . import logging_config
+from .synthetic_slides import load_ground_truth, map_to_fixed
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+"""
+Target registration error
+"""
+
+def load_channel(path, channel=2):
+    """Loads a channel of an HDF5 image, by default the DAPI channel used for registration."""
+    with h5py.File(path, 'r') as f:
+        return f['dataset'][:, :, channel]
+
+def get_evaluation_points(fixed, spacing=256, patch_size=128, min_texture=0.25):
+    """
+    Places evaluation points on a regular grid of the fixed image, keeping those whose patch has enough
+    texture for its displacement to be measured, i.e. whose standard deviation reaches a fraction of the
+    median one of the textured patches.
+
+    Parameters:
+        fixed (np.ndarray): Fixed image channel.
+        spacing (int, optional): Spacing of the grid, in pixels.
+        patch_size (int, optional): Size of the patches centered on the points.
+        min_texture (float, optional): Fraction of the median standard deviation of the patches a patch must reach.
+
+    Returns:
+        tuple: Row and column coordinates of the points.
+    """
+    half = patch_size // 2
+    rows, cols = np.meshgrid(np.arange(half, fixed.shape[0] - half + 1, spacing),
+                             np.arange(half, fixed.shape[1] - half + 1, spacing), indexing='ij')
+    rows, cols = rows.ravel(), cols.ravel()
+
+    std = extract_patches(fixed, rows, cols, patch_size).std(axis=(1, 2))
+    keep = std >= min_texture * np.median(std[std > 0]) if np.any(std > 0) else np.zeros(len(std), dtype=bool)
+
+    return rows[keep], cols[keep]
+
+def extract_patches(image, rows, cols, patch_size):
+    """
+    Extracts square patches centered on points, as views into the image.
+
+    Returns:
+        np.ndarray: Patches of shape (n_points, patch_size, patch_size).
+    """
+    half = patch_size // 2
+    windows = sliding_window_view(image, (patch_size, patch_size))
+
+    return windows[np.asarray(rows) - half, np.asarray(cols) - half]
+
+def estimate_displacements(fixed_patches, patches):
+    """
+    Estimates the displacement of the content of each patch relative to the fixed patch at the same
+    position by phase correlation, in one batch of FFTs. The peak of the correlation is refined to
+    subpixel precision from its largest neighbour along each axis.
+
+    Parameters:
+        fixed_patches (np.ndarray): Patches of the fixed image, of shape (n, size, size).
+        patches (np.ndarray): Patches of the registered image at the same positions.
+
+    Returns:
+        tuple: Row and column displacements, such that patches[p] shows fixed_patches[p + displacement],
+               and the height of the correlation peak, low when the patches do not match.
+    """
+    n, size = fixed_patches.shape[0], fixed_patches.shape[1]
+    window = np.outer(np.hanning(size), np.hanning(size)).astype(np.float32)
+
+    def normalize(x):
+        x = x.astype(np.float32)
+        return (x - x.mean(axis=(1, 2), keepdims=True)) * window
+
+    cross_power = np.fft.rfft2(normalize(fixed_patches)) * np.conj(np.fft.rfft2(normalize(patches)))
+    cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+    correlation = np.fft.irfft2(cross_power, s=(size, size)).reshape(n, -1)
+
+    peak = np.argmax(correlation, axis=1)
+    peak_rows, peak_cols = np.unravel_index(peak, (size, size))
+    correlation = correlation.reshape(n, size, size)
+    points = np.arange(n)
+
+    def refine(center, before, after):
+        # The phase correlation peak is a sampled sinc, whose neighbour on the side of the true peak gives its offset
+        side = np.where(after > before, after, -before)
+        return np.where(center + np.abs(side) > 0, side / (center + np.abs(side)), 0)
+
+    center = correlation[points, peak_rows, peak_cols]
+    row_offset = refine(center, correlation[points, (peak_rows - 1) % size, peak_cols], correlation[points, (peak_rows + 1) % size, peak_cols])
+    col_offset = refine(center, correlation[points, peak_rows, (peak_cols - 1) % size], correlation[points, peak_rows, (peak_cols + 1) % size])
+
+    # Peaks past the middle of the patch are negative displacements
+    d_rows = (peak_rows + size // 2) % size - size // 2 + row_offset
+    d_cols = (peak_cols + size // 2) % size - size // 2 + col_offset
+
+    return d_rows, d_cols, center
+
+def get_ground_truth_displacements(ground_truth_path, rows, cols):
+    """
+    Displacements of the unregistered moving image relative to the fixed image at the evaluation points,
+    from the ground truth transformation of a synthetic slide.
+
+    Returns:
+        tuple: Row and column displacements, which the registration should undo.
+    """
+    ground_truth = load_ground_truth(ground_truth_path)
+    fixed_x, fixed_y = map_to_fixed(ground_truth, cols, rows)
+
+    return fixed_y - rows, fixed_x - cols
+
+def load_landmarks(landmarks_path, shape, patch_size=128):
+    """
+    Loads pairs of corresponding landmarks from a CSV file with the columns fixed_x, fixed_y, moving_x and
+    moving_y. Landmarks too close to the border of the image for their patch are left out.
+
+    Returns:
+        tuple: Row and column coordinates of the landmarks in the fixed image, and their row and column
+               displacements in the unregistered moving image.
+    """
+    landmarks = pd.read_csv(landmarks_path)
+    rows, cols = landmarks['fixed_y'].round().astype(int).values, landmarks['fixed_x'].round().astype(int).values
+    half = patch_size // 2
+    inside = (rows >= half) & (rows <= shape[0] - half) & (cols >= half) & (cols <= shape[1] - half)
+    if not inside.all():
+        logger.warning(f'{np.count_nonzero(~inside)} landmarks too close to the border of the image are left out.')
+
+    landmarks = landmarks[inside]
+    return (rows[inside], cols[inside],
+            (landmarks['fixed_y'] - landmarks['moving_y']).values, (landmarks['fixed_x'] - landmarks['moving_x']).values)
+
+def summarize_errors(errors, prefix):
+    """Mean, median, 90th percentile and maximum of errors, named after a prefix."""
+    if len(errors) == 0:
+        return {f'{prefix}_{stat}': None for stat in ['mean', 'median', 'p90', 'max']}
+
+    return {
+        f'{prefix}_mean': float(np.mean(errors)),
+        f'{prefix}_median': float(np.median(errors)),
+        f'{prefix}_p90': float(np.percentile(errors, 90)),
+        f'{prefix}_max': float(np.max(errors))
+    }
+
+"""
+Tile similarity and seams
+"""
+
+def compute_tile_ncc(fixed, image, grid):
+    """
+    Computes the normalized cross-correlation between the fixed image and an image over the trimmed region
+    of each crop, i.e. the region it contributes to the stitched image. The sums of each region are
+    reduced one band of crop rows at a time, so only one band is converted to floats.
+
+    Parameters:
+        fixed (np.ndarray): Fixed image channel.
+        image (np.ndarray): Image channel in the frame of the fixed image.
+        grid (CropGrid): Crop grid whose trimmed regions are compared.
+
+    Returns:
+        np.ndarray: NCC of each crop, of shape (n_rows, n_cols). NaN for crops outside the images or without signal.
+    """
+    height, width = min(fixed.shape[0], image.shape[0]), min(fixed.shape[1], image.shape[1])
+    row_bounds = np.append(grid.row_offsets, grid.shape[0]).clip(0, height)
+    col_offsets = grid.col_offsets[grid.col_offsets < width]
+
+    sums = np.zeros((6, grid.n_rows, grid.n_cols))
+    for row in range(grid.n_rows):
+        if row_bounds[row] >= row_bounds[row + 1]:
+            continue
+        f = fixed[row_bounds[row]:row_bounds[row + 1], :width].astype(np.float64)
+        m = image[row_bounds[row]:row_bounds[row + 1], :width].astype(np.float64)
+        for i, values in enumerate([np.ones_like(f), f, m, f * f, m * m, f * m]):
+            sums[i, row, :len(col_offsets)] = np.add.reduceat(values.sum(axis=0), col_offsets)
+
+    n, sum_f, sum_m, sum_ff, sum_mm, sum_fm = sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = sum_fm - sum_f * sum_m / n
+        variance = (sum_ff - sum_f ** 2 / n) * (sum_mm - sum_m ** 2 / n)
+        return np.where(variance > 0, covariance / np.sqrt(variance), np.nan)
+
+def compute_seam_discontinuity(image, grid, n_reference=2):
+    """
+    Measures the discontinuity of a stitched image at the borders between its crops, as the mean absolute
+    difference between the pixels on either side of each border, relative to the one between neighbouring
+    pixel lines. A ratio close to 1 means that the seams are not visible.
+
+    Parameters:
+        image (np.ndarray): Stitched image channel.
+        grid (CropGrid): Crop grid the image was stitched from.
+        n_reference (int, optional): Number of pixel lines on each side of a border used as reference.
+
+    Returns:
+        dict: Mean and maximum discontinuity ratio of the borders.
+    """
+    def line_differences(image, positions):
+        # Absolute differences across the lines before positions, averaged along the lines
+        positions = positions[(positions > 0) & (positions < image.shape[1])]
+        return np.abs(image[:, positions].astype(np.float32) - image[:, positions - 1].astype(np.float32)).mean(axis=0)
+
+    ratios = []
+    for image_view, offsets, length in [(image, grid.col_offsets[1:], image.shape[1]), (image.T, grid.row_offsets[1:], image.shape[0])]:
+        offsets = offsets[(offsets > n_reference) & (offsets < length - n_reference)]
+        if len(offsets) == 0:
+            continue
+        seam = line_differences(image_view, offsets)
+        shifts = [shift for shift in range(-n_reference, n_reference + 1) if shift != 0]
+        reference = np.mean([line_differences(image_view, offsets + shift) for shift in shifts], axis=0)
+        ratios.append(seam[reference > 0] / reference[reference > 0])
+
+    ratios = np.concatenate(ratios) if ratios else np.array([])
+    return {
+        'seam_ratio_mean': float(ratios.mean()) if len(ratios) else None,
+        'seam_ratio_max': float(ratios.max()) if len(ratios) else None
+    }
+
+"""
+Evaluation
+"""
+
+def evaluate_registration(fixed_image_path, registered_path, input_path, grid=None, ground_truth_path=None, landmarks_path=None,
+                          spacing=256, patch_size=128, min_peak=0.05):
+    """
+    Evaluates the accuracy of a registered image against the fixed image, and compares it with the image
+    before registration. The target registration error is measured at evaluation points as the residual
+    displacement between the images. Displacements from a ground truth transformation or from landmarks
+    give the error of the unregistered image, and landmarks replace the evaluation points.
+
+    Parameters:
+        fixed_image_path (str): Path to the fixed image.
+        registered_path (str): Path to the registered image.
+        input_path (str): Path to the image before registration, e.g. the affine registered image when
+                          evaluating the diffeomorphic registration.
+        grid (CropGrid, optional): Crop grid of the registration, for the per crop NCC and the seams.
+        ground_truth_path (str, optional): Path to the ground truth of a synthetic moving image.
+        landmarks_path (str, optional): Path to a CSV file of corresponding landmarks.
+        spacing (int, optional): Spacing of the evaluation points.
+        patch_size (int, optional): Size of the patches the displacements are measured on.
+        min_peak (float, optional): Correlation peak below which a displacement is not reliable and left out.
+
+    Returns:
+        tuple: Summary of the metrics, and the measures at each evaluation point as a DataFrame.
+    """
+    fixed = load_channel(fixed_image_path)
+    registered = load_channel(registered_path)
+    before = load_channel(input_path)
+    shape = tuple(min(sizes) for sizes in zip(fixed.shape, registered.shape, before.shape))
+    fixed, registered, before = (image[:shape[0], :shape[1]] for image in (fixed, registered, before))
+
+    points = {}
+    if landmarks_path is not None:
+        rows, cols, points['initial_d_row'], points['initial_d_col'] = load_landmarks(landmarks_path, shape, patch_size)
+    else:
+        rows, cols = get_evaluation_points(fixed, spacing, patch_size)
+        if ground_truth_path is not None:
+            points['initial_d_row'], points['initial_d_col'] = get_ground_truth_displacements(ground_truth_path, rows, cols)
+    points = pd.DataFrame({'row': rows, 'col': cols, **points})
+
+    fixed_patches = extract_patches(fixed, rows, cols, patch_size)
+    for name, image in [('before', before), ('after', registered)]:
+        d_rows, d_cols, peaks = estimate_displacements(fixed_patches, extract_patches(image, rows, cols, patch_size))
+        points[f'{name}_d_row'], points[f'{name}_d_col'], points[f'{name}_peak'] = d_rows, d_cols, peaks
+        points[f'{name}_error'] = np.where(peaks >= min_peak, np.hypot(d_rows, d_cols), np.nan)
+
+    summary = {'n_points': len(points)}
+    if 'initial_d_row' in points:
+        summary.update(summarize_errors(np.hypot(points['initial_d_row'], points['initial_d_col']).values, 'tre_initial'))
+    for name in ['before', 'after']:
+        errors = points[f'{name}_error'].dropna().values
+        summary[f'{name}_reliable_fraction'] = len(errors) / len(points) if len(points) else None
+        summary.update(summarize_errors(errors, f'tre_{name}'))
+
+    if grid is not None:
+        for name, image in [('before', before), ('after', registered)]:
+            ncc = compute_tile_ncc(fixed, image, grid)
+            summary[f'ncc_{name}_median'] = float(np.nanmedian(ncc)) if np.any(~np.isnan(ncc)) else None
+            summary[f'ncc_{name}_min'] = float(np.nanmin(ncc)) if np.any(~np.isnan(ncc)) else None
+        summary.update(compute_seam_discontinuity(registered, grid))
+
+    logger.info(f"Median target registration error {summary['tre_before_median']} px before and "
+                f"{summary['tre_after_median']} px after registration, over {len(points)} points.")
+
+    return summary, points
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+from dipy.align.imwarp import RegistrationStages
+from . import logging_config
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+"""
+Telemetry recording
+"""
+
+class RegistrationTelemetry:
+    """
+    Callback of the DIPY diffeomorphic optimizer recording the convergence of a registration: the number
+    of iterations run at each level (coarse to fine), the energy reached at the end of each level and the
+    wall time of the optimization.
+    """
+    def __init__(self):
+        self.iterations = []
+        self.energies = []
+        self.wall_time = None
+        self._start = None
+
+    def __call__(self, sdr, stage):
+        if stage == RegistrationStages.OPT_START:
+            self._start = time.perf_counter()
+        elif stage == RegistrationStages.SCALE_END:
+            self.iterations.append(int(sdr.niter))
+            self.energies.append(float(sdr.energy_list[-1]) if sdr.energy_list else np.nan)
+        elif stage == RegistrationStages.OPT_END:
+            self.wall_time = time.perf_counter() - self._start
+
+    def to_record(self):
+        """
+        Flatten the telemetry into a record with one iteration column per level.
+
+        Returns:
+            dict: Iterations per level, final energy and wall time of the registration.
+        """
+        record = {f'iterations_{level}': n for level, n in enumerate(self.iterations)}
+        record['final_energy'] = self.energies[-1] if self.energies else np.nan
+        record['wall_time'] = self.wall_time
+
+        return record
+
+"""
+Telemetry files
+"""
+
+def save_telemetry(records, registration_params, telemetry_path):
+    """
+    Save the telemetry of the crops of a moving image. Records of crops registered in a previous run are kept.
+
+    Parameters:
+        records (dict): Telemetry record of each crop, indexed by (row, column).
+        registration_params (dict): Parameters of the diffeomorphic registration the records were produced with.
+        telemetry_path (str): Path to the telemetry file.
+    """
+    level_iters = ','.join(map(str, registration_params['level_iters']))
+    telemetry = pd.DataFrame([
+        {'row': row, 'col': col, 'metric': registration_params['metric'], 'level_iters': level_iters, **record}
+        for (row, col), record in records.items()
+    ])
+    if telemetry.empty:
+        return
+
+    if os.path.exists(telemetry_path):
+        telemetry = pd.concat([pd.read_csv(telemetry_path), telemetry]).drop_duplicates(['row', 'col'], keep='last')
+
+    os.makedirs(os.path.dirname(telemetry_path), exist_ok=True)
+    telemetry.sort_values(['row', 'col']).to_csv(telemetry_path, index=False)
+    logger.info(f'Registration telemetry of {len(records)} crops saved to {telemetry_path}.')
+
+"""
+Quality maps
+"""
+
+def save_quality_map(scores, skip_threshold, quality_map_path):
+    """
+    Save the similarity score of each crop after affine registration, and whether its diffeomorphic 
+    registration was skipped. Scores of crops processed in a previous run are kept.
+
+    Parameters:
+        scores (dict): Similarity score of each crop, indexed by (row, column).
+        skip_threshold (float): Threshold above which the diffeomorphic registration of a crop is skipped.
+        quality_map_path (str): Path to the quality map file.
+    """
+    quality_map = pd.DataFrame(
+        [(row, col, score, score >= skip_threshold) for (row, col), score in scores.items()],
+        columns=['row', 'col', 'score', 'skipped']
+    )
+    if os.path.exists(quality_map_path):
+        quality_map = pd.concat([pd.read_csv(quality_map_path), quality_map]).drop_duplicates(['row', 'col'], keep='last')
+
+    os.makedirs(os.path.dirname(quality_map_path), exist_ok=True)
+    quality_map.sort_values(['row', 'col']).to_csv(quality_map_path, index=False)
+
+    n_skipped = int(quality_map['skipped'].sum())
+    logger.info(f'Diffeomorphic registration skipped for {n_skipped}/{len(quality_map)} crops. Quality map saved to {quality_map_path}.')
+
+"""
+Batches
+"""
+
+def gather_batch_files(path, batch_paths):
+    """
+    Merge the per-crop files (quality map or telemetry) written by the batches of an image into its file,
+    and remove the batch files. Rows of crops present in several files are taken from the last one.
+
+    Parameters:
+        path (str): Path to the per-image file.
+        batch_paths (list): Paths to the batch files, as returned by get_batch_path.
+
+    Returns:
+        int: Number of batch files merged.
+    """
+    batch_paths = [batch_path for batch_path in batch_paths if os.path.exists(batch_path)]
+    if not batch_paths:
+        return 0
+
+    parts = [pd.read_csv(path)] if os.path.exists(path) else []
+    merged = pd.concat(parts + [pd.read_csv(batch_path) for batch_path in batch_paths]).drop_duplicates(['row', 'col'], keep='last')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    merged.sort_values(['row', 'col']).to_csv(path, index=False)
+
+    for batch_path in batch_paths:
+        os.remove(batch_path)
+    batch_dir = os.path.dirname(batch_paths[0])
+    if not os.listdir(batch_dir):
+        os.rmdir(batch_dir)
+
+    return len(batch_paths)
+
+"""
+Aggregation
+"""
+
+def summarize_telemetry(telemetry):
+    """
+    Aggregate crop telemetry per registration schedule. For each level, reports the mean number of
+    iterations and the fraction of crops that ran out of iterations before reaching the tolerance,
+    which is the signal to add iterations to that level (or to remove them when it stays close to zero).
+
+    Parameters:
+        telemetry (pd.DataFrame): Crop telemetry, as saved by save_telemetry.
+
+    Returns:
+        pd.DataFrame: One row per metric and level schedule.
+    """
+    rows = []
+    for (metric, level_iters), group in telemetry.groupby(['metric', 'level_iters']):
+        caps = [int(n) for n in str(level_iters).split(',')]
+        row = {'metric': metric, 'level_iters': level_iters, 'n_crops': len(group)}
+
+        for level, cap in enumerate(caps):
+            iterations = group[f'iterations_{level}']
+            row[f'mean_iterations_{level}'] = iterations.mean()
+            row[f'capped_fraction_{level}'] = (iterations >= cap).mean()
+
+        row['mean_final_energy'] = group['final_energy'].mean()
+        row['mean_wall_time'] = group['wall_time'].mean()
+        row['total_wall_time'] = group['wall_time'].sum()
+        rows.append(row)
+
+    return pd.DataFrame(rows)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+import os
+import math
+import logging
+import h5py
+import nd2
+import numpy as np
+from . import logging_config
+from .crop_grid import CropGrid
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+GB = 1024 ** 3
+
+# Coefficients of the stage models, measured on uint16 images with three channels
+DEFAULT_COEFFICIENTS = {
+    'bytes_per_pixel': 2,                   # uint16 pixels
+    'base_memory': 0.5 * GB,                # Interpreter and imported libraries
+    'syn_bytes_per_pixel': 160,             # Peak memory of a DIPY SyN registration per crop pixel
+    'syn_seconds_per_pixel': 1.2e-6,        # SyN time per crop pixel and iteration at the finest level
+    'transform_seconds_per_pixel': 1e-7,    # Time of applying a diffeomorphic mapping per pixel and channel
+    'warp_seconds_per_pixel': 1e-8,         # Time of applying the affine transformation per pixel and channel
+    'io_bytes_per_second': 100e6,           # Throughput of reading and writing images, crops and pickles
+    'mapping_bytes_per_pixel': 16,          # Size of a pickled diffeomorphic mapping per crop pixel
+    'scale_space_bytes_per_pixel': 8        # Size of a pickled scale space per crop pixel
+}
+
+# Stages with resource columns in the sample sheet, named after the processes they size
+STAGES = ['conversion', 'affine', 'diffeomorphic', 'export', 'register']
+
+"""
+Image probing
+"""
+
+def get_image_shape(path):
+    """
+    Reads the shape of an image from its metadata, without loading the pixels. The converted HDF5 image
+    is probed if it exists, as the nd2 file may have been deleted after conversion.
+
+    Parameters:
+        path (str): Path to the nd2 image, as written in the sample sheet.
+
+    Returns:
+        tuple: (height, width, channels) of the image.
+    """
+    h5_path = path.replace('.nd2', '.h5')
+    if os.path.exists(h5_path):
+        with h5py.File(h5_path, 'r') as f:
+            height, width, n_channels = f['dataset'].shape
+    else:
+        with nd2.ND2File(path) as nd2_file:
+            sizes = nd2_file.sizes
+            height, width, n_channels = sizes['Y'], sizes['X'], sizes.get('C', 1)
+
+    return int(height), int(width), int(n_channels)
+
+def get_crop_pixels(grid):
+    """
+    Computes the number of pixels of the largest crop and of all crops of a grid, overlaps included.
+
+    Parameters:
+        grid (CropGrid): Crop grid of the image.
+
+    Returns:
+        tuple: Pixels of the largest crop and total pixels of the crops.
+    """
+    row_extents = grid.row_ends - grid.row_starts
+    col_extents = grid.col_ends - grid.col_starts
+
+    return int(row_extents.max() * col_extents.max()), int(row_extents.sum() * col_extents.sum())
+
+def get_effective_iterations(level_iters):
+    """
+    Converts the iterations of each level, from coarse to fine, to iterations at the finest level.
+    Each coarser level has a quarter of the pixels of the next one.
+    """
+    n_levels = len(level_iters)
+    return sum(n / 4 ** (n_levels - 1 - level) for level, n in enumerate(level_iters))
+
+"""
+Calibration
+"""
+
+def get_syn_time_coefficient(telemetry, grid):
+    """
+    Measures the SyN time per crop pixel and finest level iteration from the telemetry of a registered
+    image, using the iterations each crop actually ran.
+
+    Parameters:
+        telemetry (pd.DataFrame): Crop telemetry, as saved by save_telemetry.
+        grid (CropGrid): Crop grid the image was registered with.
+
+    Returns:
+        float: Median time per pixel and iteration, or None if the telemetry holds no timed crop.
+    """
+    level_columns = sorted((column for column in telemetry.columns if column.startswith('iterations_')),
+                           key=lambda column: int(column.split('_')[1]))
+    coefficients = []
+    for _, record in telemetry.iterrows():
+        start_row, end_row, start_col, end_col = grid.area((int(record['row']), int(record['col'])))
+        iterations = get_effective_iterations([record[column] for column in level_columns])
+        if record['wall_time'] > 0 and iterations > 0:
+            coefficients.append(record['wall_time'] / ((end_row - start_row) * (end_col - start_col) * iterations))
+
+    return float(np.median(coefficients)) if coefficients else None
+
+"""
+Stage models
+"""
+
+def predict_resources(shape, fixed_shape, crop_width_x, crop_width_y, overlap_x, overlap_y, max_workers,
+                      level_iters, n_batches=1, blend=False, coefficients=None):
+    """
+    Predicts the peak memory, the CPUs, the CPU time and the wall time of each stage of the registration
+    of a moving image, and the scratch disk taken by its intermediate files.
+
+    Conversion loads the whole nd2 image and writes it to HDF5. Affine registration loads the moving
+    image and pads each channel to the shape shared with the fixed image, before warping and saving its
+    crops. The diffeomorphic stage crops the fixed image in the same way, then registers max_workers
+    crops at a time, and the export stitches the crops into the registered image a few tiles at a time.
+    The fused engine holds the crops of both images in shared memory while max_workers crops are registered.
+
+    Parameters:
+        shape (tuple): Shape (height, width, channels) of the moving image.
+        fixed_shape (tuple): Shape (height, width, channels) of the fixed image.
+        crop_width_x (int): Width of each crop.
+        crop_width_y (int): Height of each crop.
+        overlap_x (int): Overlap of each crop along the x-axis.
+        overlap_y (int): Overlap of each crop along the y-axis.
+        max_workers (int): Number of workers of the diffeomorphic registration and of the export.
+        level_iters (list): Maximum number of diffeomorphic registration iterations at each level.
+        n_batches (int, optional): Number of batches the crops are registered in.
+        blend (bool, optional): Whether the crops are feather blended when stitched.
+        coefficients (dict, optional): Coefficients overriding DEFAULT_COEFFICIENTS.
+
+    Returns:
+        dict: For each stage, the memory (bytes), cpus, cpu_seconds and wall_seconds of one task, and
+              the disk (bytes) its outputs take.
+    """
+    k = {**DEFAULT_COEFFICIENTS, **(coefficients or {})}
+    n_channels = shape[2]
+    bpp = k['bytes_per_pixel']
+    io_rate = k['io_bytes_per_second']
+
+    grid = CropGrid((max(shape[0], fixed_shape[0]), max(shape[1], fixed_shape[1])),
+                    crop_width_x, crop_width_y, overlap_x, overlap_y)
+    crop_pixels, total_crop_pixels = get_crop_pixels(grid)
+
+    image_bytes = shape[0] * shape[1] * n_channels * bpp
+    fixed_bytes = fixed_shape[0] * fixed_shape[1] * fixed_shape[2] * bpp
+    padded_channel_bytes = grid.shape[0] * grid.shape[1] * bpp
+    padded_bytes = padded_channel_bytes * n_channels
+    crops_bytes = total_crop_pixels * n_channels * bpp
+    crop_bytes = crop_pixels * n_channels * bpp
+
+    stages = {}
+
+    # The nd2 array and its HDF5 copy
+    seconds = 2 * image_bytes / io_rate
+    stages['conversion'] = {
+        'memory': k['base_memory'] + 2 * image_bytes,
+        'cpus': 1,
+        'cpu_seconds': seconds,
+        'wall_seconds': seconds,
+        'disk': image_bytes
+    }
+
+    # The moving image, a channel and its padded copy, and the dense crops the transformation is computed on
+    seconds = (image_bytes + crops_bytes) / io_rate + total_crop_pixels * n_channels * k['warp_seconds_per_pixel']
+    stages['affine'] = {
+        'memory': k['base_memory'] + image_bytes + 2 * padded_channel_bytes + 4 * crop_bytes,
+        'cpus': 1,
+        'cpu_seconds': seconds,
+        'wall_seconds': seconds,
+        'disk': crops_bytes
+    }
+
+    # Cropping the fixed image, then max_workers registrations each holding a fixed and a moving crop
+    cropping_memory = k['base_memory'] + fixed_bytes + 2 * padded_channel_bytes
+    cropping_seconds = (fixed_bytes + crops_bytes) / io_rate
+    registration_memory = k['base_memory'] + max_workers * (k['syn_bytes_per_pixel'] * crop_pixels + 2 * crop_bytes)
+    registration_seconds = (
+        total_crop_pixels * get_effective_iterations(level_iters) * k['syn_seconds_per_pixel']
+        + total_crop_pixels * n_channels * k['transform_seconds_per_pixel']
+    )
+    registration_io_seconds = 2 * crops_bytes / io_rate
+    stages['diffeomorphic'] = {
+        'memory': max(cropping_memory, registration_memory),
+        'cpus': max_workers,
+        'cpu_seconds': cropping_seconds + registration_io_seconds + registration_seconds,
+        # Each batch crops the fixed image and registers its share of the crops
+        'wall_seconds': cropping_seconds + (registration_io_seconds + registration_seconds / max_workers) / n_batches,
+        'disk': crops_bytes * 2 + total_crop_pixels * (k['mapping_bytes_per_pixel'] + k['scale_space_bytes_per_pixel'])
+    }
+
+    # A bounded number of tiles in flight, and the rolling accumulator of a band of rows when blending
+    blend_memory = 2 * crop_width_y * grid.shape[1] * n_channels * 8 if blend else 0
+    seconds = (crops_bytes + padded_bytes) / io_rate
+    stages['export'] = {
+        'memory': k['base_memory'] + 2 * max_workers * crop_bytes + blend_memory,
+        'cpus': max_workers,
+        'cpu_seconds': seconds,
+        'wall_seconds': seconds,
+        'disk': padded_bytes
+    }
+
+    # The moving image while it is cropped, the crops of both images in shared memory and the registrations
+    shared_memory = total_crop_pixels * bpp + crops_bytes
+    seconds = (image_bytes + fixed_bytes + padded_bytes) / io_rate
+    stages['register'] = {
+        'memory': max(k['base_memory'] + shared_memory + image_bytes, registration_memory + shared_memory + blend_memory),
+        'cpus': max_workers,
+        'cpu_seconds': seconds + registration_seconds,
+        'wall_seconds': seconds + registration_seconds / max_workers,
+        'disk': padded_bytes
+    }
+
+    return stages
+
+"""
+Requirements
+"""
+
+def format_requirements(stages, headroom=1.25, max_memory=None, max_cpus=None, max_time=None):
+    """
+    Converts the predicted resources of the stages to Nextflow memory, cpus and time directives. Memory
+    and time are inflated by a headroom, and rounded up to whole gigabytes and minutes.
+
+    Parameters:
+        stages (dict): Resources of each stage, as returned by predict_resources.
+        headroom (float, optional): Factor applied to the predicted memory and time.
+        max_memory (float, optional): Maximum memory of a task, in gigabytes.
+        max_cpus (int, optional): Maximum number of CPUs of a task.
+        max_time (float, optional): Maximum time of a task, in hours.
+
+    Returns:
+        dict: Columns {stage}_memory, {stage}_cpus and {stage}_time of each stage.
+    """
+    columns = {}
+    for stage, resources in stages.items():
+        memory = max(1, math.ceil(resources['memory'] * headroom / GB))
+        cpus = max(1, resources['cpus'])
+        minutes = max(10, math.ceil(resources['wall_seconds'] * headroom / 60))
+
+        if max_memory is not None and memory > max_memory:
+            logger.warning(f'Predicted memory of the {stage} stage ({memory} GB) exceeds the maximum of {max_memory} GB.')
+            memory = int(max_memory)
+        if max_cpus is not None:
+            cpus = min(cpus, max_cpus)
+        if max_time is not None and minutes > max_time * 60:
+            logger.warning(f'Predicted time of the {stage} stage ({minutes} min) exceeds the maximum of {max_time} h.')
+            minutes = int(max_time * 60)
+
+        columns[f'{stage}_memory'] = f'{memory} GB'
+        columns[f'{stage}_cpus'] = cpus
+        columns[f'{stage}_time'] = f'{minutes}m'
+
+    return columns
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+from . import logging_config
+from .file_catalog import remove_extensions
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Stages record their state in the store at this path, if it is set
+STATE_STORE_ENV = 'REGISTRATION_STATE_STORE'
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+# Stages tracked by the pipeline scripts that complete each status column of the sample sheets. The fused
+# registration completes both registration columns
+SAMPLE_SHEET_STAGES = {
+    'converted': ('convert_to_h5',),
+    'registered_1': ('export_affine', 'register_image'),
+    'registered_2': ('export_diffeomorphic', 'register_image'),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    sample_id TEXT PRIMARY KEY,
+    patient_id TEXT,
+    attributes TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS samples_patient_id ON samples (patient_id);
+
+CREATE TABLE IF NOT EXISTS stages (
+    sample_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    state TEXT NOT NULL,
+    seconds REAL,
+    artifact_key TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (sample_id, stage)
+);
+CREATE INDEX IF NOT EXISTS stages_stage_state ON stages (stage, state);
+"""
+
+def get_sample_id(path):
+    """Identifier of the sample of an image, its filename without extensions, as in the filename column of the sample sheets."""
+    return remove_extensions(os.path.basename(path))
+
+"""
+Sample store
+"""
+
+class SampleStore:
+    """
+    State of the samples of the pipeline: their sample sheet attributes (paths, patient id) and the state
+    of each of their stages, with its duration and the key of its output artifact, stored in an SQLite
+    database. Each stage updates the row of its sample in its own transaction, so concurrent stages never
+    overwrite each other, and sample sheets are exported from the store instead of being merged.
+
+    Attributes:
+        path (str): Path to the database.
+        conn (sqlite3.Connection): Connection to the database.
+    """
+    def __init__(self, path, timeout=60):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Stages of other samples may be writing, in which case the connection waits for its turn. The store is
+        # shared by tasks running on different nodes, so it keeps the default rollback journal, which only relies
+        # on file locks, as write-ahead logging needs memory shared by all the connections on a single host
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def add_samples(self, rows, key, stage_columns=None):
+        """
+        Adds the rows of a sample sheet, or updates the attributes of known samples with its columns.
+
+        Parameters:
+            rows (list): Rows of the sample sheet, as dictionaries.
+            key (str): Column identifying the sample of each row.
+            stage_columns (dict, optional): Boolean columns giving whether a stage is done, e.g. 'converted', 
+                                            mapped to the name of the stage. They only seed the states the
+                                            stages did not record themselves, or report a pending stage done.
+        """
+        stage_columns = stage_columns or {}
+        with self.conn:
+            known = dict(self.conn.execute('SELECT sample_id, attributes FROM samples'))
+            for row in rows:
+                sample_id = str(row[key])
+                attributes = {**json.loads(known.get(sample_id, '{}')),
+                              **{name: value for name, value in row.items() if name != key and name not in stage_columns}}
+                self.conn.execute('INSERT OR REPLACE INTO samples VALUES (?, ?, ?)',
+                                  (sample_id, attributes.get('patient_id'), json.dumps(attributes, default=str)))
+                for column, stage in stage_columns.items():
+                    if column in row:
+                        self._seed_state(sample_id, stage, 'done' if is_true(row[column]) else 'pending')
+
+    def _seed_state(self, sample_id, stage, state):
+        # States recorded by the stages are kept, so that the store, not the files, is the state of the samples
+        self.conn.execute(
+            "INSERT INTO stages (sample_id, stage, state, updated_at) VALUES (?, ?, ?, ?) ON CONFLICT (sample_id, stage) "
+            "DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at "
+            "WHERE stages.state = 'pending' AND excluded.state = 'done'",
+            (sample_id, stage, state, datetime.now(timezone.utc).isoformat())
+        )
+
+    def _set_state(self, sample_id, stage, state, seconds=None, artifact_key=None):
+        if state not in STATES:
+            raise ValueError(f"Unknown state '{state}', expected one of {STATES}.")
+
+        # Samples tracked by their stages before being added from a sample sheet have no attributes yet
+        self.conn.execute('INSERT OR IGNORE INTO samples (sample_id) VALUES (?)', (sample_id,))
+
+        # Duration and key of a previous run are kept until the stage reports new ones
+        self.conn.execute(
+            'INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (sample_id, stage) DO UPDATE SET '
+            'state = excluded.state, seconds = coalesce(excluded.seconds, seconds), '
+            'artifact_key = coalesce(excluded.artifact_key, artifact_key), updated_at = excluded.updated_at',
+            (sample_id, stage, state, seconds, artifact_key, datetime.now(timezone.utc).isoformat())
+        )
+
+    def set_state(self, sample_id, stage, state, seconds=None, artifact_key=None):
+        """
+        Records the state of a stage of a sample, in its own transaction.
+
+        Parameters:
+            sample_id (str): Identifier of the sample.
+            stage (str): Name of the stage.
+            state (str): One of 'pending', 'running', 'done' and 'failed'.
+            seconds (float, optional): Duration of the stage.
+            artifact_key (str, optional): Key of the output artifact of the stage.
+        """
+        with self.conn:
+            self._set_state(sample_id, stage, state, seconds, artifact_key)
+
+    def get_pending(self, stages):
+        """
+        Samples with at least one of the given stages not done.
+
+        Parameters:
+            stages (list): Names of the stages. An item may be a tuple of alternative stages, done when
+                           any of them is done, e.g. ('export_diffeomorphic', 'register_image').
+
+        Returns:
+            list: Identifiers of the pending samples, sorted.
+        """
+        groups = [(stage,) if isinstance(stage, str) else tuple(stage) for stage in stages]
+        conditions = ' OR '.join(
+            f"NOT EXISTS (SELECT 1 FROM stages st WHERE st.sample_id = s.sample_id AND st.state = 'done' "
+            f"AND st.stage IN ({', '.join('?' * len(group))}))"
+            for group in groups
+        )
+        rows = self.conn.execute(f'SELECT s.sample_id FROM samples s WHERE {conditions} ORDER BY s.sample_id',
+                                 [stage for group in groups for stage in group])
+        return [row[0] for row in rows]
+
+    def get_counts(self):
+        """Number of samples in each state, for each stage."""
+        rows = self.conn.execute('SELECT stage, state, count(*) FROM stages GROUP BY stage, state ORDER BY stage, state')
+        counts = {}
+        for stage, state, count in rows:
+            counts.setdefault(stage, {})[state] = count
+        return counts
+
+    def export(self, stages=None, sample_ids=None):
+        """
+        Sample sheet view of the store: the attributes of each sample and, for each stage, whether it is done,
+        its duration and the key of its output artifact.
+
+        Parameters:
+            stages (list, optional): Stages to export, in the order of their columns. Defaults to every stage.
+            sample_ids (list, optional): Samples to export. Defaults to every sample.
+
+        Returns:
+            list: One dictionary per sample, sorted by identifier.
+        """
+        if stages is None:
+            stages = [row[0] for row in self.conn.execute('SELECT DISTINCT stage FROM stages ORDER BY stage')]
+        selected = set(sample_ids) if sample_ids is not None else None
+
+        states = {}
+        for sample_id, stage, state, seconds, artifact_key in self.conn.execute(
+                'SELECT sample_id, stage, state, seconds, artifact_key FROM stages'):
+            states[sample_id, stage] = (state, seconds, artifact_key)
+
+        rows = []
+        for sample_id, attributes in self.conn.execute('SELECT sample_id, attributes FROM samples ORDER BY sample_id'):
+            if selected is not None and sample_id not in selected:
+                continue
+
+            row = {**json.loads(attributes), 'sample_id': sample_id}
+            for stage in stages:
+                state, seconds, artifact_key = states.get((sample_id, stage), (None, None, None))
+                row[stage] = state == 'done'
+                if seconds is not None:
+                    row[f'{stage}_seconds'] = seconds
+                if artifact_key is not None:
+                    row[f'{stage}_key'] = artifact_key
+            rows.append(row)
+
+        return rows
+
+def is_true(value):
+    """Whether a status value of a sample sheet means done, as read by pandas or csv."""
+    if isinstance(value, str):
+        return value.strip().lower() == 'true'
+    return bool(value) and value == value
+
+"""
+Stage tracking
+"""
+
+# Stage tracked by each thread, as a process may register several samples concurrently
+_tracked = threading.local()
+
+class StageTracker:
+    """
+    Records a stage of a sample as running, then as done with its duration, or as failed.
+
+    Attributes:
+        store_path (str): Path to the store.
+        sample_id (str): Identifier of the sample.
+        stage (str): Name of the stage.
+        artifact_key (str): Key of the output artifact, reported by the stage with set_artifact_key.
+    """
+    def __init__(self, store_path, sample_id, stage):
+        self.store_path = store_path
+        self.sample_id = sample_id
+        self.stage = stage
+        self.artifact_key = None
+
+    def _set_state(self, state, seconds=None):
+        # The stage goes on if the store cannot be written, e.g. on a file system without locks
+        try:
+            with SampleStore(self.store_path) as store:
+                store.set_state(self.sample_id, self.stage, state, seconds, self.artifact_key)
+        except sqlite3.Error as e:
+            logger.warning(f'State {state} of {self.stage} not recorded for {self.sample_id}: {e}')
+
+    def __enter__(self):
+        _tracked.stage = self
+        self.start = time.perf_counter()
+        self._set_state('running')
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _tracked.stage = None
+        if exc_type is not None:
+            # The key of the last output written is kept
+            self.artifact_key = None
+        self._set_state('failed' if exc_type is not None else 'done', time.perf_counter() - self.start)
+
+class _NullTracker:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+def track_stage(stage, input_path, store_path=None):
+    """
+    Tracks a stage of the sample of an image in the state store, if one is set.
+
+    Parameters:
+        stage (str): Name of the stage.
+        input_path (str): Path to the image.
+        store_path (str, optional): Path to the store. Defaults to the REGISTRATION_STATE_STORE variable.
+
+    Returns:
+        StageTracker: Context manager recording the stage, doing nothing if no store is set.
+    """
+    store_path = store_path or os.environ.get(STATE_STORE_ENV)
+    if not store_path:
+        return _NullTracker()
+    return StageTracker(store_path, get_sample_id(input_path), stage)
+
+def set_artifact_key(key):
+    """Reports the key of the output artifact of the tracked stage, recorded when it ends."""
+    stage = getattr(_tracked, 'stage', None)
+    if stage is not None:
+        stage.artifact_key = key
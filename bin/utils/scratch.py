@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+from . import logging_config
+from .resource_model import GB
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+LEASES_FILENAME = '.leases.json'
+RESERVATIONS_FILENAME = '.scratch_reservations.json'
+
+"""
+Locked ledgers
+"""
+
+@contextmanager
+def locked_ledger(path):
+    """
+    Opens a JSON ledger shared by several processes. The ledger is read under an exclusive lock, modified
+    by the caller and written back when the context exits.
+
+    Parameters:
+        path (str): Path to the ledger file.
+
+    Yields:
+        dict: Content of the ledger, empty if it does not exist yet.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as f:
+                ledger = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            ledger = {}
+
+        yield ledger
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(ledger, f)
+        os.replace(tmp_path, path)
+
+"""
+Artifact release
+"""
+
+def release_artifacts(paths):
+    """
+    Deletes artifacts consumed by every stage that needs them. Their keys are kept in the artifact index
+    of their directory, so that the keys of the artifacts computed from them can still be derived, while
+    the missing files make them invalid, and recomputed if they are needed again.
+
+    Parameters:
+        paths (list): Paths to the artifacts.
+
+    Returns:
+        int: Number of bytes freed.
+    """
+    freed = 0
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except FileNotFoundError:
+            pass
+
+    return freed
+
+def check_artifacts(paths, stage):
+    """
+    Checks that the input artifacts of a stage exist, as they may have been deleted once consumed.
+
+    Parameters:
+        paths (list): Paths to the input artifacts.
+        stage (str): Name of the upstream stage writing them, for the error message.
+
+    Raises:
+        FileNotFoundError: If an input artifact is missing.
+    """
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} input artifacts are missing, e.g. {missing[:3]}. They are deleted once "
+                                f"consumed when checkpoints are deleted, run the {stage} again to recompute them.")
+
+def acquire_lease(directory, holder):
+    """
+    Records that a process needs the artifacts of a directory shared by several processes, such as the
+    crops of a fixed image shared by its moving images.
+
+    Parameters:
+        directory (str): Directory of the shared artifacts.
+        holder (str): Identifier of the process, e.g. the moving image and its batch.
+    """
+    with locked_ledger(os.path.join(directory, LEASES_FILENAME)) as leases:
+        leases[holder] = time.time()
+
+def release_lease(directory, holder, paths=None):
+    """
+    Drops the lease of a process on a shared directory, and deletes its artifacts if no other process
+    holds a lease on them. Deleting under the lock keeps a process acquiring a lease in the meantime from
+    using artifacts being deleted.
+
+    Parameters:
+        directory (str): Directory of the shared artifacts.
+        holder (str): Identifier of the process.
+        paths (list, optional): Artifacts deleted with the last lease. Nothing is deleted if None.
+
+    Returns:
+        int: Number of bytes freed.
+    """
+    with locked_ledger(os.path.join(directory, LEASES_FILENAME)) as leases:
+        leases.pop(holder, None)
+        if leases or paths is None:
+            return 0
+        return release_artifacts(paths)
+
+"""
+Scratch budget
+"""
+
+def get_directory_size(directory):
+    """
+    Computes the size of the files of a directory and of its subdirectories.
+
+    Parameters:
+        directory (str): Path to the directory.
+
+    Returns:
+        int: Size in bytes, 0 if the directory does not exist.
+    """
+    size = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                size += get_directory_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            # Deleted by another process while scanning
+            continue
+
+    return size
+
+def get_scratch_usage(scratch_dirs):
+    """Size in bytes of the scratch directories."""
+    return sum(get_directory_size(directory) for directory in scratch_dirs)
+
+def reserve_scratch(scratch_dirs, budget, holder, required, poll_interval=30):
+    """
+    Waits until the scratch directories have room for the intermediate artifacts of an image within the
+    budget, then reserves it. This throttles the images entering the pipeline, while the images already
+    in it keep running and free their artifacts as they are consumed, so waiting never blocks them.
+
+    Space reserved by other images still being written counts against the budget, as their artifacts are
+    not on disk yet. An image requiring more than the whole budget is started with a warning, as waiting
+    would not help.
+
+    Parameters:
+        scratch_dirs (list): Scratch directories sharing the budget. The ledger of reservations is kept in the first one.
+        budget (float): Scratch budget in bytes.
+        holder (str): Identifier of the image.
+        required (float): Scratch space the image is predicted to take, in bytes.
+        poll_interval (float, optional): Seconds between two measures of the scratch usage.
+
+    Returns:
+        float: Seconds waited.
+    """
+    ledger_path = os.path.join(scratch_dirs[0], RESERVATIONS_FILENAME)
+    if required > budget:
+        logger.warning(f'{holder} needs {required / GB:.1f} GB of scratch space, more than the budget of {budget / GB:.1f} GB.')
+        with locked_ledger(ledger_path) as reservations:
+            reservations[holder] = required
+        return 0
+
+    start = time.time()
+    while True:
+        usage = get_scratch_usage(scratch_dirs)
+        with locked_ledger(ledger_path) as reservations:
+            # A retried task replaces the reservation of its previous attempt
+            reservations.pop(holder, None)
+            reserved = sum(reservations.values())
+            if usage + reserved + required <= budget:
+                reservations[holder] = required
+                break
+
+        logger.info(f'Waiting for scratch space for {holder}: {usage / GB:.1f} GB used and {reserved / GB:.1f} GB reserved, '
+                    f'{required / GB:.1f} GB needed within a budget of {budget / GB:.1f} GB.')
+        time.sleep(poll_interval)
+
+    waited = time.time() - start
+    if waited > 0.5:
+        logger.info(f'Scratch space reserved for {holder} after waiting {waited:.0f} s.')
+    return waited
+
+def release_reservation(scratch_dirs, holder, keep=0):
+    """
+    Drops the reservation of an image once its artifacts are written and counted by the scratch usage, or
+    reduces it to the share of the stages still to write theirs.
+
+    Parameters:
+        scratch_dirs (list): Scratch directories sharing the budget. The ledger of reservations is kept in the first one.
+        holder (str): Identifier of the image.
+        keep (float, optional): Scratch space kept reserved for the following stages, in bytes.
+    """
+    with locked_ledger(os.path.join(scratch_dirs[0], RESERVATIONS_FILENAME)) as reservations:
+        if keep > 0 and holder in reservations:
+            reservations[holder] = min(reservations[holder], keep)
+        else:
+            reservations.pop(holder, None)
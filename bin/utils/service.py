@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import logging
+from multiprocessing.connection import Client
+from multiprocessing.reduction import send_handle, recv_handle
+from . import logging_config
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Scripts submit their job to the registration service listening at this address, if it is set
+SERVICE_ADDRESS_ENV = 'REGISTRATION_SERVICE_ADDRESS'
+
+# Variables of the client forwarded to the job, e.g. the profile directory. Thread limits of numerical
+# libraries are not, as they were read when the service imported them
+FORWARDED_ENV_PREFIX = 'REGISTRATION_'
+
+"""
+Client side
+"""
+
+def get_service_address():
+    return os.environ.get(SERVICE_ADDRESS_ENV) or None
+
+def submit_job(script_path, argv, address=None):
+    """
+    Runs a script in the registration service instead of a new interpreter. The standard streams of the
+    client are passed to the job, so its output goes where the output of the script would go, and the
+    client waits for the job to end.
+
+    Parameters:
+        script_path (str): Path to the script.
+        argv (list): Command line arguments of the script.
+        address (str, optional): Path to the socket of the service. Defaults to the REGISTRATION_SERVICE_ADDRESS variable.
+
+    Returns:
+        int: Exit code of the job, or None if no service is reachable and the script should run locally.
+    """
+    address = address or get_service_address()
+    if address is None:
+        return None
+
+    try:
+        conn = Client(address, family='AF_UNIX')
+    except OSError as e:
+        logger.warning(f'Registration service unreachable at {address} ({e}), running {os.path.basename(script_path)} locally.')
+        return None
+
+    with conn:
+        conn.send({
+            'script_path': os.path.abspath(script_path),
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': {name: value for name, value in os.environ.items() if name.startswith(FORWARDED_ENV_PREFIX)}
+        })
+        for fd in (sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()):
+            send_handle(conn, fd, None)
+
+        try:
+            return conn.recv()['exitcode']
+        except EOFError:
+            # The job process died without reporting, e.g. terminated or killed for lack of memory
+            logger.error(f'Job {os.path.basename(script_path)} ended without an exit code.')
+            return 1
+
+def run_in_service(script_path):
+    """
+    Submits the current command to the registration service, if one is set, and exits with the exit code
+    of the job. Returns without doing anything otherwise, so that the script runs locally.
+
+    Parameters:
+        script_path (str): Path to the script, i.e. its __file__.
+    """
+    exitcode = submit_job(script_path, sys.argv[1:])
+    if exitcode is not None:
+        sys.exit(exitcode)
+
+"""
+Service side
+"""
+
+def receive_job(conn):
+    """
+    Receives a job submitted by submit_job.
+
+    Returns:
+        tuple: The job and the descriptors of the standard input, output and error of the client.
+    """
+    job = conn.recv()
+    fds = [recv_handle(conn) for _ in range(3)]
+
+    return job, fds
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+import numpy as np
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+"""
+Shared memory arrays
+"""
+
+# Minimal information a worker process needs to attach to a shared array
+SharedArrayDescriptor = namedtuple('SharedArrayDescriptor', ['name', 'shape', 'dtype'])
+
+def create_shared_array(shape, dtype, array=None):
+    """
+    Allocate a NumPy array backed by a shared memory block.
+
+    Parameters:
+        shape (tuple): Shape of the array.
+        dtype (str or np.dtype): Data type of the array.
+        array (np.ndarray, optional): Data to copy into the shared array.
+
+    Returns:
+        tuple: Shared memory block, array view on the block and its descriptor.
+    """
+    dtype = np.dtype(dtype)
+    size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    shared_array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    if array is not None:
+        shared_array[...] = array
+
+    descriptor = SharedArrayDescriptor(shm.name, tuple(shape), dtype.str)
+
+    return shm, shared_array, descriptor
+
+def attach_shared_array(descriptor):
+    """
+    Attach to a shared array created by another process.
+
+    Parameters:
+        descriptor (SharedArrayDescriptor): Name, shape and dtype of the shared array.
+
+    Returns:
+        tuple: Shared memory block and array view on the block. The block must be closed
+               (not unlinked) by the caller once the array is no longer needed.
+    """
+    shm = shared_memory.SharedMemory(name=descriptor.name)
+    shared_array = np.ndarray(descriptor.shape, dtype=np.dtype(descriptor.dtype), buffer=shm.buf)
+
+    return shm, shared_array
+
+def release_shared_arrays(blocks):
+    """
+    Close and unlink shared memory blocks owned by the current process.
+
+    Parameters:
+        blocks (iterable): Shared memory blocks to release.
+    """
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
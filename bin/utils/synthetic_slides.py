@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+import os
+import math
+import itertools
+import functools
+import logging
+import cv2
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .image_stitching import create_stitched_dataset
+from . import logging_config
+
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+# Nuclei and pixel noise are generated per cell of the slide, seeded by the cell position, so that any
+# tile renders the same pixels whatever the tiling
+CELL_SIZE = 256
+
+# Default appearance of the slides, with the DAPI channel last as in the acquired images
+DEFAULT_SLIDE_PARAMS = {
+    'n_channels': 3,
+    'border': 0.04,                 # Width of the blank borders, as a fraction of the smallest side
+    'nuclei_per_cell': 150,         # Mean number of nuclei in a cell of dense tissue
+    'nucleus_radius': (4, 9),       # Range of the semi-axes of the nuclei, in pixels
+    'dapi_intensity': (800, 4000),  # Range of the DAPI intensity of the nuclei
+    'background': 80,               # Autofluorescence of the tissue
+    'tissue_spacing': 1024,         # Spacing of the control points of the tissue density field, in pixels
+    'tissue_threshold': 0.3         # Density below which there is no tissue
+}
+
+# Default range of the random transformation of the moving cycles
+DEFAULT_DEFORMATION_PARAMS = {
+    'max_rotation': 1.0,            # Degrees
+    'max_scale': 0.01,              # Relative scale change
+    'max_translation': 50,          # Pixels
+    'max_displacement': 15,         # Pixels, maximum of the smooth displacement field
+    'displacement_spacing': 512     # Spacing of the control points of the displacement field, in pixels
+}
+
+"""
+Smooth fields
+"""
+
+def create_smooth_field(rng, shape, sigma=1.5):
+    """
+    Creates a smooth random field on a grid of control points, scaled to [-1, 1].
+
+    Parameters:
+        rng (np.random.Generator): Random generator.
+        shape (tuple): Number of control points along each axis.
+        sigma (float, optional): Standard deviation of the Gaussian smoothing, in control points.
+
+    Returns:
+        np.ndarray: The field, of dtype float32.
+    """
+    field = cv2.GaussianBlur(rng.standard_normal(shape).astype(np.float32), (0, 0), sigma, borderType=cv2.BORDER_REFLECT)
+    return field / max(np.abs(field).max(), 1e-6)
+
+def get_control_shape(shape, spacing):
+    """Number of control points of a field covering an image with the given spacing."""
+    return math.ceil(shape[0] / spacing) + 1, math.ceil(shape[1] / spacing) + 1
+
+def sample_field(field, spacing, rows, cols):
+    """
+    Samples a field defined on control points at pixel coordinates, with bicubic interpolation. Tiles and
+    point sets sample the same interpolant, so ground truth points match the rendered images exactly.
+
+    Parameters:
+        field (np.ndarray): Values at the control points, spaced by spacing pixels.
+        spacing (int): Spacing of the control points, in pixels.
+        rows (np.ndarray): Row coordinates of the pixels.
+        cols (np.ndarray): Column coordinates of the pixels, with the same shape as rows.
+
+    Returns:
+        np.ndarray: Values of the field at the pixels, with the shape of rows.
+    """
+    shape = np.shape(rows)
+    map_x = np.asarray(cols, dtype=np.float32).ravel() / spacing
+    map_y = np.asarray(rows, dtype=np.float32).ravel() / spacing
+
+    # cv2.remap is limited to maps with sides below 32767, so pixels are sampled as blocks of a 2D map
+    block = 4096
+    n = map_x.size
+    padded = math.ceil(n / block) * block
+    map_x = np.pad(map_x, (0, padded - n)).reshape(-1, block)
+    map_y = np.pad(map_y, (0, padded - n)).reshape(-1, block)
+
+    values = np.concatenate([
+        cv2.remap(field, map_x[i:i + block], map_y[i:i + block], cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        for i in range(0, map_x.shape[0], block)
+    ]).ravel()[:n]
+
+    return values.reshape(shape)
+
+"""
+Ground truth
+"""
+
+def create_ground_truth(rng, shape, max_rotation=1.0, max_scale=0.01, max_translation=50, max_displacement=15,
+                        displacement_spacing=512):
+    """
+    Draws the transformation of a moving cycle: a random affine transformation around the center of the
+    image followed by a smooth displacement field. The moving image at pixel (x, y) shows the fixed image
+    at phi(x, y) = A [x, y, 1] + u(x, y).
+
+    Parameters:
+        rng (np.random.Generator): Random generator.
+        shape (tuple): Shape (height, width) of the images.
+        max_rotation (float, optional): Maximum rotation, in degrees.
+        max_scale (float, optional): Maximum relative scale change.
+        max_translation (float, optional): Maximum translation along each axis, in pixels.
+        max_displacement (float, optional): Maximum displacement of the smooth field along each axis, in pixels.
+        displacement_spacing (int, optional): Spacing of the control points of the displacement field, in pixels.
+
+    Returns:
+        dict: Affine matrix (2, 3) mapping moving (x, y) to fixed (x, y), displacement field (2, rows, cols)
+              (dx, dy) on the control points, and their spacing.
+    """
+    height, width = shape[:2]
+    angle = rng.uniform(-max_rotation, max_rotation)
+    scale = 1 + rng.uniform(-max_scale, max_scale)
+    affine = cv2.getRotationMatrix2D((width / 2, height / 2), angle, scale)
+    affine[:, 2] += rng.uniform(-max_translation, max_translation, size=2)
+
+    control_shape = get_control_shape(shape, displacement_spacing)
+    displacement = np.stack([create_smooth_field(rng, control_shape) * max_displacement for _ in range(2)])
+
+    return {
+        'affine': affine.astype(np.float64),
+        'displacement': displacement.astype(np.float32),
+        'spacing': int(displacement_spacing),
+        'shape': np.array(shape[:2])
+    }
+
+def map_to_fixed(ground_truth, x, y):
+    """
+    Maps pixel coordinates of a moving image to the fixed image with its ground truth transformation.
+
+    Parameters:
+        ground_truth (dict): Ground truth, as returned by create_ground_truth or load_ground_truth.
+        x (np.ndarray): Column coordinates in the moving image.
+        y (np.ndarray): Row coordinates in the moving image, with the same shape as x.
+
+    Returns:
+        tuple: Column and row coordinates in the fixed image.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    affine, displacement, spacing = ground_truth['affine'], ground_truth['displacement'], int(ground_truth['spacing'])
+
+    fixed_x = affine[0, 0] * x + affine[0, 1] * y + affine[0, 2] + sample_field(displacement[0], spacing, y, x)
+    fixed_y = affine[1, 0] * x + affine[1, 1] * y + affine[1, 2] + sample_field(displacement[1], spacing, y, x)
+
+    return fixed_x, fixed_y
+
+def get_ground_truth_path(image_path):
+    """Path of the ground truth transformation saved next to a synthetic moving image."""
+    return os.path.splitext(image_path)[0] + '_ground_truth.npz'
+
+def save_ground_truth(ground_truth, path, fixed_image_path):
+    np.savez(path, fixed_image_path=fixed_image_path, **ground_truth)
+
+def load_ground_truth(path):
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+"""
+Rendering
+"""
+
+def create_tissue_field(rng, shape, spacing=1024):
+    """Smooth tissue density in [0, 1] on control points spaced by spacing pixels."""
+    return (create_smooth_field(rng, get_control_shape(shape, spacing), sigma=1) + 1) / 2
+
+def get_cell_rng(seed, cell, stream):
+    """Random generator of a stream of a cell. Cells start at -1, the cells around the slide included."""
+    return np.random.default_rng([seed, cell[0] + 1, cell[1] + 1, stream])
+
+def get_cell_nuclei(seed, cell, tissue, params):
+    """
+    Draws the nuclei of a cell of the slide, seeded by the cell position. Nuclei are denser where the tissue
+    is denser, and absent outside the tissue and in the blank borders.
+
+    Returns:
+        np.ndarray: Rows (y, x, semi-axis a, semi-axis b, angle, DAPI intensity, marker expressions...).
+    """
+    rng = get_cell_rng(seed, cell, 0)
+    height, width = params['shape']
+    border = params['border_width']
+    n_markers = params['n_channels'] - 1
+
+    n = rng.poisson(params['nuclei_per_cell'])
+    y = (cell[0] + rng.random(n)) * CELL_SIZE
+    x = (cell[1] + rng.random(n)) * CELL_SIZE
+
+    density = sample_field(tissue, params['tissue_spacing'], y, x)
+    inside = (y >= border) & (y < height - border) & (x >= border) & (x < width - border)
+    keep = inside & (density > params['tissue_threshold']) & (rng.random(n) < density)
+
+    r_min, r_max = params['nucleus_radius']
+    a = rng.uniform(r_min, r_max, n)
+    b = a * rng.uniform(0.6, 1, n)
+    angle = rng.uniform(0, 180, n)
+    intensity = rng.uniform(*params['dapi_intensity'], n)
+    # Markers are expressed by a fraction of the cells only
+    markers = rng.lognormal(6.5, 0.5, (n, n_markers)) * (rng.random((n, n_markers)) < 0.4)
+
+    return np.column_stack([y, x, a, b, angle, intensity, markers])[keep]
+
+def render_fixed_tile(area, params):
+    """
+    Renders a tile of a fixed slide. The tile is drawn on a canvas extended by one cell on each side, so
+    that nuclei and blurs crossing its edges match the neighbouring tiles.
+
+    Parameters:
+        area (tuple): Region (start_row, end_row, start_col, end_col) of the tile, aligned on cells.
+        params (dict): Slide parameters, with the shape, seed, tissue field and border width of the slide.
+
+    Returns:
+        np.ndarray: The tile with shape (height, width, n_channels), of dtype uint16.
+    """
+    start_row, end_row, start_col, end_col = area
+    cells_y = range(start_row // CELL_SIZE - 1, math.ceil(end_row / CELL_SIZE) + 1)
+    cells_x = range(start_col // CELL_SIZE - 1, math.ceil(end_col / CELL_SIZE) + 1)
+    origin_y, origin_x = cells_y[0] * CELL_SIZE, cells_x[0] * CELL_SIZE
+    canvas_shape = (len(cells_y) * CELL_SIZE, len(cells_x) * CELL_SIZE)
+    n_channels = params['n_channels']
+    shift = 4  # Sub-pixel precision of the drawn ellipses
+
+    nuclei = np.zeros(canvas_shape, np.float32)
+    texture = np.zeros(canvas_shape, np.float32)
+    noise = np.zeros((n_channels,) + canvas_shape, np.float32)
+    markers = [np.zeros(canvas_shape, np.float32) for _ in range(n_channels - 1)]
+
+    for cell in itertools.product(cells_y, cells_x):
+        y0, x0 = cell[0] * CELL_SIZE - origin_y, cell[1] * CELL_SIZE - origin_x
+        rng = get_cell_rng(params['seed'], cell, 1)
+        texture[y0:y0 + CELL_SIZE, x0:x0 + CELL_SIZE] = rng.random((CELL_SIZE, CELL_SIZE))
+        noise[:, y0:y0 + CELL_SIZE, x0:x0 + CELL_SIZE] = rng.standard_normal((n_channels, CELL_SIZE, CELL_SIZE))
+
+        for y, x, a, b, angle, intensity, *expressions in get_cell_nuclei(params['seed'], cell, params['tissue'], params):
+            center = (int((x - origin_x) * 2 ** shift), int((y - origin_y) * 2 ** shift))
+            axes = (int(a * 2 ** shift), int(b * 2 ** shift))
+            cv2.ellipse(nuclei, center, axes, angle, 0, 360, float(intensity), -1, cv2.LINE_AA, shift)
+            for marker, expression in zip(markers, expressions):
+                if expression > 0:
+                    # Cytoplasmic markers fill the cell around the nucleus
+                    cell_axes = (int(a * 1.8 * 2 ** shift), int(b * 1.8 * 2 ** shift))
+                    cv2.ellipse(marker, center, cell_axes, angle, 0, 360, float(expression), -1, cv2.LINE_AA, shift)
+
+    # Chromatin texture inside the nuclei, then the blur of the optics
+    nuclei *= 0.7 + 0.6 * cv2.GaussianBlur(texture, (0, 0), 1)
+    channels = [cv2.GaussianBlur(marker, (0, 0), 2.5) for marker in markers] + [cv2.GaussianBlur(nuclei, (0, 0), 1.2)]
+
+    rows, cols = np.mgrid[origin_y:origin_y + canvas_shape[0], origin_x:origin_x + canvas_shape[1]]
+    density = sample_field(params['tissue'], params['tissue_spacing'], rows, cols)
+    tissue = np.clip((density - params['tissue_threshold']) * 5, 0, 1) * params['background']
+
+    # Shot noise on the signal and autofluorescence, and blank slide outside the borders
+    height, width = params['shape']
+    border = params['border_width']
+    blank = (rows < border) | (rows >= height - border) | (cols < border) | (cols >= width - border)
+    for i, channel in enumerate(channels):
+        channel += tissue
+        channel += np.sqrt(channel) * noise[i]
+        channel[blank] = 0
+
+    tile = np.stack(channels, axis=-1)
+    tile = tile[start_row - origin_y:end_row - origin_y, start_col - origin_x:end_col - origin_x]
+
+    return np.clip(tile, 0, 65535).astype(np.uint16)
+
+def render_moving_tile(area, fixed_image_path, ground_truth, cycle_params):
+    """
+    Renders a tile of a moving cycle by sampling the fixed image at the ground truth coordinates of its
+    pixels. The cycle gets its own intensity scale, marker gains and noise, as another staining round would.
+
+    Parameters:
+        area (tuple): Region (start_row, end_row, start_col, end_col) of the tile.
+        fixed_image_path (str): Path to the fixed image.
+        ground_truth (dict): Ground truth transformation of the cycle.
+        cycle_params (dict): Seed, intensity scale and marker gain field of the cycle.
+
+    Returns:
+        np.ndarray: The tile with shape (height, width, n_channels), of dtype uint16.
+    """
+    start_row, end_row, start_col, end_col = area
+    rows, cols = np.mgrid[start_row:end_row, start_col:end_col]
+    fixed_x, fixed_y = map_to_fixed(ground_truth, cols, rows)
+
+    with h5py.File(fixed_image_path, 'r') as f:
+        dataset = f['dataset']
+        height, width, n_channels = dataset.shape
+
+        # Region of the fixed image the tile is sampled from
+        y0 = int(np.clip(np.floor(fixed_y.min()) - 2, 0, height))
+        y1 = int(np.clip(np.ceil(fixed_y.max()) + 3, 0, height))
+        x0 = int(np.clip(np.floor(fixed_x.min()) - 2, 0, width))
+        x1 = int(np.clip(np.ceil(fixed_x.max()) + 3, 0, width))
+        if y1 <= y0 or x1 <= x0:
+            return np.zeros(rows.shape + (n_channels,), np.uint16)
+        source = dataset[y0:y1, x0:x1, :].astype(np.float32)
+
+    map_x, map_y = (fixed_x - x0).astype(np.float32), (fixed_y - y0).astype(np.float32)
+    gain = sample_field(cycle_params['gain'], cycle_params['gain_spacing'], rows, cols)
+    rng = np.random.default_rng([cycle_params['seed'], start_row, start_col])
+
+    channels = []
+    for ch in range(n_channels):
+        channel = cv2.remap(source[:, :, ch], map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        signal = channel > 0
+        channel *= cycle_params['scale'] if ch == n_channels - 1 else gain
+        channel += np.sqrt(channel) * 0.5 * rng.standard_normal(channel.shape).astype(np.float32)
+        channel[~signal] = 0
+        channels.append(channel)
+
+    return np.clip(np.stack(channels, axis=-1), 0, 65535).astype(np.uint16)
+
+def write_tiles(output_path, shape, n_channels, render, max_workers=None, tile_size=2048):
+    """
+    Renders the tiles of an image in parallel and writes them into a chunked HDF5 dataset. The parent
+    process is the only writer and the number of tiles in flight is bounded.
+
+    Parameters:
+        output_path (str): Path to the image.
+        shape (tuple): Shape (height, width) of the image.
+        n_channels (int): Number of channels.
+        render (callable): Function rendering the tile of an area (start_row, end_row, start_col, end_col).
+        max_workers (int, optional): Maximum number of workers for parallel processing.
+        tile_size (int, optional): Height and width of the tiles, a multiple of CELL_SIZE.
+    """
+    areas = iter([
+        (row, min(row + tile_size, shape[0]), col, min(col + tile_size, shape[1]))
+        for row in range(0, shape[0], tile_size) for col in range(0, shape[1], tile_size)
+    ])
+    max_in_flight = 2 * (max_workers or os.cpu_count())
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    tmp_path = f'{output_path}.tmp'
+    with h5py.File(tmp_path, 'w') as h5_file:
+        dataset = create_stitched_dataset(h5_file, shape, n_channels)
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(render, area): area for area in itertools.islice(areas, max_in_flight)}
+
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start_row, end_row, start_col, end_col = futures.pop(future)
+                    dataset[start_row:end_row, start_col:end_col, :] = future.result()
+
+                    for area in itertools.islice(areas, 1):
+                        futures[executor.submit(render, area)] = area
+
+    os.replace(tmp_path, output_path)
+
+"""
+Slides
+"""
+
+def generate_fixed_slide(output_path, shape, seed, max_workers=None, **slide_params):
+    """
+    Generates a fixed slide: nuclei with a textured DAPI signal, cytoplasmic markers expressed by some of
+    the cells, tissue of varying density and blank borders.
+
+    Parameters:
+        output_path (str): Path to the HDF5 image.
+        shape (tuple): Shape (height, width) of the slide.
+        seed (int): Seed of the slide.
+        max_workers (int, optional): Maximum number of workers for parallel processing.
+        **slide_params: Parameters overriding DEFAULT_SLIDE_PARAMS.
+    """
+    params = {**DEFAULT_SLIDE_PARAMS, **slide_params}
+    params['shape'] = tuple(shape)
+    params['seed'] = seed
+    params['border_width'] = int(params['border'] * min(shape))
+    params['tissue'] = create_tissue_field(np.random.default_rng([seed, 0]), shape, params['tissue_spacing'])
+
+    write_tiles(output_path, shape, params['n_channels'], functools.partial(render_fixed_tile, params=params), max_workers)
+    logger.info(f'Fixed slide {output_path} of shape {tuple(shape)} generated.')
+
+def generate_moving_cycle(output_path, fixed_image_path, seed, max_workers=None, **deformation_params):
+    """
+    Generates a moving cycle by warping a fixed slide with a random ground truth transformation, and saves
+    the transformation next to the image.
+
+    Parameters:
+        output_path (str): Path to the HDF5 image.
+        fixed_image_path (str): Path to the fixed slide.
+        seed (int): Seed of the cycle.
+        max_workers (int, optional): Maximum number of workers for parallel processing.
+        **deformation_params: Parameters overriding DEFAULT_DEFORMATION_PARAMS.
+
+    Returns:
+        dict: The ground truth transformation.
+    """
+    with h5py.File(fixed_image_path, 'r') as f:
+        height, width, n_channels = f['dataset'].shape
+
+    rng = np.random.default_rng([seed, 1])
+    ground_truth = create_ground_truth(rng, (height, width), **{**DEFAULT_DEFORMATION_PARAMS, **deformation_params})
+    gain_spacing = 2048
+    cycle_params = {
+        'seed': seed,
+        'scale': rng.uniform(0.8, 1.2),
+        'gain': (1 + 0.3 * create_smooth_field(rng, get_control_shape((height, width), gain_spacing))).astype(np.float32),
+        'gain_spacing': gain_spacing
+    }
+
+    render = functools.partial(render_moving_tile, fixed_image_path=fixed_image_path, ground_truth=ground_truth, cycle_params=cycle_params)
+    write_tiles(output_path, (height, width), n_channels, render, max_workers)
+    save_ground_truth(ground_truth, get_ground_truth_path(output_path), fixed_image_path)
+    logger.info(f'Moving cycle {output_path} generated.')
+
+    return ground_truth
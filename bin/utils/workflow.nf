@@ -1,3 +1,5 @@
+import groovy.transform.Field
+
 // Parse rows from csv file
 def parse_csv(csv_file_path) {
     channel
@@ -13,6 +15,25 @@ def parse_csv(csv_file_path) {
         }
 }
 
+// Rows of the sample sheet by input path, read once by get_resource
+@Field Map sample_sheet_rows = null
+
+// Read a resource of a stage predicted by plan_resources.py from the sample sheet row of an image. 
+// The fallback is used when the sample sheet was not planned.
+def get_resource(input_path, stage, resource, fallback) {
+    if (sample_sheet_rows == null) {
+        def rows = [:]
+        file(params.sample_sheet_path).splitCsv(header: true).each { rows.putIfAbsent(it.input_path, it) }
+        sample_sheet_rows = rows
+    }
+    def row = sample_sheet_rows[input_path.toString()]
+    def value = row?.get("${stage}_${resource}".toString())
+    if (!value) {
+        return fallback
+    }
+    return resource == 'cpus' ? value as int : value
+}
+
 // Function to define registration parameters
 def get_diffeomorphic_registration_params() {
     return Channel.of(
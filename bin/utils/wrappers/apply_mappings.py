@@ -2,68 +2,126 @@
 
 import os
 import numpy as np
-import re
 import gc
-<<<<<<< HEAD
-from .io_tools import save_pickle, load_pickle
-from .image_mapping import apply_mapping
-=======
+import logging
+from .. import logging_config
 from ..io_tools import save_pickle, load_pickle
 from ..image_mapping import apply_mapping
->>>>>>> develop
-from concurrent.futures import ProcessPoolExecutor
+from ..crop_grid import get_crop_path
+from ..scratch import check_artifacts
+from ..artifact_index import ArtifactIndex, get_artifact_key
+from ..profiling import span
+from ..progress import ProgressReporter, run_timed
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def process_crop(mapping_file, moving_file, checkpoint_dir=None):
+# Setup logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def process_crop(idx, ch, mapping_path, moving_path, checkpoint_dir):
     """
-    Apply affine and diffeomorphic mappings to a set of image crops and save/load results from checkpoints.
+    Apply the diffeomorphic mapping of a crop to one of its channels and save the result to a checkpoint.
 
     Parameters:
-        mapping_file (list): Path to diffeomorphic mapping file.
-        moving_file (list): Path to moving crop file.
+        idx (tuple): Index (row, column) of the crop.
+        ch (int): Channel of the crop.
+        mapping_path (str): Path to the diffeomorphic mapping file.
+        moving_path (str): Path to the moving crop file.
         checkpoint_dir (str): Directory to save/load checkpoint files.
     """
-    match = re.search(r'\d+_\d+_\d+', moving_file)
-    idx = match.group(0) # Get the first two indices
-
-    checkpoint_path = os.path.join(checkpoint_dir, f'registered_split_{idx}.pkl')
-    if not os.path.exists(checkpoint_path):
-        moving_crop = load_pickle(moving_file)
-        mapping = load_pickle(mapping_file)
-
-        # Check for single valued array (such as white border)
-        if not len(np.unique(moving_crop[1])) == 1:
-        # Apply mappings
-            save_pickle((moving_crop[0], apply_mapping(mapping, moving_crop[1], method='dipy')), checkpoint_path)
-        else:
-        # Return crop as is
-            save_pickle(moving_crop[0], moving_crop[1])
-
-        print(f"Saved checkpoint for i={moving_crop[0]}")
-        
-        del moving_crop, mapping
-        gc.collect()        
+    checkpoint_path = get_crop_path(checkpoint_dir, 'registered_split', idx, ch)
+    moving_crop = load_pickle(moving_path)
+    mapping = load_pickle(mapping_path)
+
+    # Check for single valued array (such as white border) and identity mappings (crops skipped at registration)
+    if not len(np.unique(moving_crop[1])) == 1 and not isinstance(mapping, int):
+    # Apply mappings
+        with span('apply_mapping', 'tile', tile=idx, channel=ch, bytes=moving_crop[1].nbytes):
+            registered_crop = apply_mapping(mapping, moving_crop[1], method='dipy')
+        save_pickle((moving_crop[0], registered_crop), checkpoint_path)
+    else:
+    # Return crop as is
+        save_pickle((moving_crop[0], moving_crop[1]), checkpoint_path)
 
+    logger.debug(f"Saved checkpoint for i={moving_crop[0]}")
+    
+    del moving_crop, mapping
+    gc.collect()        
 
-def apply_mappings(mapping_files, moving_files, checkpoint_dir, max_workers=None):
+def get_registered_crop_keys(crop_indices, mappings_dir, moving_crops_dir, n_channels=3):
     """
-    Compute affine and diffeomorphic mappings between fixed and moving image crops in parallel.
+    Computes the artifact keys of the registered crops, which depend on the mapping of the crop and on
+    the moving crop channel, as recorded in the indices of their directories.
 
     Parameters:
-        mapping_files (list): List of filenames for the mapping.
-        moving_files (list): List of filenames for the moving crops.
-        checkpoint_dir (str): Directory to save/load checkpoint files.
-        max_workers (int, optional): Maximum number of workers for parallel processing.
+        crop_indices (list): Indices (row, column) of the crops.
+        mappings_dir (str): Directory of the diffeomorphic mappings.
+        moving_crops_dir (str): Directory of the moving crops.
+        n_channels (int, optional): Number of channels of the moving crops.
 
     Returns:
-        list: List of mappings corresponding to each crop, or None for mismatched shapes.
+        dict: Keys of the registered crops indexed by (row, column, channel), None for crops without a mapping.
+    """
+    mapping_index = ArtifactIndex(mappings_dir)
+    moving_index = ArtifactIndex(moving_crops_dir)
+
+    keys = {}
+    for idx in crop_indices:
+        mapping_key = mapping_index.get_key(get_crop_path(mappings_dir, 'mapping', idx))
+        for ch in range(n_channels):
+            moving_key = moving_index.get_key(get_crop_path(moving_crops_dir, 'affine_split', idx, ch))
+            keys[idx + (ch,)] = get_artifact_key('registered_split', mapping_key, moving_key) if mapping_key else None
+
+    return keys
+
+
+def apply_mappings(crop_indices, mappings_dir, moving_crops_dir, checkpoint_dir, max_workers=None, n_channels=3, status_path=None):
+    """
+    Apply the diffeomorphic mappings to every channel of the moving image crops in parallel. Only the
+    registered crops whose key changed since they were saved are computed.
+
+    Parameters:
+        crop_indices (list): Indices (row, column) of the crops.
+        mappings_dir (str): Directory of the diffeomorphic mappings.
+        moving_crops_dir (str): Directory of the moving crops.
+        checkpoint_dir (str): Directory to save/load checkpoint files.
+        max_workers (int, optional): Maximum number of workers for parallel processing.
+        n_channels (int, optional): Number of channels of the moving crops.
+        status_path (str, optional): Path to the status file where the progress of the workers is written.
     """
     if checkpoint_dir is not None:
         # Create checkpoint directory if it doesn't exist
         os.makedirs(checkpoint_dir, exist_ok=True)
         
+    keys = get_registered_crop_keys(crop_indices, mappings_dir, moving_crops_dir, n_channels)
+    index = ArtifactIndex(checkpoint_dir)
+
+    invalid_crops = []
+    for (row, col, ch), key in keys.items():
+        if key is None:
+            logger.error(f"No mapping computed for crop i={(row, col)}.")
+        elif not index.is_valid(get_crop_path(checkpoint_dir, 'registered_split', (row, col), ch), key):
+            invalid_crops.append(((row, col), ch))
+    index.invalidate([get_crop_path(checkpoint_dir, 'registered_split', idx, ch) for idx, ch in invalid_crops])
+    check_artifacts([get_crop_path(mappings_dir, 'mapping', idx) for idx, _ in invalid_crops] + 
+                    [get_crop_path(moving_crops_dir, 'affine_split', idx, ch) for idx, ch in invalid_crops], 
+                    'diffeomorphic registration')
+        
     # Use ProcessPoolExecutor for parallel processing
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        # Submit tasks for each crop to be processed in parallel
-        for moving_file, mapping_file,  in zip(moving_files, mapping_files):
-            executor.submit(process_crop, mapping_file, moving_file, checkpoint_dir)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+             ProgressReporter(status_path, 'apply_mappings', len(invalid_crops)) as progress:
+            # Submit tasks for each crop to be processed in parallel
+            futures = {
+                executor.submit(run_timed, process_crop, idx, ch, get_crop_path(mappings_dir, 'mapping', idx), 
+                                get_crop_path(moving_crops_dir, 'affine_split', idx, ch), checkpoint_dir): (idx, ch)
+                for idx, ch in invalid_crops
+            }
 
+            for future in as_completed(futures):
+                _, report = future.result()
+                progress.update(report)
+                idx, ch = futures[future]
+                index.record(get_crop_path(checkpoint_dir, 'registered_split', idx, ch), keys[idx + (ch,)])
+    finally:
+        index.flush()
@@ -3,94 +3,203 @@
 import os
 import numpy as np
 import logging
-import re
 import gc
-<<<<<<< HEAD
-from concurrent.futures import ProcessPoolExecutor
-from .io_tools import load_pickle, save_pickle
-from .image_mapping import compute_diffeomorphic_mapping_dipy
-from . import logging_config
-=======
 from .. import logging_config
 from ..io_tools import load_pickle, save_pickle
-from ..image_mapping import compute_diffeomorphic_mapping_dipy
-from concurrent.futures import ProcessPoolExecutor
->>>>>>> develop
+from ..image_mapping import compute_diffeomorphic_mapping_dipy, load_static_scale_space, compute_similarity, DEFAULT_LEVEL_ITERS
+from ..registration_telemetry import RegistrationTelemetry
+from ..crop_grid import get_crop_path
+from ..scratch import check_artifacts
+from ..artifact_index import ArtifactIndex, get_artifact_key, get_scale_space_key
+from ..profiling import span
+from ..progress import ProgressReporter, run_timed
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Setup logging configuration
 logging_config.setup_logging()
 logger = logging.getLogger(__name__)
 
-def process_crop(fixed_file, moving_file, current_crops_dir_fixed, current_crops_dir_moving, checkpoint_dir):
+def process_crop(idx, current_crops_dir_fixed, current_crops_dir_moving, checkpoint_dir, scale_space_dir=None,
+                 skip_threshold=None, similarity_metric='ncc', registration_params=None, reuse_scale_space=True):
     """
-    Loads a pair of fixed and moving crops from their respective directories,
-    computes the diffeomorphic mapping if not already cached, and returns the mapping.
+    Loads a pair of fixed and moving DAPI crops from their respective directories,
+    computes the diffeomorphic mapping, and saves the mapping.
 
     Args:
-        fixed_file (str): Filename of the fixed crop.
-        moving_file (str): Filename of the moving crop.
+        idx (tuple): Index (row, column) of the crop.
         current_crops_dir_fixed (str): Directory where fixed crops are stored.
         current_crops_dir_moving (str): Directory where moving crops are stored.
         checkpoint_dir (str): Directory to save/load checkpoint files.
+        scale_space_dir (str, optional): Directory where the scale spaces of the fixed crops are cached.
+        skip_threshold (float, optional): Crops whose similarity score reaches this threshold are considered 
+                                          aligned by the affine transformation, and get an identity mapping.
+        similarity_metric (str, optional): Similarity metric used for the pre-check, either 'ncc' or 'mi'.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy 
+                                              (level_iters, opt_tol, inv_tol, metric, radius).
+        reuse_scale_space (bool, optional): Whether the cached scale space of the fixed crop is up to date.
 
     Returns:
-        mapping_diffeomorphic: The computed or loaded diffeomorphic mapping, or None if shapes do not match.
+        tuple: Crop index, similarity score and telemetry record (None when not computed), or None if 
+               the crop shapes do not match.
     """
-    match = re.search(r'\d+_\d+_\d+', fixed_file)
-    idx = "_".join(match.group(0).split('_')[:-1]) # Get the first two indices
-
-    # Construct the checkpoint path for storing/loading mappings
-    checkpoint_path = os.path.join(checkpoint_dir, f'mapping_{idx}.pkl')
-    if not os.path.exists(checkpoint_path):
-        fixed_crop = load_pickle(os.path.join(current_crops_dir_fixed, fixed_file))
-        moving_crop = load_pickle(os.path.join(current_crops_dir_moving, moving_file))  
-
-        # Check for shape mismatch
-        if fixed_crop[1].shape != moving_crop[1].shape:
-            logger.error(f"Shape mismatch for crops at indices {idx}.")
-            return None
-
-        # Check for single valued crops (white areas)
-        if len(np.unique(fixed_crop[1])) == 1 or len(np.unique(moving_crop[1])) == 1:
-            mapping_diffeomorphic = 0
-        else:
-            # Compute the diffeomorphic mapping
-            mapping_diffeomorphic = compute_diffeomorphic_mapping_dipy(fixed_crop[1], moving_crop[1])
-        
-        del fixed_crop, moving_crop
-        gc.collect()
-        
-        # Save the computed mapping to a checkpoint
-        save_pickle(mapping_diffeomorphic, checkpoint_path)
-        logger.info(f"Saved checkpoint for i={idx}")
-
-        del mapping_diffeomorphic
-        gc.collect()
-
-def compute_mappings(fixed_files, moving_files, current_crops_dir_fixed, current_crops_dir_moving, checkpoint_dir, max_workers=None):
+    registration_params = registration_params or {}
+
+    # Construct the checkpoint path for storing mappings
+    checkpoint_path = get_crop_path(checkpoint_dir, 'mapping', idx)
+    score, record = None, None
+    fixed_crop = load_pickle(get_crop_path(current_crops_dir_fixed, 'crop', idx, 2))
+    moving_crop = load_pickle(get_crop_path(current_crops_dir_moving, 'affine_split', idx, 2))
+
+    # Check for shape mismatch
+    if fixed_crop[1].shape != moving_crop[1].shape:
+        logger.error(f"Shape mismatch for crops at indices {idx}.")
+        return None
+
+    # Score the affine alignment of the crops
+    if skip_threshold is not None:
+        with span('compute_similarity', 'tile', tile=idx):
+            score = compute_similarity(fixed_crop[1], moving_crop[1], metric=similarity_metric)
+
+    # Check for single valued crops (white areas)
+    if len(np.unique(fixed_crop[1])) == 1 or len(np.unique(moving_crop[1])) == 1:
+        mapping_diffeomorphic = 0
+    # Check for crops already aligned by the affine transformation
+    elif score is not None and score >= skip_threshold:
+        logger.info(f"Skipping diffeomorphic registration for i={idx} ({similarity_metric}={score:.3f}).")
+        mapping_diffeomorphic = 0
+    else:
+        # Reuse the scale space of the fixed crop across moving images
+        scale_space_path = get_crop_path(scale_space_dir, 'scale_space', idx) if scale_space_dir else None
+        levels = len(registration_params.get('level_iters') or DEFAULT_LEVEL_ITERS)
+        with span('load_scale_space', 'tile', tile=idx, reuse=reuse_scale_space):
+            static_scale_space = load_static_scale_space(fixed_crop[1], scale_space_path, levels=levels,
+                                                         reuse=reuse_scale_space)
+
+        # Compute the diffeomorphic mapping
+        telemetry = RegistrationTelemetry()
+        with span('compute_mapping', 'tile', tile=idx, bytes=moving_crop[1].nbytes):
+            mapping_diffeomorphic = compute_diffeomorphic_mapping_dipy(fixed_crop[1], moving_crop[1], 
+                                                                       static_scale_space=static_scale_space,
+                                                                       telemetry=telemetry, **registration_params)
+        record = telemetry.to_record()
+
+    del fixed_crop, moving_crop
+    gc.collect()
+
+    # Save the computed mapping to a checkpoint
+    save_pickle(mapping_diffeomorphic, checkpoint_path)
+    logger.info(f"Saved checkpoint for i={idx}")
+
+    del mapping_diffeomorphic
+    gc.collect()
+
+    return idx, score, record
+
+def get_mapping_keys(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, skip_threshold=None,
+                     similarity_metric='ncc', registration_params=None):
+    """
+    Computes the artifact keys of the mappings of the crops and of the scale spaces of the fixed crops. A
+    mapping depends on the DAPI channels of its fixed and moving crops, as recorded in the indices of their
+    directories, and on the registration parameters. A scale space only depends on its fixed crop and on
+    the number of levels.
+
+    Parameters:
+        crop_indices (list): Indices (row, column) of the crops.
+        current_crops_dir_fixed (str): Directory containing fixed crops.
+        current_crops_dir_moving (str): Directory containing moving crops.
+        skip_threshold (float, optional): Similarity threshold of the pre-check.
+        similarity_metric (str, optional): Similarity metric used for the pre-check.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+
+    Returns:
+        tuple: Mapping keys and scale space keys, indexed by (row, column).
     """
-    Compute affine and diffeomorphic mappings between fixed and moving image crops in parallel.
+    registration_params = registration_params or {}
+    levels = len(registration_params.get('level_iters') or DEFAULT_LEVEL_ITERS)
+    fixed_index = ArtifactIndex(current_crops_dir_fixed)
+    moving_index = ArtifactIndex(current_crops_dir_moving)
+
+    mapping_keys, scale_space_keys = {}, {}
+    for idx in crop_indices:
+        fixed_key = fixed_index.get_key(get_crop_path(current_crops_dir_fixed, 'crop', idx, 2))
+        moving_key = moving_index.get_key(get_crop_path(current_crops_dir_moving, 'affine_split', idx, 2))
+        mapping_keys[idx] = get_artifact_key('mapping', fixed_key, moving_key, skip_threshold, similarity_metric,
+                                             registration_params)
+        scale_space_keys[idx] = get_scale_space_key(fixed_key, levels)
+
+    return mapping_keys, scale_space_keys
+
+def compute_mappings(crop_indices, current_crops_dir_fixed, current_crops_dir_moving, checkpoint_dir, max_workers=None, scale_space_dir=None,
+                     skip_threshold=None, similarity_metric='ncc', registration_params=None, status_path=None):
+    """
+    Compute affine and diffeomorphic mappings between fixed and moving image crops in parallel. Only the
+    mappings whose key changed since they were saved are computed.
 
     Parameters:
-        fixed_files (list): List of filenames for the fixed crops.
-        moving_files (list): List of filenames for the moving crops.
+        crop_indices (list): Indices (row, column) of the crops.
         current_crops_dir_fixed (str): Directory containing fixed crops.
         current_crops_dir_moving (str): Directory containing moving crops.
         checkpoint_dir (str): Directory to save/load checkpoint files.
         max_workers (int, optional): Maximum number of workers for parallel processing.
+        scale_space_dir (str, optional): Directory where the scale spaces of the fixed crops are cached.
+        skip_threshold (float, optional): Crops whose similarity score reaches this threshold get an identity mapping.
+        similarity_metric (str, optional): Similarity metric used for the pre-check, either 'ncc' or 'mi'.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+        status_path (str, optional): Path to the status file where the progress of the workers is written.
 
     Returns:
-        list: List of mappings corresponding to each crop, or None for mismatched shapes.
+        tuple: Similarity score and telemetry record of each crop processed in this run, indexed by (row, column).
     """
     if checkpoint_dir is not None:
         # Create checkpoint directory if it doesn't exist
         os.makedirs(checkpoint_dir, exist_ok=True)
 
+    if scale_space_dir is not None:
+        os.makedirs(scale_space_dir, exist_ok=True)
+
+    mapping_keys, scale_space_keys = get_mapping_keys(crop_indices, current_crops_dir_fixed, current_crops_dir_moving,
+                                                      skip_threshold, similarity_metric, registration_params)
+    mapping_index = ArtifactIndex(checkpoint_dir)
+    scale_space_index = ArtifactIndex(scale_space_dir) if scale_space_dir is not None else None
+
+    invalid_indices = [idx for idx in crop_indices if not mapping_index.is_valid(get_crop_path(checkpoint_dir, 'mapping', idx), mapping_keys[idx])]
+    mapping_index.invalidate([get_crop_path(checkpoint_dir, 'mapping', idx) for idx in invalid_indices])
+    logger.info(f"{len(crop_indices) - len(invalid_indices)}/{len(crop_indices)} mappings are up to date.")
+    check_artifacts([get_crop_path(current_crops_dir_moving, 'affine_split', idx, 2) for idx in invalid_indices], 'affine registration')
+
+    scores, records = {}, {}
+
     # Use ProcessPoolExecutor for parallel processing
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        # Submit tasks for each crop to be processed in parallel
-        for fixed_file, moving_file in zip(fixed_files, moving_files): 
-            executor.submit(process_crop, fixed_file, moving_file, current_crops_dir_fixed, current_crops_dir_moving, checkpoint_dir)
-    
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor, \
+             ProgressReporter(status_path, 'compute_mappings', len(invalid_indices)) as progress:
+            # Submit tasks for each crop to be processed in parallel
+            futures = [
+                executor.submit(run_timed, process_crop, idx, current_crops_dir_fixed, current_crops_dir_moving, checkpoint_dir, 
+                                scale_space_dir, skip_threshold, similarity_metric, registration_params,
+                                scale_space_index is not None and scale_space_index.is_valid(
+                                    get_crop_path(scale_space_dir, 'scale_space', idx), scale_space_keys[idx]))
+                for idx in invalid_indices
+            ]
+
+            for future in as_completed(futures):
+                result, report = future.result()
+                progress.update(report)
+                if result is None:
+                    continue
 
+                idx, score, record = result
+                mapping_index.record(get_crop_path(checkpoint_dir, 'mapping', idx), mapping_keys[idx])
+                if score is not None:
+                    scores[idx] = score
+                if record is not None:
+                    records[idx] = record
+                    # A scale space is only cached for the crops that were registered
+                    if scale_space_index is not None:
+                        scale_space_index.record(get_crop_path(scale_space_dir, 'scale_space', idx), scale_space_keys[idx])
+    finally:
+        mapping_index.flush()
+        if scale_space_index is not None:
+            scale_space_index.flush()
 
+    return scores, records
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import logging
+import gc
+from .. import logging_config
+from ..io_tools import save_pickle, load_pickle
+from ..image_mapping import compute_diffeomorphic_mapping_dipy, apply_mapping, load_static_scale_space, compute_similarity, DEFAULT_LEVEL_ITERS
+from ..registration_telemetry import RegistrationTelemetry
+from ..shared_memory import attach_shared_array, create_shared_array
+from ..crop_grid import get_crop_path
+from ..artifact_index import ArtifactIndex, get_crop_key, get_file_identity, get_scale_space_key
+from ..profiling import span
+from ..progress import ProgressReporter, run_timed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# Setup logging configuration
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+
+def process_crop(idx, fixed_descriptor, moving_descriptors, scale_space_dir=None, skip_threshold=None, similarity_metric='ncc',
+                 registration_params=None, affine_matrix=None, reuse_scale_space=True):
+    """
+    Attaches to a pair of fixed and moving crops held in shared memory, computes the diffeomorphic
+    mapping on the DAPI channel and applies it in place to every channel of the moving crop.
+
+    Args:
+        idx (tuple): Index (row, column) of the crop.
+        fixed_descriptor (SharedArrayDescriptor): Descriptor of the fixed DAPI crop.
+        moving_descriptors (list): Descriptors of the moving crop channels, ordered by channel.
+        scale_space_dir (str, optional): Directory where the scale spaces of the fixed crops are cached.
+        skip_threshold (float, optional): Crops whose similarity score reaches this threshold are considered 
+                                          aligned by the affine transformation, and are left as they are.
+        similarity_metric (str, optional): Similarity metric used for the pre-check, either 'ncc' or 'mi'.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy 
+                                              (level_iters, opt_tol, inv_tol, metric, radius).
+        affine_matrix (np.ndarray, optional): Affine transformation applied in place to every channel of the 
+                                              moving crop before the diffeomorphic registration, when the 
+                                              moving crops are not affine registered yet.
+        reuse_scale_space (bool, optional): Whether the cached scale space of the fixed crop is up to date.
+
+    Returns:
+        tuple: The crop index, its similarity score and its telemetry record (None when not computed), 
+               or None if the crop shapes do not match.
+    """
+    registration_params = registration_params or {}
+    fixed_shm, fixed_crop = attach_shared_array(fixed_descriptor)
+    moving_shms, moving_crops = zip(*[attach_shared_array(descriptor) for descriptor in moving_descriptors])
+
+    try:
+        # Check for shape mismatch
+        if fixed_crop.shape != moving_crops[2].shape:
+            logger.error(f"Shape mismatch for crops at indices {idx}.")
+            return None
+
+        if affine_matrix is not None:
+            with span('affine_warp', 'tile', tile=idx):
+                for moving_crop in moving_crops:
+                    moving_crop[...] = apply_mapping(affine_matrix, moving_crop, method='cv2')
+
+        # Score the affine alignment of the crops
+        score, record = None, None
+        if skip_threshold is not None:
+            with span('compute_similarity', 'tile', tile=idx):
+                score = compute_similarity(fixed_crop, moving_crops[2], metric=similarity_metric)
+
+        # Check for single valued crops (white areas), which are left as they are
+        if len(np.unique(fixed_crop)) == 1 or len(np.unique(moving_crops[2])) == 1:
+            return idx, score, record
+
+        # Check for crops already aligned by the affine transformation
+        if score is not None and score >= skip_threshold:
+            logger.info(f"Skipping diffeomorphic registration for i={idx} ({similarity_metric}={score:.3f}).")
+            return idx, score, record
+
+        # Reuse the scale space of the fixed crop across moving images
+        scale_space_path = get_crop_path(scale_space_dir, 'scale_space', idx) if scale_space_dir else None
+        levels = len(registration_params.get('level_iters') or DEFAULT_LEVEL_ITERS)
+        with span('load_scale_space', 'tile', tile=idx, reuse=reuse_scale_space):
+            static_scale_space = load_static_scale_space(fixed_crop, scale_space_path, levels=levels, reuse=reuse_scale_space)
+
+        telemetry = RegistrationTelemetry()
+        with span('compute_mapping', 'tile', tile=idx, bytes=fixed_crop.nbytes):
+            mapping = compute_diffeomorphic_mapping_dipy(fixed_crop, moving_crops[2], static_scale_space=static_scale_space,
+                                                         telemetry=telemetry, **registration_params)
+        record = telemetry.to_record()
+        with span('apply_mapping', 'tile', tile=idx):
+            for moving_crop in moving_crops:
+                moving_crop[...] = apply_mapping(mapping, moving_crop, method='dipy')
+
+        del mapping
+        gc.collect()
+    finally:
+        del fixed_crop, moving_crops
+        fixed_shm.close()
+        for shm in moving_shms:
+            shm.close()
+
+    return idx, score, record
+
+def load_crops_shared(crops_dir, crop_indices, prefix, channels=(0, 1, 2)):
+    """
+    Loads saved crops into shared memory blocks, one block per crop, e.g. the affine registered crops
+    written by affine_registration.py.
+
+    Parameters:
+        crops_dir (str): Directory of the crops.
+        crop_indices (list): Indices (row, column) of the crops.
+        prefix (str): Prefix of the crop filenames, e.g. 'affine_split'.
+        channels (iterable, optional): Channels to load.
+
+    Returns:
+        dict: Maps each crop index (row, column, channel) to a tuple (shared memory block, crop array, descriptor).
+    """
+    crops = {}
+    for idx in crop_indices:
+        for ch in channels:
+            _, crop = load_pickle(get_crop_path(crops_dir, prefix, idx, ch))
+            crops[idx + (ch,)] = create_shared_array(crop.shape, crop.dtype, crop)
+
+    return crops
+
+def get_scale_space_keys(fixed_image_path, grid, registration_params=None):
+    """
+    Computes the artifact keys of the scale spaces of the DAPI crops of a fixed image. They match the
+    keys of the scale spaces computed from the crops saved by crop_image_channels, so that the cache is
+    shared with the staged registration.
+
+    Parameters:
+        fixed_image_path (str): Path to the fixed image.
+        grid (CropGrid): Crop grid of the image.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+
+    Returns:
+        dict: Keys of the scale spaces, indexed by (row, column).
+    """
+    levels = len((registration_params or {}).get('level_iters') or DEFAULT_LEVEL_ITERS)
+    fixed_identity = get_file_identity(fixed_image_path)
+
+    return {idx: get_scale_space_key(get_crop_key(fixed_identity, grid.area(idx), 2), levels) for idx in grid.crop_indices}
+
+def register_crops_shared(fixed_crops, moving_crops, crop_indices, n_channels=3, checkpoint_dir=None, max_workers=None, scale_space_dir=None,
+                          skip_threshold=None, similarity_metric='ncc', registration_params=None, affine_matrix=None,
+                          scale_space_keys=None, status_path=None, mp_context=None):
+    """
+    Registers moving crops held in shared memory to the corresponding fixed crops. Workers only receive
+    the shared memory descriptors of the crops, and the registered channels overwrite the moving crops in place.
+
+    Parameters:
+        fixed_crops (dict): Shared fixed crops indexed by (row, column, channel), as returned by crop_image_channels_shared.
+                            Only the DAPI channel (2) is required.
+        moving_crops (dict): Shared moving crops indexed by (row, column, channel).
+        crop_indices (list): Indices (row, column) of the crops to register.
+        n_channels (int, optional): Number of channels of the moving crops.
+        checkpoint_dir (str, optional): Directory where registered crops are saved asynchronously. No checkpoints
+                                        are written if None.
+        max_workers (int, optional): Maximum number of workers for parallel processing.
+        scale_space_dir (str, optional): Directory where the scale spaces of the fixed crops are cached.
+        skip_threshold (float, optional): Crops whose similarity score reaches this threshold are left as they are.
+        similarity_metric (str, optional): Similarity metric used for the pre-check, either 'ncc' or 'mi'.
+        registration_params (dict, optional): Keyword arguments of compute_diffeomorphic_mapping_dipy.
+        affine_matrix (np.ndarray, optional): Affine transformation applied to the moving crops first.
+        scale_space_keys (dict, optional): Artifact keys of the scale spaces of the fixed crops, indexed by 
+                                           (row, column). Cached scale spaces are reused without checking 
+                                           their key if None.
+        status_path (str, optional): Path to the status file where the progress of the workers is written.
+        mp_context (multiprocessing.context.BaseContext, optional): Context starting the workers, e.g. a forkserver
+                                                                   context when called from several threads.
+                                                                   Defaults to the default start method.
+
+    Returns:
+        tuple: Similarity score and telemetry record (None when not computed) of each crop registered 
+               successfully, indexed by (row, column).
+    """
+    if checkpoint_dir is not None:
+        # Create checkpoint directory if it doesn't exist
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    if scale_space_dir is not None:
+        os.makedirs(scale_space_dir, exist_ok=True)
+
+    scale_space_index = None
+    if scale_space_dir is not None and scale_space_keys is not None:
+        scale_space_index = ArtifactIndex(scale_space_dir)
+
+    def reuse_scale_space(idx):
+        if scale_space_index is None:
+            return True
+        return scale_space_index.is_valid(get_crop_path(scale_space_dir, 'scale_space', idx), scale_space_keys[idx])
+
+    scores, records = {}, {}
+
+    # Checkpoints are written from a background thread while the workers keep registering crops
+    try:
+        with ThreadPoolExecutor(max_workers=1) as checkpoint_writer:
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context) as executor, \
+                 ProgressReporter(status_path, 'register_crops', len(crop_indices)) as progress:
+                futures = [
+                    executor.submit(
+                        run_timed, process_crop, idx, fixed_crops[idx + (2,)][2],
+                        [moving_crops[idx + (ch,)][2] for ch in range(n_channels)],
+                        scale_space_dir, skip_threshold, similarity_metric, registration_params, affine_matrix,
+                        reuse_scale_space(idx)
+                    )
+                    for idx in crop_indices
+                ]
+
+                for future in as_completed(futures):
+                    result, report = future.result()
+                    progress.update(report)
+                    if result is None:
+                        continue
+
+                    idx, score, record = result
+                    scores[idx] = score
+                    records[idx] = record
+                    logger.info(f"Registered crop i={idx}")
+
+                    # A scale space is only cached for the crops that were registered
+                    if record is not None and scale_space_index is not None:
+                        scale_space_index.record(get_crop_path(scale_space_dir, 'scale_space', idx), scale_space_keys[idx])
+
+                    if checkpoint_dir is not None:
+                        for ch in range(n_channels):
+                            checkpoint_path = get_crop_path(checkpoint_dir, 'registered_split', idx, ch)
+                            checkpoint_writer.submit(save_pickle, (idx + (ch,), moving_crops[idx + (ch,)][1]), checkpoint_path)
+    finally:
+        if scale_space_index is not None:
+            scale_space_index.flush()
+
+    return scores, records
@@ -13,6 +13,10 @@ include { convert_to_h5 } from './modules/local/image_conversion/main.nf'
 include { convert_to_ome_tiff } from './modules/local/image_conversion/main.nf'
 include { affine_registration } from './modules/local/image_registration/main.nf' 
 include { diffeomorphic_registration } from './modules/local/image_registration/main.nf'
+include { register_image } from './modules/local/image_registration/main.nf'
+include { register_patient } from './modules/local/image_registration/main.nf'
+include { diffeomorphic_registration_batch } from './modules/local/image_registration/main.nf'
+include { gather_registration } from './modules/local/image_registration/main.nf'
 include { export_image_1 } from './modules/local/export_image/main.nf'
 include { export_image_2 } from './modules/local/export_image/main.nf'
 
@@ -24,6 +28,11 @@ workflow {
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     */
 
+    // Images registered in memory are written as HDF5 without crops, which leaves nothing to export to another format
+    if (params.in_memory && params.output_format != "h5") {
+        error "in_memory only writes HDF5 images, and cannot be combined with output_format ${params.output_format}."
+    }
+
     parsed_lines = parse_csv(params.sample_sheet_path)
 
     // Prepare conversion parameters from parsed CSV data
@@ -50,10 +59,30 @@ workflow {
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     */
 
-    affine_registration(convert_to_h5.out)
-    export_image_1(affine_registration.out) 
-    diffeomorphic_registration(export_image_1.out)
-    export_image_2(diffeomorphic_registration.out)
+    if (params.fused && params.patient_batched) {
+        // All the cycles of a patient in a single process, sharing the fixed image
+        register_patient(convert_to_h5.out.groupTuple(by: [0, 1]))
+    } else if (params.fused) {
+        // Affine registration, diffeomorphic registration and export in a single process per image
+        register_image(convert_to_h5.out)
+    } else {
+        affine_registration(convert_to_h5.out)
+        export_image_1(affine_registration.out) 
+
+        if (params.n_batches > 1) {
+            // Scatter the crops of each image into batches registered by separate tasks, then gather them
+            diffeomorphic_registration_batch(
+                export_image_1.out.combine(Channel.of(0..<params.n_batches))
+            )
+            gather_registration(
+                diffeomorphic_registration_batch.out.groupTuple(by: [0, 1, 2, 3], size: params.n_batches)
+            )
+            export_image_2(gather_registration.out)
+        } else {
+            diffeomorphic_registration(export_image_1.out)
+            export_image_2(diffeomorphic_registration.out)
+        }
+    }
 
     /*
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -1,8 +1,11 @@
+include { get_resource } from '../../../bin/utils/workflow.nf'
+
 process export_image_1 {
     // cpus 5
     // memory "5G"
-    cpus 10
-    memory "100G"
+    cpus { get_resource(input_path, 'export', 'cpus', 10) }
+    memory { get_resource(input_path, 'export', 'memory', "20G") }
+    time { get_resource(input_path, 'export', 'time', null) }
     // errorStrategy 'retry'
     // maxRetries = 1
     // memory { 80.GB * task.attempt }
@@ -31,9 +34,12 @@ process export_image_1 {
             --fixed-image-path "${fixed_image_path}" \
             --registered-crops-dir "${params.registered_crops_dir}" \
             --transformation "affine" \
+            --crop-width-x "${params.crop_width_x}" \
+            --crop-width-y "${params.crop_width_y}" \
             --overlap-x "${params.overlap_x}" \
             --overlap-y "${params.overlap_y}" \
             --max-workers "${params.max_workers}" \
+            ${params.blend ? '--blend' : ''} \
             --logs-dir "${params.logs_dir}"
     fi
     """
@@ -43,8 +49,9 @@ process export_image_1 {
 process export_image_2 {
     // cpus 5
     // memory "5G"
-    cpus 10
-    memory "100G"
+    cpus { get_resource(input_path, 'export', 'cpus', 10) }
+    memory { get_resource(input_path, 'export', 'memory', "20G") }
+    time { get_resource(input_path, 'export', 'time', null) }
     // errorStrategy 'retry'
     // maxRetries = 1
     // memory { 80.GB * task.attempt }
@@ -73,9 +80,16 @@ process export_image_2 {
             --fixed-image-path "${fixed_image_path}" \
             --registered-crops-dir "${params.registered_crops_dir}" \
             --transformation "diffeomorphic" \
+            --crop-width-x "${params.crop_width_x}" \
+            --crop-width-y "${params.crop_width_y}" \
             --overlap-x "${params.overlap_x}" \
             --overlap-y "${params.overlap_y}" \
             --max-workers "${params.max_workers}" \
+            ${params.blend ? '--blend' : ''} \
+            --output-format "${params.output_format}" \
+            --pyramid-resolutions "${params.pyramid_resolutions}" \
+            --pyramid-scale "${params.pyramid_scale}" \
+            ${params.delete_checkpoints ? '--delete-checkpoints' : ''} \
             --logs-dir "${params.logs_dir}"
     fi
     """
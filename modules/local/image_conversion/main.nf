@@ -2,9 +2,12 @@
     Convert nd2 files into multiple resolution hierarchical tiff files.
 */
 
+include { get_resource } from '../../../bin/utils/workflow.nf'
+
 process convert_to_h5 {
-    cpus 10
-    memory "100G"
+    cpus { get_resource(input_path, 'conversion', 'cpus', 10) }
+    memory { get_resource(input_path, 'conversion', 'memory', "100G") }
+    time { get_resource(input_path, 'conversion', 'time', null) }
     publishDir "${params.input_dir}", mode: "copy"
     // container "docker://yinxiu/bftools:latest"
     tag "conversion_h5"
@@ -31,8 +34,8 @@ process convert_to_h5 {
 }
 
 process convert_to_ome_tiff {
-    memory "1G"
-    cpus 1
+    memory "2G"
+    cpus 4
     publishDir "${params.output_dir_conv}", mode: "copy"
     // container "docker://yinxiu/bftools:latest"
     tag "conversion_ome"
@@ -46,12 +49,15 @@ process convert_to_ome_tiff {
     script:
     """
     if [ ! -f "${output_path}" ]; then
-        bfconvert -noflat -bigtiff \
-            -tilex "${params.tilex}" \
-            -tiley "${params.tiley}" \
-            -pyramid-resolutions "${params.pyramid_resolutions}" \
-            -pyramid-scale "${params.pyramid_scale}" \
-            "${input_path}" "${output_path}"
+        convert_to_ome_tiff.py \
+            --input-path "${input_path}" \
+            --output-path "${output_path}" \
+            --tilex "${params.tilex}" \
+            --tiley "${params.tiley}" \
+            --pyramid-resolutions "${params.pyramid_resolutions}" \
+            --pyramid-scale "${params.pyramid_scale}" \
+            --max-workers "${task.cpus}" \
+            --logs-dir "${params.logs_dir}"
     fi
     """
 }
\ No newline at end of file
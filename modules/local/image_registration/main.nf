@@ -2,9 +2,12 @@
     Register images with respect to a predefined fixed image
 */
 
+include { get_resource } from '../../../bin/utils/workflow.nf'
+
 process affine_registration {
-    cpus 10
-    memory "100G"
+    cpus { get_resource(input_path, 'affine', 'cpus', 10) }
+    memory { get_resource(input_path, 'affine', 'memory', "100G") }
+    time { get_resource(input_path, 'affine', 'time', null) }
     // cpus 32
     // memory "170G"
     // errorStrategy 'retry'
@@ -38,14 +41,17 @@ process affine_registration {
             --crop-width-y "${params.crop_width_y}" \
             --overlap-x "${params.overlap_x}" \
             --overlap-y "${params.overlap_y}" \
+            ${params.adaptive_overlap ? '--adaptive-overlap' : ''} \
+            ${params.scratch_budget != "" ? "--scratch-budget ${params.scratch_budget} --scratch-dirs ${params.crops_dir_fixed} ${params.registered_crops_dir} ${params.mappings_dir} ${params.scale_space_dir}" : ''} \
             --logs-dir "${params.logs_dir}" 
     fi
     """
 }
 
 process diffeomorphic_registration {
-    cpus 10
-    memory "50G"
+    cpus { get_resource(input_path, 'diffeomorphic', 'cpus', 10) }
+    memory { get_resource(input_path, 'diffeomorphic', 'memory', "50G") }
+    time { get_resource(input_path, 'diffeomorphic', 'time', null) }
     // cpus 32
     // memory "170G"
     // errorStrategy 'retry'
@@ -77,13 +83,215 @@ process diffeomorphic_registration {
             --crops-dir-fixed "${params.crops_dir_fixed}" \
             --crops-dir-moving "${params.crops_dir_moving}" \
             --mappings-dir "${params.mappings_dir}" \
+            ${params.scale_space_dir != "" ? "--scale-space-dir ${params.scale_space_dir}" : ''} \
             --registered-crops-dir "${params.registered_crops_dir}" \
             --crop-width-x "${params.crop_width_x}" \
             --crop-width-y "${params.crop_width_y}" \
             --overlap-x "${params.overlap_x}" \
             --overlap-y "${params.overlap_y}" \
+            ${params.adaptive_overlap ? '--adaptive-overlap' : ''} \
             --max-workers "${params.max_workers}" \
+            ${params.delete_checkpoints ? '--delete-checkpoints' : ''} \
+            ${params.in_memory ? '--in-memory' : ''} \
+            ${params.scratch_budget != "" ? "--scratch-budget ${params.scratch_budget} --scratch-dirs ${params.crops_dir_fixed} ${params.registered_crops_dir} ${params.mappings_dir} ${params.scale_space_dir}" : ''} \
+            ${params.save_checkpoints ? '--save-checkpoints' : ''} \
+            ${params.blend ? '--blend' : ''} \
+            ${params.skip_threshold != "" ? "--skip-threshold ${params.skip_threshold}" : ''} \
+            --similarity-metric "${params.similarity_metric}" \
+            --level-iters "${params.level_iters}" \
+            --opt-tol "${params.opt_tol}" \
+            --inv-tol "${params.inv_tol}" \
+            --metric "${params.metric}" \
+            --metric-radius "${params.metric_radius}" \
             --logs-dir "${params.logs_dir}"     
     fi
     """
 }
+
+process register_image {
+    cpus { get_resource(input_path, 'register', 'cpus', 10) }
+    memory { get_resource(input_path, 'register', 'memory', "50G") }
+    time { get_resource(input_path, 'register', 'time', null) }
+    publishDir "${params.output_dir_reg}", mode: "copy"
+    tag "registration"
+
+    input:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_path),
+        val(output_path)
+
+    output:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_path),
+        val(output_path)
+
+    script:
+    """
+    if [ "${input_path}" != "${fixed_image_path}" ]; then
+        register_image.py \
+            --input-path "${input_path}" \
+            --output-dir "${params.output_dir_reg}" \
+            --fixed-image-path "${fixed_image_path}" \
+            --mappings-dir "${params.mappings_dir}" \
+            ${params.scale_space_dir != "" ? "--scale-space-dir ${params.scale_space_dir}" : ''} \
+            --registered-crops-dir "${params.registered_crops_dir}" \
+            --crop-width-x "${params.crop_width_x}" \
+            --crop-width-y "${params.crop_width_y}" \
+            --overlap-x "${params.overlap_x}" \
+            --overlap-y "${params.overlap_y}" \
+            ${params.adaptive_overlap ? '--adaptive-overlap' : ''} \
+            --max-workers "${params.max_workers}" \
+            ${params.save_checkpoints ? '--save-checkpoints' : ''} \
+            ${params.blend ? '--blend' : ''} \
+            ${params.skip_threshold != "" ? "--skip-threshold ${params.skip_threshold}" : ''} \
+            --similarity-metric "${params.similarity_metric}" \
+            --level-iters "${params.level_iters}" \
+            --opt-tol "${params.opt_tol}" \
+            --inv-tol "${params.inv_tol}" \
+            --metric "${params.metric}" \
+            --metric-radius "${params.metric_radius}" \
+            --logs-dir "${params.logs_dir}"
+    fi
+    """
+}
+
+process register_patient {
+    cpus { get_resource(input_paths[0], 'register', 'cpus', 10) }
+    memory { get_resource(input_paths[0], 'register', 'memory', "50G") }
+    time { get_resource(input_paths[0], 'register', 'time', null) }
+    publishDir "${params.output_dir_reg}", mode: "copy"
+    tag "registration_patient"
+
+    input:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_paths),
+        val(output_paths)
+
+    output:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_paths),
+        val(output_paths)
+
+    script:
+    // The fixed image is skipped by register_image.py
+    """
+    register_image.py \
+        --input-path ${input_paths.collect { "\"${it}\"" }.join(' ')} \
+        --output-dir "${params.output_dir_reg}" \
+        --fixed-image-path "${fixed_image_path}" \
+        --mappings-dir "${params.mappings_dir}" \
+        ${params.scale_space_dir != "" ? "--scale-space-dir ${params.scale_space_dir}" : ''} \
+        --registered-crops-dir "${params.registered_crops_dir}" \
+        --crop-width-x "${params.crop_width_x}" \
+        --crop-width-y "${params.crop_width_y}" \
+        --overlap-x "${params.overlap_x}" \
+        --overlap-y "${params.overlap_y}" \
+        ${params.adaptive_overlap ? '--adaptive-overlap' : ''} \
+        --max-workers "${params.max_workers}" \
+        --max-concurrent "${params.max_concurrent_cycles}" \
+        ${params.save_checkpoints ? '--save-checkpoints' : ''} \
+        ${params.blend ? '--blend' : ''} \
+        ${params.skip_threshold != "" ? "--skip-threshold ${params.skip_threshold}" : ''} \
+        --similarity-metric "${params.similarity_metric}" \
+        --level-iters "${params.level_iters}" \
+        --opt-tol "${params.opt_tol}" \
+        --inv-tol "${params.inv_tol}" \
+        --metric "${params.metric}" \
+        --metric-radius "${params.metric_radius}" \
+        --logs-dir "${params.logs_dir}"
+    """
+}
+
+process diffeomorphic_registration_batch {
+    cpus { get_resource(input_path, 'diffeomorphic', 'cpus', 10) }
+    memory { get_resource(input_path, 'diffeomorphic', 'memory', "50G") }
+    time { get_resource(input_path, 'diffeomorphic', 'time', null) }
+    tag "registration_2_batch"
+
+    input:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_path),
+        val(output_path),
+        val(batch_index)
+
+    output:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_path),
+        val(output_path),
+        val(batch_index)
+
+    script:
+    """
+    if [ "${input_path}" != "${fixed_image_path}" ]; then
+        diffeomorphic_registration.py \
+            --input-path "${input_path}" \
+            --output-dir "${params.output_dir_reg}" \
+            --fixed-image-path "${fixed_image_path}" \
+            --crops-dir-fixed "${params.crops_dir_fixed}" \
+            --crops-dir-moving "${params.crops_dir_moving}" \
+            --mappings-dir "${params.mappings_dir}" \
+            ${params.scale_space_dir != "" ? "--scale-space-dir ${params.scale_space_dir}" : ''} \
+            --registered-crops-dir "${params.registered_crops_dir}" \
+            --crop-width-x "${params.crop_width_x}" \
+            --crop-width-y "${params.crop_width_y}" \
+            --overlap-x "${params.overlap_x}" \
+            --overlap-y "${params.overlap_y}" \
+            ${params.adaptive_overlap ? '--adaptive-overlap' : ''} \
+            --max-workers "${params.max_workers}" \
+            --n-batches "${params.n_batches}" \
+            --batch-index "${batch_index}" \
+            ${params.delete_checkpoints ? '--delete-checkpoints' : ''} \
+            ${params.skip_threshold != "" ? "--skip-threshold ${params.skip_threshold}" : ''} \
+            --similarity-metric "${params.similarity_metric}" \
+            --level-iters "${params.level_iters}" \
+            --opt-tol "${params.opt_tol}" \
+            --inv-tol "${params.inv_tol}" \
+            --metric "${params.metric}" \
+            --metric-radius "${params.metric_radius}" \
+            --logs-dir "${params.logs_dir}"
+    fi
+    """
+}
+
+process gather_registration {
+    cpus 1
+    memory "2G"
+    tag "registration_2_gather"
+
+    input:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_path),
+        val(output_path),
+        val(batch_indices)
+
+    output:
+    tuple val(patient_id),
+        val(fixed_image_path),
+        val(input_path),
+        val(output_path)
+
+    script:
+    """
+    if [ "${input_path}" != "${fixed_image_path}" ]; then
+        gather_registration.py \
+            --input-path "${input_path}" \
+            --fixed-image-path "${fixed_image_path}" \
+            --mappings-dir "${params.mappings_dir}" \
+            --registered-crops-dir "${params.registered_crops_dir}" \
+            --crop-width-x "${params.crop_width_x}" \
+            --crop-width-y "${params.crop_width_y}" \
+            --overlap-x "${params.overlap_x}" \
+            --overlap-y "${params.overlap_y}" \
+            --n-batches "${params.n_batches}" \
+            ${params.scratch_budget != "" ? "--scratch-budget ${params.scratch_budget} --scratch-dirs ${params.crops_dir_fixed} ${params.registered_crops_dir} ${params.mappings_dir} ${params.scale_space_dir}" : ''} \
+            --logs-dir "${params.logs_dir}"
+    fi
+    """
+}
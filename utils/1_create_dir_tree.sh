@@ -46,6 +46,7 @@ mappings_dir="${work_dir}/data/mappings"
 registered_crops_1="${work_dir}/data/registered_crops/affine"
 registered_crops_2="${work_dir}/data/registered_crops/diffeomorphic"
 crops="${work_dir}/data/crops"
+scale_space="${work_dir}/data/scale_space"
 
 # Create directories if they don't exist
 mkdir -p "${input_dir}"
@@ -62,5 +63,6 @@ mkdir -p "${mappings_dir}"
 mkdir -p "${registered_crops_1}"
 mkdir -p "${registered_crops_2}"
 mkdir -p "${crops}"
+mkdir -p "${scale_space}"
 
 echo "Directories have been created and verified."
@@ -1,10 +1,14 @@
 import argparse
 import os
+import sys
 import csv
 import re
 from collections import defaultdict
 from datetime import datetime
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+from utils.file_catalog import FileCatalog, CATALOG_FILENAME
+
 def extract_date_from_path(path):
     """Extract the date from the input path using a regex pattern."""
     match = re.search(r'\d{4}\.\d{2}\.\d{2}', path)  # Matches dates like '2024.08.30'
@@ -12,8 +16,8 @@ def extract_date_from_path(path):
         return datetime.strptime(match.group(), '%Y.%m.%d')
     return None
 
-def process_files(work_dir, input_dir=None, output_dir=None, output_csv="output.csv"):
-    """Process files from input_dir and check existence in output_reg_2."""
+def process_files(work_dir, input_dir=None, output_dir=None, output_csv="output.csv", catalog_path=None, full_rescan=False):
+    """Process files from input_dir and check existence in output_reg_2. Files are listed from a catalog updated incrementally."""
     # Set default values for input_dir and output_dir if they are not provided
     if input_dir is None:
         input_dir = os.path.join(work_dir, 'data/input/image_registration')
@@ -22,26 +26,30 @@ def process_files(work_dir, input_dir=None, output_dir=None, output_csv="output.
 
     patient_data = defaultdict(list)  # Dictionary to group files by patient_id
     
-    # Step 1: Walk through the input directory and collect file information
-    for root, dirs, files in os.walk(input_dir):
-        for file in files:
-            if file.endswith('.nd2') or file.endswith('.h5'):  # Process .nd2 or .h5 files
-                patient_id = file.split('_')[0]
-                input_path = os.path.join(root, file)
-                
-                # Extract the date from the input path
-                date = extract_date_from_path(input_path)
-                
-                # Define expected paths based on the directory structure
-                # output_path = os.path.join(work_dir, 'data/output/image_conversion', input_path.replace(input_dir, '').lstrip('/').replace('.nd2', '.ome.tiff'))
-                output_path = os.path.join(work_dir, 'data/output/image_conversion', re.sub(r'\.(nd2|h5)$', '.ome.tiff', input_path.replace(input_dir, '').lstrip('/')))           
-                # Store data with date
-                patient_data[patient_id].append({
-                    'patient_id': patient_id,
-                    'input_path': input_path,
-                    'output_path': output_path,
-                    'date': date  # Keep date in the dictionary for processing
-                })
+    # Step 1: List the input directory from the catalog and collect file information
+    if catalog_path is None:
+        catalog_path = os.path.join(work_dir, 'logs', 'io', CATALOG_FILENAME)
+    with FileCatalog(catalog_path) as catalog:
+        catalog.update(input_dir, full=full_rescan)
+        files = catalog.get_files(input_dir, '.nd2') + catalog.get_files(input_dir, '.h5')  # Process .nd2 or .h5 files
+
+    for file in files:
+        patient_id = os.path.basename(file['path']).split('_')[0]
+        input_path = file['path']
+
+        # Extract the date from the input path
+        date = extract_date_from_path(input_path)
+
+        # Define expected paths based on the directory structure
+        # output_path = os.path.join(work_dir, 'data/output/image_conversion', input_path.replace(input_dir, '').lstrip('/').replace('.nd2', '.ome.tiff'))
+        output_path = os.path.join(work_dir, 'data/output/image_conversion', re.sub(r'\.(nd2|h5)$', '.ome.tiff', input_path.replace(input_dir, '').lstrip('/')))
+        # Store data with date
+        patient_data[patient_id].append({
+            'patient_id': patient_id,
+            'input_path': input_path,
+            'output_path': output_path,
+            'date': date  # Keep date in the dictionary for processing
+        })
 
     # Step 2: Determine the fixed_image_path for each patient based on the least recent date
     rows = []
@@ -73,11 +81,13 @@ def main():
     parser.add_argument('--input-dir', help="Directory containing the subdirectories with the files to be converted")
     parser.add_argument('--output-dir', help="Directory structure with the files to check for output_reg_2 and the 'registered' column")
     parser.add_argument('--output-csv', default="sample_sheet.csv", help="Name of the CSV output file (default: output.csv)")
+    parser.add_argument('--catalog-path', help="SQLite catalog of the input files, updated incrementally (default: <work_dir>/logs/io/file_catalog.sqlite)")
+    parser.add_argument('--full-rescan', action='store_true', help="List every input directory again, to refresh files rewritten in place")
     
     args = parser.parse_args()
     
     # Process the files and generate the CSV
-    process_files(args.work_dir, args.input_dir, args.output_dir, args.output_csv)
+    process_files(args.work_dir, args.input_dir, args.output_dir, args.output_csv, args.catalog_path, args.full_rescan)
 
 if __name__ == "__main__":
     main()
@@ -116,7 +116,7 @@ python bin/utils/generate_sample_sheet/update_io.py \
     --logs-dir "${logs_dir}" \
     --backup-dir "${backup_dir}" \
     --colnames patient_id input_path_reg output_path_reg_1 registered_1 filename \
-    --export-path "${logs_dir}/io/reg_sample_sheet.csv" \
+    --export-path "${logs_dir}/io/reg_1_sample_sheet.csv" \
     --make-dirs
 
 echo "Creating elastic_reg_sample_sheet.csv"
@@ -128,21 +128,23 @@ python bin/utils/generate_sample_sheet/update_io.py \
     --logs-dir "${logs_dir}" \
     --backup-dir "${backup_dir}" \
     --colnames patient_id input_path_reg output_path_reg_2 registered_2 filename \
-    --export-path "${logs_dir}/io/reg_sample_sheet.csv" \
+    --export-path "${logs_dir}/io/reg_2_sample_sheet.csv" \
     --make-dirs
 
 # Remove unnecessary columns
-python bin/utils/generate_sample_sheet/remove_columns.py \
-    --csv-file-path "${logs_dir}/io/reg_sample_sheet.csv" \
-    --column input_path_reg patient_id \
-    --export-path "${logs_dir}/io/reg_sample_sheet.csv"
+for reg_sample_sheet in "${logs_dir}/io/reg_1_sample_sheet.csv" "${logs_dir}/io/reg_2_sample_sheet.csv"; do
+    python bin/utils/generate_sample_sheet/remove_columns.py \
+        --csv-file-path "${reg_sample_sheet}" \
+        --column input_path_reg patient_id \
+        --export-path "${reg_sample_sheet}"
+done
 
-# Join I/O sheets
-echo "Joining "${logs_dir}/io/conv_sample_sheet.csv" and "${logs_dir}/io/reg_sample_sheet.csv""
+# Load the I/O sheets into the sample store and export the joined sheet
+echo "Joining "${logs_dir}/io/conv_sample_sheet.csv" and the registration sample sheets"
 python bin/utils/generate_sample_sheet/join_samp_sheets.py \
-    --samp-sheets-paths "${logs_dir}/io/conv_sample_sheet.csv" "${logs_dir}/io/reg_sample_sheet.csv" \
-    --key-col-name "patient_id" \
+    --samp-sheets-paths "${logs_dir}/io/conv_sample_sheet.csv" "${logs_dir}/io/reg_1_sample_sheet.csv" "${logs_dir}/io/reg_2_sample_sheet.csv" \
+    --key-col-name "filename" \
     --filter-pending \
     --export-path "${export_path}" \
     --export-path-filtered "${export_path}" \
-    --backup-dir "${logs_dir}/io/backups" 
+    --store-path "${logs_dir}/io/sample_store.sqlite"
@@ -1,3 +1,11 @@
 python 2_generate_sample_sheet.py \
 	--work-dir /data/dimaimaging_dare/work/image_registration_pipeline \
 	--output-csv /data/dimaimaging_dare/work/image_registration_pipeline/logs/io/sample_sheet.csv
+
+python ../bin/plan_resources.py \
+	--sample-sheet-path /data/dimaimaging_dare/work/image_registration_pipeline/logs/io/sample_sheet.csv \
+	--crop-width-x 7000 \
+	--crop-width-y 7000 \
+	--overlap-x 3000 \
+	--overlap-y 3000 \
+	--max-workers 10